@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+# benchmark.py
+#
+# Serban Giuroiu
+# http://serban.org
+#
+# Measure how much time piggy itself spends scanning, scheduling and shuffling
+# PCM around, apart from the time the codecs take. A synthetic library of WAVE
+# and AIFF files is generated, and piggy's main() is run against it with fast
+# stand-ins for the codecs, or with the real codecs when -R is given.
+
+# ------------------------------------------------------------------------------
+
+import getopt
+import json
+import os
+import random
+import resource
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import time
+import wave
+
+import piggy
+
+from piggy import msg, err, sep
+
+# ------------------------------------------------------------------------------
+
+SAMPLE_RATE             = 44100
+CHANNELS                = 2
+SAMPLE_WIDTH            = 2             # Bytes per sample
+FILES_PER_FOLDER        = 12            # About an album's worth
+FOLDERS_PER_FOLDER      = 4             # Fan-out of every level above the albums
+DEFAULT_SETTINGS        = ['flac', 'lame-vbr2']
+RANDOM_SEED             = 1             # Same fixtures on every run
+
+STANDIN_TOOLS           = ['AtomicParsley', 'afconvert', 'faad', 'flac', 'lame',
+                            'madplay', 'metaflac', 'oggdec', 'oggenc',
+                            'vorbiscomment']
+
+# The stand-in codecs copy their input to their output, which is as fast as a
+# codec can possibly be. flac is the exception: it wraps the WAVE file in a
+# STREAMINFO and a VORBIS_COMMENT block, so piggy's native FLAC readers work on
+# the fixtures, and unwraps it again when decoding.
+STANDIN_SOURCE = r'''
+import hashlib
+import os
+import shutil
+import struct
+import sys
+
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+def openInput(path):
+    return sys.stdin.buffer if path == '-' else open(path, 'rb')
+
+def openOutput(path):
+    return sys.stdout.buffer if path == '-' else open(path, 'wb')
+
+def copy(inputPath, outputPath):
+    with openInput(inputPath) as i, openOutput(outputPath) as o:
+        shutil.copyfileobj(i, o, 1024 * 1024)
+
+def flacEncode(inputPath, outputPath, tags):
+    with openInput(inputPath) as i:
+        data = i.read()
+
+    sampleRate, channels, bits = 44100, 2, 16
+    pos = data.find(b'fmt ')
+    if pos >= 0:
+        channels, sampleRate = struct.unpack_from('<HI', data, pos + 10)
+        bits, = struct.unpack_from('<H', data, pos + 22)
+    samples = max(0, len(data) - 44) // (channels * bits // 8)
+
+    info = struct.pack('>HH', 4096, 4096) + b'\0' * 6
+    info += ((sampleRate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) |
+                samples).to_bytes(8, 'big')
+    info += hashlib.md5(data[44:]).digest()
+
+    vendor = b'piggy benchmark'
+    comments = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(tags))
+    for tag in tags:
+        tag = tag.encode('utf-8')
+        comments += struct.pack('<I', len(tag)) + tag
+
+    with openOutput(outputPath) as o:
+        o.write(b'fLaC')
+        o.write(bytes([0]) + len(info).to_bytes(3, 'big') + info)
+        o.write(bytes([0x84]) + len(comments).to_bytes(3, 'big') + comments)
+        o.write(data)
+
+def mp4Box(boxType, data):
+    return struct.pack('>I4s', 8 + len(data), boxType) + data
+
+def alacEncode(inputPath, outputPath):
+    # The PCM goes into mdat as is, with just enough of a moov after it for
+    # piggy to write its tags into
+    with openInput(inputPath) as i:
+        data = i.read()
+
+    mvhd = mp4Box(b'mvhd', bytes(12) + struct.pack('>II', 44100, 0) + bytes(80))
+    with openOutput(outputPath) as o:
+        o.write(mp4Box(b'ftyp', b'M4A \0\0\0\0M4A mp42isom'))
+        o.write(mp4Box(b'mdat', data))
+        o.write(mp4Box(b'moov', mvhd))
+
+def flacDecode(inputPath, outputPath):
+    with openInput(inputPath) as i, openOutput(outputPath) as o:
+        if i.read(4) != b'fLaC':
+            sys.exit(1)
+        last = False
+        while not last:
+            header = i.read(4)
+            last = header[0] & 0x80
+            i.read(int.from_bytes(header[1:], 'big'))
+        shutil.copyfileobj(i, o, 1024 * 1024)
+
+if tool in ('AtomicParsley', 'metaflac', 'vorbiscomment'):
+    sys.exit(0)
+elif tool == 'flac':
+    outputPath = args[args.index('-o') + 1] if '-o' in args else '-'
+    if '--decode' in args or '-d' in args:
+        flacDecode(args[-1], outputPath)
+    else:
+        tags = [args[n + 1] for n, a in enumerate(args[:-1]) if a == '-T']
+        flacEncode(args[-1], outputPath, tags)
+elif tool == 'afconvert' and 'alac' in args:
+    alacEncode(args[-2], args[-1])
+elif tool in ('afconvert', 'lame'):
+    copy(args[-2], args[-1])
+elif tool == 'faad':
+    copy(args[-1], '-' if '-w' in args else args[args.index('-o') + 1])
+elif tool in ('oggenc', 'oggdec', 'madplay'):
+    outputPath = args[args.index('-o') + 1]
+    copy(args[-1], '-' if outputPath == 'wave:-' else outputPath)
+'''
+
+# ------------------------------------------------------------------------------
+
+class Options(object):
+    def __init__(self):
+        self.count          = 200       # Number of fixtures
+        self.length         = 5.0       # Seconds of audio in every fixture
+        self.depth          = 2         # Folder levels above the albums
+        self.flacPercent    = 0         # Fixtures compressed with flac first
+        self.settings       = []        # Names of the settings to benchmark
+        self.realCodecs     = False     # Use the codecs in PATH
+        self.keep           = False     # Keep the working directory
+        self.resultsPath    = None      # Where to write the results as JSON
+        self.piggyArgs      = []        # Passed through to piggy
+
+def parseCommandLine():
+    # Accept the following command line arguments:
+    #   -n  Number of fixtures to generate
+    #   -l  Length of every fixture in seconds
+    #   -d  Folder levels above the albums
+    #   -f  Percentage of fixtures to compress with flac before the run
+    #   -s  Encoder setting to benchmark (repeatable)
+    #   -R  Run the real codecs from PATH instead of the stand-ins
+    #   -k  Keep the working directory
+    #   -r  Write the results to this JSON file
+    #   Anything after -- is passed on to piggy
+
+    options = Options()
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:l:d:f:s:Rkr:')
+        numbers = {'-n': int, '-l': float, '-d': int, '-f': int}
+        for opt, arg in opts:
+            if opt in numbers and numbers[opt](arg) < 0:
+                raise ValueError(opt + ' must not be negative')
+
+            if opt == '-n':
+                options.count = int(arg)
+            elif opt == '-l':
+                options.length = float(arg)
+            elif opt == '-d':
+                options.depth = int(arg)
+            elif opt == '-f':
+                options.flacPercent = min(100, int(arg))
+            elif opt == '-s':
+                options.settings.append(arg)
+            elif opt == '-R':
+                options.realCodecs = True
+            elif opt == '-k':
+                options.keep = True
+            elif opt == '-r':
+                options.resultsPath = arg
+    except (getopt.GetoptError, ValueError) as e:
+        err(e)
+        sys.exit(piggy.EXIT_CMDFAILURE)
+
+    options.settings = options.settings or DEFAULT_SETTINGS
+    options.piggyArgs = args
+
+    known = [s.name for s in piggy.encoderSettings]
+    for name in options.settings:
+        if name not in known:
+            err('Invalid encoder setting: ' + name)
+            sys.exit(piggy.EXIT_CMDFAILURE)
+
+    return options
+
+# ------------------------------------------------------------------------------
+
+def fixturePath(root, number, depth):
+    '''Spread the fixtures over albums of FILES_PER_FOLDER tracks, nested depth
+    folders deep'''
+
+    album = number // FILES_PER_FOLDER
+    parts = []
+    for level in range(depth):
+        parts.append('level{}-{}'.format(level, album % FOLDERS_PER_FOLDER))
+        album //= FOLDERS_PER_FOLDER
+    parts.reverse()
+
+    album = number // FILES_PER_FOLDER
+    parts.append('album{:04}'.format(album))
+    return os.path.join(root, *parts)
+
+def noise(rng, length):
+    # A second of noise, repeated. Noise is the worst case for the real
+    # codecs, and generating more of it would only benchmark this script.
+    second = rng.randbytes(SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH)
+    frames = int(length * SAMPLE_RATE)
+    data = second * (frames // SAMPLE_RATE + 1)
+    return data[:frames * CHANNELS * SAMPLE_WIDTH]
+
+def writeWave(path, data):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(SAMPLE_WIDTH)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(data)
+
+def writeAIFF(path, data):
+    # AIFF samples are big-endian
+    samples = bytearray(data)
+    samples[0::2], samples[1::2] = data[1::2], data[0::2]
+
+    frames = len(data) // (CHANNELS * SAMPLE_WIDTH)
+    exponent = 16383 + 63
+    mantissa = SAMPLE_RATE
+    while not mantissa & (1 << 63):
+        mantissa <<= 1
+        exponent -= 1
+
+    comm = struct.pack('>HIH', CHANNELS, frames, SAMPLE_WIDTH * 8)
+    comm += struct.pack('>HQ', exponent, mantissa)
+    ssnd = struct.pack('>II', 0, 0) + bytes(samples)
+
+    with open(path, 'wb') as f:
+        f.write(b'FORM' + struct.pack('>I', 4 + 8 + len(comm) + 8 + len(ssnd)) + b'AIFF')
+        f.write(b'COMM' + struct.pack('>I', len(comm)) + comm)
+        f.write(b'SSND' + struct.pack('>I', len(ssnd)) + ssnd)
+
+def generateLibrary(root, options):
+    '''Write the fixtures and return their total size in bytes. Every third
+    fixture is an AIFF file, and flacPercent of them are compressed with
+    whichever flac is in PATH.'''
+
+    rng = random.Random(RANDOM_SEED)
+    total = 0
+
+    for number in range(options.count):
+        folder = fixturePath(root, number, options.depth)
+        os.makedirs(folder, exist_ok=True)
+
+        data = noise(rng, options.length)
+        name = '{:02} Track {}'.format(number % FILES_PER_FOLDER + 1, number)
+
+        if number % 3 == 2:
+            path = os.path.join(folder, name + '.aiff')
+            writeAIFF(path, data)
+        else:
+            path = os.path.join(folder, name + '.wav')
+            writeWave(path, data)
+
+        if number * 100 < options.flacPercent * options.count:
+            flacPath = os.path.splitext(path)[0] + '.flac'
+            album = os.path.basename(folder)
+            argv = [piggy.FLAC, '--silent', '-T', 'ARTIST=Benchmark',
+                    '-T', 'ALBUM=' + album, '-T', 'TITLE=' + name,
+                    '-T', 'TRACKNUMBER=' + str(number % FILES_PER_FOLDER + 1),
+                    '-o', flacPath, path]
+            if piggy.runProcess(argv) != 0:
+                err('Could not compress ' + path)
+                sys.exit(piggy.EXIT_CMDFAILURE)
+            os.remove(path)
+            path = flacPath
+
+        total += os.path.getsize(path)
+
+    return total
+
+def installStandIns(binPath):
+    '''Write the stand-in codecs into binPath and put it first in PATH'''
+
+    os.makedirs(binPath, exist_ok=True)
+
+    script = os.path.join(binPath, 'standin')
+    with open(script, 'w') as f:
+        f.write('#!' + sys.executable + ' -S\n' + STANDIN_SOURCE)
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    for tool in STANDIN_TOOLS:
+        os.symlink('standin', os.path.join(binPath, tool))
+
+    os.environ['PATH'] = binPath + os.pathsep + os.environ.get('PATH', '')
+
+def folderSize(root):
+    total = 0
+    for folder, folders, files in os.walk(root):
+        for name in files:
+            total += os.path.getsize(os.path.join(folder, name))
+    return total
+
+def runPiggy(options, inputPath, outputPath, reportPath):
+    '''Run piggy's main() and return its report along with the wall and CPU
+    seconds that piggy spent in its own process'''
+
+    argv = [piggy.NAME]
+    for name in options.settings:
+        argv += ['-s', name]
+    argv += ['-i', inputPath, '-r', reportPath] + options.piggyArgs + [outputPath]
+
+    savedArgv = sys.argv
+    sys.argv = argv
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    startTime = time.perf_counter()
+
+    try:
+        piggy.main()
+    except SystemExit as e:
+        if e.code:
+            err('piggy exited with ' + str(e.code))
+            sys.exit(e.code)
+    finally:
+        sys.argv = savedArgv
+
+    wallSeconds = time.perf_counter() - startTime
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpuSeconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    with open(reportPath) as f:
+        report = json.load(f)
+
+    return report, wallSeconds, cpuSeconds
+
+def summarize(options, report, wallSeconds, cpuSeconds, libraryBytes, outputBytes):
+    files = report['scan']['files']
+    slots = report['slots']
+    stages = report['stages']
+
+    # The encoders hold the process slots, so whatever the slots spent idle
+    # is what scanning, decoding ahead and scheduling cost
+    encodeSeconds = stages.get('encode', {}).get('wallSeconds', 0.0)
+    busySeconds = encodeSeconds / slots if slots else 0.0
+    tempBytes = sum(s.get('tempBytes', 0) for s in stages.values())
+    codecSeconds = sum(s['userSeconds'] + s['systemSeconds'] for s in stages.values())
+
+    return {
+        'codecs':               'real' if options.realCodecs else 'stand-in',
+        'settings':             options.settings,
+        'piggyArgs':            options.piggyArgs,
+        'files':                files,
+        'libraryBytes':         libraryBytes,
+        'outputBytes':          outputBytes,
+        'slots':                slots,
+        'wallSeconds':          wallSeconds,
+        'filesPerSecond':       files / wallSeconds if wallSeconds else 0.0,
+        'scanSeconds':          report['scan']['seconds'],
+        'schedulingSeconds':    max(0.0, report['wallSeconds'] - busySeconds),
+        'piggyCpuSeconds':      cpuSeconds,
+        'codecCpuSeconds':      codecSeconds,
+        'tempBytes':            tempBytes,
+        'stages':               stages,
+    }
+
+def printResults(results):
+    msg('Files:              ' + str(results['files']) + ' (' +
+        piggy.formatBytes(results['libraryBytes']) + ' in, ' +
+        piggy.formatBytes(results['outputBytes']) + ' out)')
+    msg('Codecs:             ' + results['codecs'] + ', ' + ', '.join(results['settings']))
+    msg('Wall time:          ' + '{:.2f}s'.format(results['wallSeconds']))
+    msg('Throughput:         ' + '{:.1f} files/s'.format(results['filesPerSecond']))
+    msg('Scan:               ' + '{:.2f}s'.format(results['scanSeconds']))
+    msg('Slots idle:         ' + '{:.2f}s'.format(results['schedulingSeconds']) +
+        ' of ' + str(results['slots']) + ' slots')
+    msg('piggy CPU time:     ' + '{:.2f}s'.format(results['piggyCpuSeconds']))
+    msg('Codec CPU time:     ' + '{:.2f}s'.format(results['codecCpuSeconds']))
+    msg('Temporary files:    ' + piggy.formatBytes(results['tempBytes']))
+
+# ------------------------------------------------------------------------------
+
+def main():
+    options = parseCommandLine()
+
+    workPath = tempfile.mkdtemp(prefix=piggy.NAME + '-benchmark-')
+    inputPath = os.path.join(workPath, 'library')
+    outputPath = os.path.join(workPath, 'output')
+    tempPath = os.path.join(workPath, 'tmp')
+    reportPath = os.path.join(workPath, 'report.json')
+
+    os.makedirs(tempPath)
+    piggy.TMPDIR = tempPath
+
+    try:
+        if not options.realCodecs:
+            installStandIns(os.path.join(workPath, 'bin'))
+
+        msg('Generating ' + str(options.count) + ' fixtures in ' + inputPath)
+        libraryBytes = generateLibrary(inputPath, options)
+
+        report, wallSeconds, cpuSeconds = runPiggy(options, inputPath,
+                                                    outputPath, reportPath)
+        results = summarize(options, report, wallSeconds, cpuSeconds,
+                            libraryBytes, folderSize(outputPath))
+    finally:
+        if options.keep:
+            msg('Keeping ' + workPath)
+        else:
+            shutil.rmtree(workPath, ignore_errors=True)
+
+    sep()
+    printResults(results)
+
+    if options.resultsPath:
+        with open(options.resultsPath, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
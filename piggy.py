@@ -23,11 +23,34 @@
 
 # ------------------------------------------------------------------------------
 
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import ctypes
+import fcntl
 import getopt
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
 import pdb
 import queue
 import re
+import resource
+import select
+import shlex
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
 import subprocess
 import sys
 import threading
@@ -49,6 +72,35 @@ OGGENC                  = os.path.join(PATH_PREFIX, 'oggenc')
 VORBISCOMMENT           = os.path.join(PATH_PREFIX, 'vorbiscomment')
 
 TMPDIR                  = '/tmp'
+MANIFEST_NAME           = '.piggy-manifest'       # Kept in every setting's output folder
+JOURNAL_NAME            = '.piggy-journal'        # Kept in the output folder
+PARTIAL_PREFIX          = '.piggy-partial.'       # Outputs that aren't complete yet
+INDEX_COMMIT_INTERVAL   = 100           # Rows stored between library index commits
+ASSUMED_BYTE_RATE       = 64 * 1024     # Bytes per second of audio when the headers don't say
+PCM_BUFFER_LENGTH       = 16            # Decoded files waiting for an encoder
+PCM_BUFFER_SIZE         = 2 * 1024 ** 3 # Bytes of decoded files in TMPDIR
+SCAN_AHEAD              = 1000          # Files the scanner may queue ahead of the workers
+TEE_BUFFER_SIZE         = 64 * 1024     # Bytes copied at a time when fanning out PCM
+HASH_BUFFER_SIZE        = 1024 * 1024   # Bytes read at a time when hashing a file
+READ_BUFFER_SIZE        = 1024 * 1024   # Bytes read at a time when reading ahead
+READ_AHEAD              = 4             # Files read ahead of the decoders
+ROTATIONAL_READERS      = 1             # Files read at once from a spinning disk
+NETWORK_READERS         = 2             # Files read at once from a network filesystem
+SNIFF_SIZE              = 4096          # Bytes read to tell what's in a file
+FICLONE                 = 0x40049409    # Linux ioctl that makes a copy-on-write clone
+GOVERNOR_INTERVAL       = 2.0           # Seconds between adaptive concurrency decisions
+CPU_PRESSURE_HIGH       = 0.25          # Share of time runnable tasks waited for a CPU
+IO_PRESSURE_HIGH        = 0.50          # Share of time every task waited for I/O
+CHILD_BUSY_LOW          = 0.60          # Child CPU time per slot below which to grow
+LEASE_SECONDS           = 60            # How long a worker keeps a job without a heartbeat
+HEARTBEAT_INTERVAL      = 10            # Seconds between a worker's heartbeats
+LEASE_WAIT              = 1.0           # Seconds a lease request waits for a job to turn up
+WORK_AHEAD              = 2             # Jobs per process slot a worker leases ahead
+WATCH_SETTLE            = 2.0           # Seconds a new file must stay unchanged to be queued
+WATCH_TICK              = 1.0           # Seconds between looks at the settling files
+WATCH_POLL_INTERVAL     = 10.0          # Seconds between scans without inotify
+PROGRESS_INTERVAL       = 0.5           # Seconds between redraws of the status line
+PROGRESS_LOG_INTERVAL   = 30.0          # Seconds between progress lines when not on a terminal
 NAME                    = 'piggy'
 
 ALAC_FILE_EXTENSIONS    = ['m4a']
@@ -58,10 +110,30 @@ MP3_FILE_EXTENSIONS     = ['mp3']
 MP4_FILE_EXTENSIONS     = ['mp4', 'm4a']
 VORBIS_FILE_EXTENSIONS  = ['ogg']
 WAVE_FILE_EXTENSIONS    = ['wav']
+AUDIO_FILE_EXTENSIONS   = set(ALAC_FILE_EXTENSIONS + AIFF_FILE_EXTENSIONS +
+                                FLAC_FILE_EXTENSIONS + MP3_FILE_EXTENSIONS +
+                                MP4_FILE_EXTENSIONS + VORBIS_FILE_EXTENSIONS +
+                                WAVE_FILE_EXTENSIONS)
+
+SHARD_METHODS           = ['path', 'duration']
+FSYNC_POLICIES          = ['none', 'file', 'album']
+NETWORK_FILESYSTEMS     = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afpfs',
+                            'fuse.sshfs', '9p', 'ceph', 'glusterfs']
+
+# inotify(7)
+IN_MODIFY               = 0x00000002
+IN_CLOSE_WRITE          = 0x00000008
+IN_MOVED_TO             = 0x00000080
+IN_CREATE               = 0x00000100
+IN_Q_OVERFLOW           = 0x00004000
+IN_IGNORED              = 0x00008000
+IN_ISDIR                = 0x40000000
+INOTIFY_MASK            = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
 
 EXIT_SUCCESS            = 0
 EXIT_FAILURE            = 1
 EXIT_CMDFAILURE         = 2
+EXIT_NOTFOUND           = 127           # What a shell returns for a missing command
 
 # TTY Colors
 NOCOLOR                 = '\033[0m'
@@ -79,67 +151,241 @@ encoderSettings         = []            # See below
 # ------------------------------------------------------------------------------
 
 def msg(s):
-    print(GREEN + '*', s, NOCOLOR)
+    progress.write(GREEN + '* ' + str(s) + ' ' + NOCOLOR)
 
 def err(s):
-    print(RED + '!', s, NOCOLOR)
+    progress.write(RED + '! ' + str(s) + ' ' + NOCOLOR)
 
 def dbg(s):
     if __debug__:
-        print(YELLOW + '%', s, NOCOLOR)
+        progress.write(YELLOW + '% ' + str(s) + ' ' + NOCOLOR)
 
 def sep():
-    try:
-        columns = subprocess.getoutput('stty size').split()[1]
-    except IndexError:
-        columns = 80
-
-    print(WHITE, end='')
-    for i in range(int(columns)):
-        print('-', end='')
-    print(NOCOLOR)
+    progress.write(WHITE + '-' * shutil.get_terminal_size().columns + NOCOLOR)
 
 class Timer(object):
     def start(self):
-        self.startTime = int(time.time())
+        self.startTime = time.perf_counter_ns()
 
     def stop(self):
-        self.endTime = int(time.time())
+        self.endTime = time.perf_counter_ns()
 
     def timeDelta(self):
-        return self.endTime - self.startTime
+        return (self.endTime - self.startTime) / 1e9
 
     def stringDelta(self):
-        total = self.timeDelta()
+        return formatDuration(self.timeDelta())
+
+def formatDuration(total):
+    days    = int(total     // 86400)
+    remain  = total         %  86400
+    hours   = int(remain    //  3600)
+    remain  = remain        %   3600
+    minutes = int(remain    //    60)
+    seconds = remain        %     60
+
+    return str(days) + 'd ' + str(hours) + 'h ' + str(minutes) + 'm ' + '{:.1f}'.format(seconds) + 's'
+
+def formatBytes(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(n) < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TiB'
+
+    return '{:.1f} '.format(n) + unit
+
+class Progress(object):
+    '''Keep track of how far along the run is and how fast it goes: files and
+    bytes per second, and for every setting, how many seconds of audio it
+    encodes per second of the run, its realtime factor. The time left goes
+    by the audio still queued rather than the number of files, since a long
+    file takes longer than a short one.
+
+    On a terminal, a status line stays under the messages and is redrawn
+    every PROGRESS_INTERVAL seconds. Otherwise, a line of key=value pairs is
+    logged every PROGRESS_LOG_INTERVAL seconds. Until start() is called,
+    messages are just printed.'''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.files      = 0         # Queued so far
+        self.done       = 0
+        self.failed     = 0
+        self.audio      = 0.0       # Estimated seconds of audio queued so far
+        self.audioDone  = 0.0       # The same estimate, of the finished files
+        self.settings   = {}        # Setting name -> seconds of audio encoded
+        self.bytesIn    = 0
+        self.bytesOut   = 0
+        self.scan       = None      # ScanProgress, to tell whether more may come
+        self.startTime  = None
+        self.status     = ''        # The status line as drawn, if any
+        self.stopped    = threading.Event()
+        self.thread     = None
+
+    def write(self, line):
+        '''Print a line of output above the status line'''
+
+        with self.lock:
+            if self.status:
+                sys.stdout.write('\r\033[K' + line + '\n' + self.status)
+                sys.stdout.flush()
+            else:
+                print(line)
+
+    def queued(self, entry):
+        with self.lock:
+            entry.estimate = entry.duration()
+            self.files += 1
+            self.audio += entry.estimate
+
+    def finished(self, entry, settings, failed):
+        '''Count an entry as done, with the audio of the settings that
+        encoded it'''
+
+        duration = entry.duration()
+
+        with self.lock:
+            self.done += 1
+            self.failed += 1 if failed else 0
+            self.audioDone += entry.estimate
+            self.bytesIn += entry.stat.st_size if entry.stat else 0
+            for name in settings:
+                self.settings[name] = self.settings.get(name, 0.0) + duration
+
+    def add(self, record):
+        if record.setting:
+            with self.lock:
+                self.bytesOut += record.bytesOut
+
+    def measure(self):
+        '''Return a dict of where the run stands'''
+
+        with self.lock:
+            seconds = max(time.monotonic() - self.startTime, 1e-9)
+            scanning = self.scan is not None and not self.scan.done
+            rate = self.audioDone / seconds
+
+            return {
+                'files':        self.done,
+                'queued':       self.files,
+                'failed':       self.failed,
+                'scanning':     scanning,
+                'filesPerSecond':       self.done / seconds,
+                'bytesInPerSecond':     self.bytesIn / seconds,
+                'bytesOutPerSecond':    self.bytesOut / seconds,
+                'realtime':     dict((name, audio / seconds)
+                                        for name, audio in sorted(self.settings.items())),
+                'secondsLeft':  (self.audio - self.audioDone) / rate if rate else None,
+            }
+
+    def statusLine(self, m):
+        s = '[{:> 6} / {:>6}] '.format(m['files'],
+                                        str(m['queued']) + ('+' if m['scanning'] else ''))
+
+        # The time left goes first, since the line may get cut short
+        if m['secondsLeft'] is not None:
+            s += formatDuration(m['secondsLeft']) + ' left, '
+
+        s += '{:.1f} files/s, '.format(m['filesPerSecond'])
+        s += formatBytes(m['bytesInPerSecond']) + '/s in, '
+        s += formatBytes(m['bytesOutPerSecond']) + '/s out'
+
+        for name, factor in m['realtime'].items():
+            s += ', ' + name + ' {:.1f}x'.format(factor)
+
+        return s
+
+    def logLine(self, m):
+        fields = ['files=' + str(m['files']), 'queued=' + str(m['queued']),
+                    'failed=' + str(m['failed']),
+                    'scanning=' + str(m['scanning']).lower(),
+                    'files_per_s={:.2f}'.format(m['filesPerSecond']),
+                    'bytes_in_per_s={:.0f}'.format(m['bytesInPerSecond']),
+                    'bytes_out_per_s={:.0f}'.format(m['bytesOutPerSecond'])]
+        fields += ['realtime_' + name + '={:.2f}'.format(factor)
+                    for name, factor in m['realtime'].items()]
+        if m['secondsLeft'] is not None:
+            fields.append('eta_s={:.0f}'.format(m['secondsLeft']))
+
+        return 'progress ' + ' '.join(fields)
+
+    def draw(self):
+        # Longer than the terminal is wide, the line would wrap and the
+        # carriage return would only go back to the start of the last row
+        columns = shutil.get_terminal_size().columns
+        line = self.statusLine(self.measure())[:columns - 1]
+
+        with self.lock:
+            self.status = MAGENTA + line + NOCOLOR
+            sys.stdout.write('\r\033[K' + self.status)
+            sys.stdout.flush()
+
+    def start(self, scan):
+        self.scan = scan
+        self.startTime = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        tty = sys.stdout.isatty()
+        interval = PROGRESS_INTERVAL if tty else PROGRESS_LOG_INTERVAL
+
+        while not self.stopped.wait(interval):
+            if tty:
+                self.draw()
+            else:
+                msg(self.logLine(self.measure()))
 
-        days    = total     // 86400
-        remain  = total     %  86400
-        hours   = remain    //  3600
-        remain  = remain    %   3600
-        minutes = remain    //    60
-        seconds = remain    %     60
+    def stop(self):
+        if self.thread is None:
+            return
 
-        return str(days) + 'd ' + str(hours) + 'h ' + str(minutes) + 'm ' + str(seconds) + 's'
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
 
-def escape(str):
-#   TODO: This is probably not adequate nor secure
-#
-#   escape strings:    replace " with \"
+        with self.lock:
+            if self.status:
+                sys.stdout.write('\r\033[K')
+                sys.stdout.flush()
+                self.status = ''
 
-    r = re.compile('"')
-    s = r.sub('\\"', str)
+progress = Progress()   # Shared by every thread
 
-    return s
+def parseSize(s):
+    '''Parse a number of bytes with an optional K, M, G or T suffix. Return 0
+    if it doesn't parse.'''
+
+    units = 'KMGT'
+    s = s.strip().upper().rstrip('B').rstrip('I')
+    multiplier = 1
+    if s and s[-1] in units:
+        multiplier = 1024 ** (units.index(s[-1]) + 1)
+        s = s[:-1]
+
+    try:
+        return int(float(s) * multiplier)
+    except ValueError:
+        return 0
 
 def numCores():
-#   From http://www.boduch.ca/2009/06/python-cpus.html
-#   TODO: make this more reliable
-    if 'SC_NPROCESSORS_ONLN' in os.sysconf_names:
+    '''Return the number of cores piggy may actually use: the ones in its
+    affinity mask, further limited by the CPU quota of its cgroup'''
+
+    if hasattr(os, 'sched_getaffinity'):
         # Linux
+        num = len(os.sched_getaffinity(0))
+    elif 'SC_NPROCESSORS_ONLN' in os.sysconf_names:
         num = os.sysconf('SC_NPROCESSORS_ONLN')
     else:
         # Mac OS X
-        num = int(subprocess.getoutput('sysctl -n hw.ncpu'))
+        num = int(captureOutput(['sysctl', '-n', 'hw.ncpu']) or 0)
+
+    quota = cgroupCPUQuota()
+    if quota:
+        num = min(num, max(1, math.ceil(quota)))
 
     if num < 1:
         err('Could not determine the number of cores available')
@@ -147,803 +393,5561 @@ def numCores():
     else:
         return num
 
-def runProcess(s):
-    if __debug__:
-        print(CYAN + '>', s, NOCOLOR)
+def readFirstLine(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def cgroupCPUQuota():
+    '''Return how many CPUs' worth of time the cgroup may use, or None if
+    there is no quota'''
+
+    # cgroup v2 lists this process as "0::/path"; v1 lists a line per
+    # controller. In a container, the cgroup is usually mounted at the root.
+    v2Path = None
+    v1Path = None
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                parts = line.strip().split(':', 2)
+                if len(parts) != 3:
+                    continue
+                if parts[0] == '0' and parts[1] == '':
+                    v2Path = parts[2]
+                elif 'cpu' in parts[1].split(','):
+                    v1Path = parts[2]
+    except OSError:
+        return None
+
+    if v2Path is not None:
+        for folder in [os.path.join('/sys/fs/cgroup', v2Path.lstrip('/')), '/sys/fs/cgroup']:
+            line = readFirstLine(os.path.join(folder, 'cpu.max'))
+            if line:
+                quota, period = (line.split() + ['100000'])[:2]
+                if quota == 'max':
+                    return None
+                return int(quota) / int(period)
+
+    if v1Path is not None:
+        for root in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+            for folder in [os.path.join(root, v1Path.lstrip('/')), root]:
+                quota = readFirstLine(os.path.join(folder, 'cpu.cfs_quota_us'))
+                period = readFirstLine(os.path.join(folder, 'cpu.cfs_period_us'))
+                if quota and period:
+                    if int(quota) <= 0:
+                        return None
+                    return int(quota) / int(period)
 
-#   TODO: return subprocess.call(s) should be adequate
-    p = subprocess.Popen(s, shell=True)
-    return p.wait()
+    return None
 
-def deleteFile(s):
-    dbg('Deleting ' + s)
-    os.remove(s)
+def readPressure(kind):
+    '''Return the ten second averages of the "some" and "full" lines of
+    /proc/pressure/<kind> as fractions, or Nones where the kernel
+    doesn't say'''
 
-# ------------------------------------------------------------------------------
+    some = full = None
+    try:
+        with open(os.path.join('/proc/pressure', kind)) as f:
+            for line in f:
+                fields = line.split()
+                for field in fields[1:]:
+                    if field.startswith('avg10='):
+                        value = float(field[6:]) / 100
+                        if fields[0] == 'some':
+                            some = value
+                        elif fields[0] == 'full':
+                            full = value
+    except (OSError, ValueError):
+        pass
 
-class AudioFile(object):
-    def __init__(self, path):
-        # AudioFile objects should not exist unless their respective files exist
-        # on disk!
-        assert os.path.isfile(path)
-        assert os.access(path, os.R_OK)
+    return some, full
 
-        self.path = path                                    # Full path to the file on disk
-        self.dir, self.name = os.path.split(path)           # Absolute directory and filename
-        self.name_noext = os.path.splitext(self.name)[0]    # Filename without the period and the extension
-        self.decodedAudioFile = None                        # A decoded version of this file; typically a WaveAudioFile
-        self.tags = {}                                      # { artist, album, title, track, year, comment }
+def readCPUTimes():
+    '''Return the (iowait, total) jiffies of all CPUs, or None'''
 
-        self.loadTags()
+    line = readFirstLine('/proc/stat')
+    if not line or not line.startswith('cpu '):
+        return None
 
-    def generateTempFileName(self, s):
-        # This is not meant to be secure. It'd be nice to use the tempfile
-        # module, but we just need a *name*, not a file handle.
-        # TODO: On Mac OS X, we can use `getconf DARWIN_USER_TEMP_DIR`
-        name = os.path.join(TMPDIR, NAME + '_' + str(time.time()) + '_' + s)
-        return name
+    times = [int(n) for n in line.split()[1:]]
+    return times[4] if len(times) > 4 else 0, sum(times)
 
-    def removeTemporaryFiles(self):
-        if self.decodedAudioFile:
-            deleteFile(self.decodedAudioFile.path)
-            self.decodedAudioFile = None
+def readMountInfo():
+    '''Return a dict of (mount point, filesystem type, source) tuples, keyed
+    by the "major:minor" device number of every mounted filesystem'''
 
-    def decode(self):
-        pass
+    unescape = lambda s: re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), s)
 
-    def loadTags(self):
+    mounts = {}
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields = line.split()
+                rest = fields[fields.index('-') + 1:]
+                mounts.setdefault(fields[2], (unescape(fields[4]), rest[0],
+                                                unescape(rest[1])))
+    except (OSError, ValueError, IndexError):
         pass
 
-    def setTags(self, artist, album, title, track, year, comment):
-        self.tags['artist']     = artist
-        self.tags['album']      = album
-        self.tags['title']      = title
-        self.tags['track']      = track
-        self.tags['year']       = year
-        self.tags['comment']    = comment
-
-class PCMAudioFile(AudioFile):
-    def decode(self):
-        return self
-
-class WaveAudioFile(PCMAudioFile):
-    pass
+    return mounts
 
-class AIFFAudioFile(PCMAudioFile):
-    pass
+def deviceKind(dev, fsType, source):
+    '''Return 'network', 'rotational' or 'solid-state' for the device number
+    in an os.stat_result's st_dev'''
 
-class CompressedAudioFile(AudioFile):
-    pass
+    if fsType in NETWORK_FILESYSTEMS:
+        return 'network'
 
-class ALACAudioFile(CompressedAudioFile):
-    def decode(self):
-        if self.decodedAudioFile:
-            return self.decodedAudioFile
+    # btrfs and the like make up a device number of their own, so look at the
+    # disk they were mounted from instead
+    if os.major(dev) == 0 and source.startswith('/dev/'):
+        try:
+            dev = os.stat(source).st_rdev
+        except OSError:
+            pass
+
+    # A partition keeps its queue settings in the folder of its disk
+    block = '/sys/dev/block/' + str(os.major(dev)) + ':' + str(os.minor(dev))
+    rotational = readFirstLine(block + '/queue/rotational') or \
+                    readFirstLine(block + '/../queue/rotational')
+
+    return 'rotational' if rotational == '1' else 'solid-state'
+
+class StageRecord(object):
+    '''What one stage of one file cost: reading it ahead, reading its tags,
+    decoding it, encoding it with one setting, or writing the tags of one
+    output'''
+
+    FIELDS = ['path', 'stage', 'setting', 'ok', 'wallNs', 'userSeconds',
+                'systemSeconds', 'maxRssKiB', 'processes', 'bytesIn', 'bytesOut',
+                'tempBytes', 'device']
+
+    def __init__(self, path, stage, setting=None):
+        self.path           = path
+        self.stage          = stage     # read, tags, decode, encode or tag
+        self.setting        = setting   # Name of the EncoderSetting, if any
+        self.ok             = True
+        self.wallNs         = 0
+        self.userSeconds    = 0.0       # CPU time of the child processes
+        self.systemSeconds  = 0.0
+        self.maxRssKiB      = 0         # Largest child process
+        self.processes      = 0
+        self.bytesIn        = 0
+        self.bytesOut       = 0
+        self.tempBytes      = 0         # Written to TMPDIR
+        self.device         = None      # Where a read stage read from
+
+    def asList(self):
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def addProcess(self, rusage):
+        self.processes      += 1
+        if rusage is None:
+            return
 
-        outputPath = self.generateTempFileName(self.name + '.wav')
+        self.userSeconds    += rusage.ru_utime
+        self.systemSeconds  += rusage.ru_stime
+
+        # Linux reports KiB; Mac OS X reports bytes
+        maxRss = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            maxRss //= 1024
+        self.maxRssKiB = max(self.maxRssKiB, maxRss)
+
+def stageRecordFromList(values):
+    '''Turn what StageRecord.asList() returned back into a StageRecord'''
+
+    record = StageRecord(None, None)
+    for field, value in zip(StageRecord.FIELDS, values):
+        setattr(record, field, value)
+
+    return record
+
+class StageTotals(object):
+    FIELDS = ['count', 'failures', 'wallSeconds', 'userSeconds',
+                'systemSeconds', 'maxRssKiB', 'processes', 'bytesIn', 'bytesOut',
+                'tempBytes']
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, record):
+        self.count          += 1
+        self.failures       += 0 if record.ok else 1
+        self.wallSeconds    += record.wallNs / 1e9
+        self.userSeconds    += record.userSeconds
+        self.systemSeconds  += record.systemSeconds
+        self.maxRssKiB      = max(self.maxRssKiB, record.maxRssKiB)
+        self.processes      += record.processes
+        self.bytesIn        += record.bytesIn
+        self.bytesOut       += record.bytesOut
+        self.tempBytes      += record.tempBytes
+
+    def cpuSeconds(self):
+        return self.userSeconds + self.systemSeconds
+
+    def asDict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+class Stats(object):
+    '''Collect a StageRecord for every stage of every file. A thread that is
+    inside stage() has a current record, which picks up the resource usage of
+    every process the thread runs unless a process is given its own.'''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.records    = []
+        self.local      = threading.local()
+
+    def current(self):
+        return getattr(self.local, 'record', None)
+
+    @contextlib.contextmanager
+    def stage(self, path, stage, setting=None, optional=False):
+        '''Time the body and record it. An optional stage that didn't run
+        any processes isn't recorded.'''
+
+        record = StageRecord(path, stage, setting)
+        previous = self.current()
+        self.local.record = record
+        startTime = time.perf_counter_ns()
 
-        # TODO: Hmm... we're assuming 16 bits per sample. Is this a good idea?
-        exitCode = runProcess(AFCONVERT + ' -f WAVE -d LEI16 "' + escape(self.path) + '" "' + escape(outputPath) + '"')
-        if exitCode == 0:
-            decodedAudioFile = WaveAudioFile(outputPath)
-            decodedAudioFile.tags = self.tags
-            self.decodedAudioFile = decodedAudioFile
-            return decodedAudioFile
+        try:
+            yield record
+        finally:
+            record.wallNs = time.perf_counter_ns() - startTime
+            self.local.record = previous
+            if record.processes or not optional:
+                self.add(record)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+        progress.add(record)
+
+    def totals(self, key):
+        '''Return a dict of StageTotals, grouped by key(record)'''
+
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                k = key(record)
+                if k is not None:
+                    totals.setdefault(k, StageTotals()).add(record)
+
+        return totals
+
+    def summary(self, wallSeconds, slots):
+        for name, t in sorted(self.totals(lambda r: r.setting).items()):
+            msg(name + ': ' + '{:.1f}'.format(t.cpuSeconds()) + 's CPU in ' +
+                '{:.1f}'.format(t.wallSeconds) + 's, ' + formatBytes(t.bytesIn) +
+                ' in, ' + formatBytes(t.bytesOut) + ' out')
+
+        # Reads from one device overlap only as far as its readers allow, so
+        # on a capped disk this is its actual throughput
+        for name, t in sorted(self.totals(lambda r: r.device).items()):
+            msg('Read ' + formatBytes(t.bytesIn) + ' from ' + name + ' in ' +
+                '{:.1f}'.format(t.wallSeconds) + 's, ' +
+                formatBytes(t.bytesIn / max(t.wallSeconds, 1e-9)) + '/s per reader')
+
+        everything = self.totals(lambda r: 'all').get('all')
+        if everything and wallSeconds > 0:
+            # Near 100% means piggy was CPU-bound. Much lower means the
+            # processes spent their time waiting on the disks.
+            busy = everything.cpuSeconds() / (wallSeconds * slots)
+            msg('Child processes used ' + '{:.1f}'.format(everything.cpuSeconds()) +
+                's of CPU time, ' + '{:.0%}'.format(busy) + ' of ' + str(slots) +
+                ' slots')
+
+    def writeReport(self, path, wallSeconds, slots, scan, failures, shard=None):
+        stages = self.totals(lambda r: r.stage)
+        settings = self.totals(lambda r: r.setting)
+        devices = self.totals(lambda r: r.device)
+        files = self.totals(lambda r: r.path)
+
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'key'] + StageTotals.FIELDS)
+                for kind, totals in [('stage', stages), ('setting', settings),
+                                    ('device', devices), ('file', files)]:
+                    for key, t in sorted(totals.items()):
+                        writer.writerow([kind, key] + [getattr(t, field)
+                                            for field in StageTotals.FIELDS])
+                for failure in failures:
+                    writer.writerow(['failure', failure])
         else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+            report = {
+                'wallSeconds':  wallSeconds,
+                'slots':        slots,
+                'shard':        list(shard) if shard else None,
+                'failures':     failures,
+                'scan':         {'files': scan.count, 'skipped': scan.skipped,
+                                    'seconds': scan.seconds},
+                'stages':       dict((k, t.asDict()) for k, t in stages.items()),
+                'settings':     dict((k, t.asDict()) for k, t in settings.items()),
+                'devices':      dict((k, t.asDict()) for k, t in devices.items()),
+                'files':        dict((k, t.asDict()) for k, t in files.items()),
+            }
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+stats = Stats()     # Shared by every thread
+
+class Process(object):
+    '''A child process run straight from an argv list, with no shell in
+    between. stdin and stdout may be file descriptors to hook up to the
+    child; otherwise it inherits ours.'''
+
+    def __init__(self, argv, stdin=None, stdout=None, record=None):
+        if __debug__:
+            progress.write(CYAN + '> ' + ' '.join(shlex.quote(a) for a in argv) +
+                            ' ' + NOCOLOR)
+
+        self.argv = argv
+        self.pid = None
+        self.record = record or stats.current()     # Where the rusage goes
+        self.startTime = time.perf_counter_ns()
+        self.elapsedNs = 0
 
-    def loadTags(self):
-        tags = subprocess.getoutput(ATOMICPARSELEY + ' "' + escape(self.path) + '" -t')
+        try:
+            if hasattr(os, 'posix_spawnp'):
+                fileActions = []
+                if stdin is not None:
+                    fileActions.append((os.POSIX_SPAWN_DUP2, stdin, 0))
+                if stdout is not None:
+                    fileActions.append((os.POSIX_SPAWN_DUP2, stdout, 1))
+
+                # Python ignores SIGPIPE, and children would inherit that. A
+                # decoder whose encoder died should die too.
+                self.pid = os.posix_spawnp(argv[0], argv, os.environ,
+                                file_actions=fileActions,
+                                setsigdef=[signal.SIGPIPE])
+            else:
+                self.pid = subprocess.Popen(argv, stdin=stdin, stdout=stdout).pid
+        except OSError as e:
+            err('Could not run ' + argv[0] + ': ' + e.strerror)
 
-        ar = re.compile('Atom "©ART" contains: (.+)', re.IGNORECASE)
-        al = re.compile('Atom "©alb" contains: (.+)', re.IGNORECASE)
-        ti = re.compile('Atom "©nam" contains: (.+)', re.IGNORECASE)
-        tr = re.compile('Atom "trkn" contains: (.+)', re.IGNORECASE)
-        yr = re.compile('Atom "©day" contains: (\d+)', re.IGNORECASE)
-#        cm = re.compile('Atom "©cmt" contains: (.+)', re.IGNORECASE)
+    def wait(self):
+        if self.pid is None:
+            return EXIT_NOTFOUND
 
-        for line in tags.splitlines():
-            m = ar.match(line)
-            if m:
-                self.tags['artist'] = m.group(1)
+        pid, status, rusage = os.wait4(self.pid, 0)
+        self.elapsedNs = time.perf_counter_ns() - self.startTime
 
-            m = al.match(line)
-            if m:
-                self.tags['album'] = m.group(1)
+        if self.record:
+            self.record.addProcess(rusage)
 
-            m = ti.match(line)
-            if m:
-                self.tags['title'] = m.group(1)
+        return os.waitstatus_to_exitcode(status)
 
-            m = tr.match(line)
-            if m:
-                self.tags['track'] = m.group(1)
+def startProcess(argv, stdin=None, stdout=None, record=None):
+    return Process(argv, stdin, stdout, record)
 
-            m = yr.match(line)
-            if m:
-                self.tags['year'] = m.group(1)
+def runProcess(argv):
+    return startProcess(argv).wait()
 
-#            m = cm.match(line)
-#            if m:
-#                self.tags['comment'] = m.group(1)
+def captureOutput(argv):
+    '''Run a command and return what it wrote to stdout'''
 
-class XiphAudioFile(CompressedAudioFile):
-    def xiphLoadTags(self, tool):
-        tags = subprocess.getoutput(tool)
+    readEnd, writeEnd = os.pipe()
+    p = startProcess(argv, stdout=writeEnd)
+    os.close(writeEnd)
 
-        ar = re.compile('ARTIST=(.+)', re.IGNORECASE)
-        al = re.compile('ALBUM=(.+)', re.IGNORECASE)
-        ti = re.compile('TITLE=(.+)', re.IGNORECASE)
-        tr = re.compile('TRACKNUMBER=(.*)', re.IGNORECASE)
-        yr = re.compile('DATE=(.*)', re.IGNORECASE)
-        cm = re.compile('COMMENT=(.*)', re.IGNORECASE)
+    chunks = []
+    while True:
+        chunk = os.read(readEnd, TEE_BUFFER_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
 
-        for line in tags.splitlines():
-            m = ar.match(line)
-            if m:
-                self.tags['artist'] = m.group(1)
+    os.close(readEnd)
+    p.wait()
 
-            m = al.match(line)
-            if m:
-                self.tags['album'] = m.group(1)
+    return b''.join(chunks).decode('utf-8', 'replace')
 
-            m = ti.match(line)
-            if m:
-                self.tags['title'] = m.group(1)
+def writeAll(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
 
-            m = tr.match(line)
-            if m:
-                self.tags['track'] = m.group(1)
+def tee(source, sinks):
+    '''Copy everything that can be read from the source pipe into every one
+    of the sink pipes, then close them all. A sink whose reader has gone away
+    is dropped and the copying goes on for the others. Return the number of
+    bytes read.'''
 
-            m = yr.match(line)
-            if m:
-                self.tags['year'] = m.group(1)
+    sinks = list(sinks)
+    total = 0
 
-            m = cm.match(line)
-            if m:
-                self.tags['comment'] = m.group(1)
+    while sinks:
+        chunk = os.read(source, TEE_BUFFER_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
 
-class FLACAudioFile(XiphAudioFile):
-    def decode(self):
-        if self.decodedAudioFile:
-            return self.decodedAudioFile
+        for sink in list(sinks):
+            try:
+                writeAll(sink, chunk)
+            except BrokenPipeError:
+                sinks.remove(sink)
+                os.close(sink)
+
+    os.close(source)
+    for sink in sinks:
+        os.close(sink)
+
+    return total
+
+class ProcessSlots(object):
+    '''Limit the number of child processes that run at the same time. A
+    worker that fans out to several encoders asks for all of its slots at
+    once, so two workers can never deadlock holding half of what they need.
+
+    The limit can move between 1 and size while piggy runs. A request for
+    more than the limit still gets through once nothing else is running.'''
+
+    def __init__(self, size):
+        self.size       = size      # The most processes there can ever be
+        self.limit      = size      # The most processes there may be right now
+        self.used       = 0
+        self.condition  = threading.Condition()
+        self.turnstile  = threading.Lock()  # Keeps small requests from starving big ones
+
+    def acquire(self, n=1):
+        assert 1 <= n <= self.size
+
+        with self.turnstile:
+            with self.condition:
+                while self.used > 0 and self.used + n > self.limit:
+                    self.condition.wait()
+                self.used += n
+
+    def release(self, n=1):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = max(1, min(self.size, limit))
+            self.condition.notify_all()
+
+class Governor(object):
+    '''Move the limit of the process slots between a minimum and a maximum
+    as piggy runs. If the children keep their CPUs busy, or are fighting over
+    them, the limit shrinks. If they spend their time waiting, presumably on
+    the disks or the network, it grows, unless the disks are saturated.'''
+
+    def __init__(self, slots, minimum, maximum, resize=None):
+        self.slots      = slots
+        self.minimum    = minimum
+        self.maximum    = maximum
+        self.resize     = resize or slots.resize
+        self.stopped    = threading.Event()
+        self.thread     = threading.Thread(target=self.run, daemon=True)
 
-        outputPath = self.generateTempFileName(self.name + '.wav')
+    def start(self):
+        self.thread.start()
 
-        exitCode = runProcess(FLAC + ' --silent --decode -o "' + escape(outputPath) + '" "' + escape(self.path) + '"')
-        if exitCode == 0:
-            decodedAudioFile = WaveAudioFile(outputPath)
-            decodedAudioFile.tags = self.tags
-            self.decodedAudioFile = decodedAudioFile
-            return decodedAudioFile
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def childCPUSeconds(self):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def decide(self, limit, busy, cpuPressure, ioPressure, ioWait):
+        '''Return the next limit'''
+
+        if cpuPressure is not None and cpuPressure > CPU_PRESSURE_HIGH:
+            return limit - 1
+        elif (ioPressure is not None and ioPressure > IO_PRESSURE_HIGH) or \
+                (ioWait is not None and ioWait > IO_PRESSURE_HIGH):
+            return limit - 1
+        elif busy < CHILD_BUSY_LOW:
+            return limit + 1
         else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+            return limit
+
+    def run(self):
+        lastCPU = self.childCPUSeconds()
+        lastTimes = readCPUTimes()
+        lastTime = time.monotonic()
+
+        while not self.stopped.wait(GOVERNOR_INTERVAL):
+            now = time.monotonic()
+            cpu = self.childCPUSeconds()
+            times = readCPUTimes()
+            limit = self.slots.limit
+
+            busy = (cpu - lastCPU) / ((now - lastTime) * limit)
+            cpuPressure = readPressure('cpu')[0]
+            ioPressure = readPressure('io')[1]
+
+            ioWait = None
+            if times and lastTimes and times[1] > lastTimes[1]:
+                ioWait = (times[0] - lastTimes[0]) / (times[1] - lastTimes[1])
+
+            newLimit = max(self.minimum, min(self.maximum,
+                            self.decide(limit, busy, cpuPressure, ioPressure, ioWait)))
+            if newLimit != limit:
+                dbg('Running ' + str(newLimit) + ' processes at once (children ' +
+                    '{:.0%}'.format(busy) + ' busy)')
+                self.resize(newLimit)
+
+            lastCPU, lastTimes, lastTime = cpu, times, now
+
+class AsyncProcess(object):
+    '''Process, for the asyncio engine. asyncio reaps its own children, so
+    only the wall time of the child goes into the record, not its rusage.'''
+
+    def __init__(self, argv, record=None):
+        if __debug__:
+            progress.write(CYAN + '> ' + ' '.join(shlex.quote(a) for a in argv) +
+                            ' ' + NOCOLOR)
+
+        self.argv = argv
+        self.process = None
+        self.record = record
+        self.startTime = time.perf_counter_ns()
+        self.elapsedNs = 0
+
+    async def start(self, stdin=None, stdout=None):
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.argv,
+                                    stdin=stdin, stdout=stdout)
+        except OSError as e:
+            err('Could not run ' + self.argv[0] + ': ' + e.strerror)
 
-    def loadTags(self):
-        self.xiphLoadTags(METAFLAC + ' --export-tags-to=- "' + escape(self.path) + '"')
+        return self
 
-class VorbisAudioFile(XiphAudioFile):
-    def decode(self):
-        if self.decodedAudioFile:
-            return self.decodedAudioFile
+    async def wait(self):
+        if self.process is None:
+            return EXIT_NOTFOUND
 
-        outputPath = self.generateTempFileName(self.name + '.wav')
+        exitCode = await self.process.wait()
+        self.elapsedNs = time.perf_counter_ns() - self.startTime
 
-        exitCode = runProcess(OGGDEC + ' --quiet -o "' + escape(outputPath) + '" "' + escape(self.path) + '"')
-        if exitCode == 0:
-            decodedAudioFile = WaveAudioFile(outputPath)
-            decodedAudioFile.tags = self.tags
-            self.decodedAudioFile = decodedAudioFile
-            return decodedAudioFile
-        else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+        if self.record:
+            self.record.addProcess(None)
 
-    def loadTags(self):
-        self.xiphLoadTags(VORBISCOMMENT + ' --list "' + escape(self.path) + '"')
+        # Like os.waitstatus_to_exitcode(), death by signal N is -N
+        return exitCode
 
-class MP3AudioFile(CompressedAudioFile):
-    def decode(self):
-        if self.decodedAudioFile:
-            return self.decodedAudioFile
+async def startProcessAsync(argv, stdin=None, stdout=None, record=None):
+    return await AsyncProcess(argv, record).start(stdin, stdout)
 
-        outputPath = self.generateTempFileName(self.name + '.wav')
+async def teeAsync(source, sinks):
+    '''tee(), for the asyncio engine. source is a StreamReader and the sinks
+    are StreamWriters.'''
 
-        exitCode = runProcess(MADPLAY + ' --quiet -o "' + escape(outputPath) + '" "' + escape(self.path) + '"')
-        if exitCode == 0:
-            decodedAudioFile = WaveAudioFile(outputPath)
-            decodedAudioFile.tags = self.tags
-            self.decodedAudioFile = decodedAudioFile
-            return decodedAudioFile
-        else:
+    sinks = list(sinks)
+    total = 0
+
+    while sinks:
+        chunk = await source.read(TEE_BUFFER_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+
+        for sink in list(sinks):
             try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
+                sink.write(chunk)
+                await sink.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                sinks.remove(sink)
+                sink.close()
+
+    for sink in sinks:
+        sink.close()
+
+    return total
+
+class AsyncProcessSlots(object):
+    '''ProcessSlots, for coroutines'''
+
+    def __init__(self, size, limit):
+        self.size       = size
+        self.limit      = limit
+        self.used       = 0
+        self.condition  = asyncio.Condition()
+        self.turnstile  = asyncio.Lock()
+
+    async def acquire(self, n=1):
+        assert 1 <= n <= self.size
+
+        async with self.turnstile:
+            async with self.condition:
+                await self.condition.wait_for(
+                            lambda: self.used == 0 or self.used + n <= self.limit)
+                self.used += n
+
+    async def release(self, n=1):
+        async with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+    async def resize(self, limit):
+        async with self.condition:
+            self.limit = max(1, min(self.size, limit))
+            self.condition.notify_all()
+
+def wakeFuture(future):
+    if not future.done():
+        future.set_result(None)
+
+class AsyncWaiters(object):
+    '''Coroutines waiting for something that a thread may bring about. Check
+    for it and add() a waiter under the lock that guards it, await the
+    waiter outside the lock, and wake() them all whenever it may have
+    happened. Nothing waits in an executor thread that way.'''
+
+    def __init__(self):
+        self.futures    = []        # (loop, future)
+
+    def add(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.futures.append((loop, future))
+        return future
+
+    def wake(self):
+        for loop, future in self.futures:
+            loop.call_soon_threadsafe(wakeFuture, future)
+        self.futures = []
+
+class AsyncQueueFeeder(object):
+    '''Let a thread put() into an asyncio.Queue, blocking while it's full'''
+
+    def __init__(self, queue, loop):
+        self.queue      = queue
+        self.loop       = loop
+
+    def put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+def deleteFile(s):
+    dbg('Deleting ' + s)
+    os.remove(s)
+
+# ------------------------------------------------------------------------------
+
+# Tag readers that parse the file headers directly instead of running a tool
+# for every file. Each returns a tags dict like AudioFile.tags, or None if the
+# file doesn't look like what it's supposed to be. In that case the caller
+# falls back to the external tool.
+
+VORBIS_COMMENT_FIELDS = {
+    'ARTIST':       'artist',
+    'ALBUM':        'album',
+    'TITLE':        'title',
+    'TRACKNUMBER':  'track',
+    'DATE':         'year',
+    'COMMENT':      'comment',
+}
+
+ID3_FRAMES = {
+    # ID3v2.3 and ID3v2.4
+    'TPE1': 'artist',   'TALB': 'album',    'TIT2': 'title',
+    'TRCK': 'track',    'TYER': 'year',     'TDRC': 'year',
+    'COMM': 'comment',
+    # ID3v2.2
+    'TP1':  'artist',   'TAL':  'album',    'TT2':  'title',
+    'TRK':  'track',    'TYE':  'year',     'COM':  'comment',
+}
+
+MP4_ATOMS = {
+    b'\xa9ART':     'artist',
+    b'\xa9alb':     'album',
+    b'\xa9nam':     'title',
+    b'trkn':        'track',
+    b'\xa9day':     'year',
+    b'\xa9cmt':     'comment',
+}
+
+ID3_ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+def syncsafe(b):
+    n = 0
+    for byte in b:
+        n = (n << 7) | (byte & 0x7f)
+    return n
+
+def parseVorbisComment(data):
+    # Vorbis comments are little-endian, unlike the FLAC metadata around them
+    tags = {}
+
+    try:
+        vendorLength, = struct.unpack_from('<I', data, 0)
+        pos = 4 + vendorLength
+        count, = struct.unpack_from('<I', data, pos)
+        pos += 4
+
+        for i in range(count):
+            length, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            comment = data[pos:pos + length].decode('utf-8', 'replace')
+            pos += length
+
+            field, _, value = comment.partition('=')
+            key = VORBIS_COMMENT_FIELDS.get(field.upper())
+            if key:
+                tags[key] = value
+    except struct.error:
+        return None
+
+    return tags
+
+def skipID3v2(f):
+    '''Seek past an ID3v2 tag at the current position, if there is one'''
+
+    start = f.tell()
+    header = f.read(10)
+
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = syncsafe(header[6:10])
+        if header[5] & 0x10:
+            size += 10      # Footer
+        f.seek(start + 10 + size)
+    else:
+        f.seek(start)
+
+def readFLACTags(path):
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            if f.read(4) != b'fLaC':
+                return None
+
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    return None
+
+                last = header[0] & 0x80
+                blockType = header[0] & 0x7f
+                length = int.from_bytes(header[1:4], 'big')
+
+                if blockType == 4:      # VORBIS_COMMENT
+                    return parseVorbisComment(f.read(length))
+                elif last:
+                    return {}
+
+                f.seek(length, os.SEEK_CUR)
+    except OSError:
+        return None
+
+def readOggPackets(f, count):
+    '''Return the first count packets of the first logical stream in an Ogg
+    file, or None if the file ends early or isn't an Ogg file'''
+
+    packets = []
+    packet  = b''
+    serial  = None
+
+    while len(packets) < count:
+        header = f.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
             return None
 
-    def loadTags(self):
-        tags = subprocess.getoutput(MADPLAY + ' --show-tags-only "' + escape(self.path) + '"')
+        pageSerial, = struct.unpack_from('<I', header, 14)
+        lacing = f.read(header[26])
+        data = f.read(sum(lacing))
 
-        ar = re.compile('\s*artist: (.+)', re.IGNORECASE)
-        al = re.compile('\s*album: (.+)', re.IGNORECASE)
-        ti = re.compile('\s*title: (.+)', re.IGNORECASE)
-        tr = re.compile('\s*track: (.*)', re.IGNORECASE)
-        yr = re.compile('\s*year: (.*)', re.IGNORECASE)
-#        cm = re.compile('comment: (.*)', re.IGNORECASE)
+        # Skip pages from other multiplexed streams
+        if serial is None:
+            serial = pageSerial
+        elif pageSerial != serial:
+            continue
 
-        for line in tags.splitlines():
-            m = ar.match(line)
-            if m:
-                self.tags['artist'] = m.group(1)
+        pos = 0
+        for length in lacing:
+            packet += data[pos:pos + length]
+            pos += length
+            if length < 255:
+                packets.append(packet)
+                packet = b''
 
-            m = al.match(line)
-            if m:
-                self.tags['album'] = m.group(1)
+    return packets[:count]
 
-            m = ti.match(line)
-            if m:
-                self.tags['title'] = m.group(1)
+def readOggTags(path):
+    try:
+        with open(path, 'rb') as f:
+            packets = readOggPackets(f, 2)
+    except OSError:
+        return None
+
+    # The second packet of a Vorbis stream is the comment header
+    if packets is None or packets[1][:7] != b'\x03vorbis':
+        return None
+
+    return parseVorbisComment(packets[1][7:])
+
+def decodeID3Text(encoding, data):
+    if encoding >= len(ID3_ENCODINGS):
+        return ''
+
+    if encoding in (1, 2):
+        # Find a NUL that's aligned to a character
+        end = 0
+        while end + 1 < len(data) and data[end:end + 2] != b'\x00\x00':
+            end += 2
+        data = data[:end]
+    else:
+        data = data.split(b'\x00', 1)[0]
 
-            m = tr.match(line)
-            if m:
-                self.tags['track'] = m.group(1)
+    return data.decode(ID3_ENCODINGS[encoding], 'replace')
 
-            m = yr.match(line)
-            if m:
-                self.tags['year'] = m.group(1)
+def parseID3Comment(body):
+    # COMM: encoding, three-letter language, description, text
+    encoding = body[0]
+    text = body[4:]
 
-#            m = cm.match(line)
-#            if m:
-#                self.tags['comment'] = m.group(1)
+    if encoding in (1, 2):
+        end = 0
+        while end + 1 < len(text) and text[end:end + 2] != b'\x00\x00':
+            end += 2
+        description = text[:end]
+        text = text[end + 2:]
+    else:
+        description, _, text = text.partition(b'\x00')
 
-class MP4AudioFile(CompressedAudioFile):
-    def decode(self):
-        if self.decodedAudioFile:
-            return self.decodedAudioFile
+    # Comments with a description are usually iTunes junk like iTunNORM. An
+    # empty UTF-16 description may still have its byte order mark.
+    if decodeID3Text(encoding, description + b'\x00\x00').strip('\ufeff'):
+        return None
 
-        outputPath = self.generateTempFileName(self.name + '.wav')
+    return decodeID3Text(encoding, text)
 
-        exitCode = runProcess(FAAD + ' --quiet -o "' + escape(outputPath) + '" "' + escape(self.path) + '"')
-        if exitCode == 0:
-            decodedAudioFile = WaveAudioFile(outputPath)
-            decodedAudioFile.tags = self.tags
-            self.decodedAudioFile = decodedAudioFile
-            return decodedAudioFile
+def readID3v2Tags(f):
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (2, 3, 4):
+        return {}
+
+    version = header[3]
+    flags = header[5]
+    data = f.read(syncsafe(header[6:10]))
+
+    # Before ID3v2.4, unsynchronisation applies to the whole tag
+    if flags & 0x80 and version < 4:
+        data = data.replace(b'\xff\x00', b'\xff')
+
+    pos = 0
+    if flags & 0x40 and version == 3:
+        pos = 4 + int.from_bytes(data[0:4], 'big')
+    elif flags & 0x40 and version == 4:
+        pos = syncsafe(data[0:4])
+
+    if version == 2:
+        idLength, headerLength = 3, 6
+    else:
+        idLength, headerLength = 4, 10
+
+    tags = {}
+    while pos + headerLength <= len(data):
+        frameId = data[pos:pos + idLength]
+        if frameId[0] == 0:
+            break   # Padding
+
+        if version == 2:
+            size = int.from_bytes(data[pos + 3:pos + 6], 'big')
+        elif version == 3:
+            size = int.from_bytes(data[pos + 4:pos + 8], 'big')
         else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+            size = syncsafe(data[pos + 4:pos + 8])
+
+        body = data[pos + headerLength:pos + headerLength + size]
+        pos += headerLength + size
+
+        if version > 2:
+            formatFlags = data[pos - size - 1]
+            if version == 3 and formatFlags & 0xc0:
+                continue    # Compressed or encrypted
+            if version == 4:
+                if formatFlags & 0x0c:
+                    continue
+                if formatFlags & 0x02:
+                    body = body.replace(b'\xff\x00', b'\xff')
+                if formatFlags & 0x01:
+                    body = body[4:]     # Data length indicator
+
+        key = ID3_FRAMES.get(frameId.decode('latin-1'))
+        if not key or key in tags or not body:
+            continue
+
+        if key == 'comment':
+            value = parseID3Comment(body)
+        else:
+            value = decodeID3Text(body[0], body[1:])
+
+        if value:
+            if frameId == b'TDRC':
+                value = value[:4]
+            tags[key] = value
+
+    return tags
+
+def readID3v1Tags(f):
+    try:
+        f.seek(-128, os.SEEK_END)
+    except OSError:
+        return {}
+
+    data = f.read(128)
+    if data[:3] != b'TAG':
+        return {}
+
+    def field(start, end):
+        return data[start:end].split(b'\x00', 1)[0].decode('latin-1').strip()
+
+    tags = {}
+    for key, start, end in [('title', 3, 33), ('artist', 33, 63),
+                            ('album', 63, 93), ('year', 93, 97)]:
+        if field(start, end):
+            tags[key] = field(start, end)
+
+    # ID3v1.1 squeezes the track number into the end of the comment
+    if data[125] == 0 and data[126] != 0:
+        tags['track'] = str(data[126])
+        if field(97, 125):
+            tags['comment'] = field(97, 125)
+    elif field(97, 127):
+        tags['comment'] = field(97, 127)
+
+    return tags
+
+def readMP3Tags(path):
+    try:
+        with open(path, 'rb') as f:
+            tags = readID3v1Tags(f)
+            f.seek(0)
+            tags.update(readID3v2Tags(f))
+    except OSError:
+        return None
+
+    return tags
+
+def mp4Boxes(f, start, end):
+    '''Yield (type, data start, data end) for every MP4 box between start and
+    end, without reading their contents'''
+
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        size, boxType = struct.unpack('>I4s', header)
+        headerSize = 8
+        if size == 1:
+            size, = struct.unpack('>Q', f.read(8))
+            headerSize = 16
+        elif size == 0:
+            size = end - pos    # Extends to the end of the file
+
+        if size < headerSize:
+            return
+
+        yield boxType, pos + headerSize, min(pos + size, end)
+        pos += size
+
+def findMP4Box(f, path, start, end):
+    '''Return (data start, data end) of the box at path, a list of box
+    types, or None if there is no such box'''
+
+    for boxType, dataStart, dataEnd in mp4Boxes(f, start, end):
+        if boxType == path[0]:
+            # meta is a full box with four bytes of version and flags
+            if boxType == b'meta':
+                dataStart += 4
+
+            if len(path) == 1:
+                return dataStart, dataEnd
+            else:
+                return findMP4Box(f, path[1:], dataStart, dataEnd)
+
+    return None
+
+def readMP4Tags(path):
+    try:
+        with open(path, 'rb') as f:
+            fileSize = os.fstat(f.fileno()).st_size
+
+            if f.read(8)[4:8] != b'ftyp':
+                return None
+
+            ilst = findMP4Box(f, [b'moov', b'udta', b'meta', b'ilst'], 0, fileSize)
+            if ilst is None:
+                return {}
+
+            tags = {}
+            for atom, start, end in list(mp4Boxes(f, *ilst)):
+                key = MP4_ATOMS.get(atom)
+                data = findMP4Box(f, [b'data'], start, end)
+                if not key or not data:
+                    continue
+
+                f.seek(data[0])
+                value = f.read(data[1] - data[0])[8:]   # Skip type and locale
+
+                if atom == b'trkn':
+                    if len(value) < 6:
+                        continue
+                    track, total = struct.unpack_from('>HH', value, 2)
+                    tags[key] = str(track) if not total else str(track) + '/' + str(total)
+                else:
+                    tags[key] = value.decode('utf-8', 'replace')
+                    if atom == b'\xa9day':
+                        tags[key] = re.match('\\d*', tags[key]).group(0)
+    except (OSError, struct.error):
+        return None
+
+    return tags
+
+# ------------------------------------------------------------------------------
+
+# Stream info readers. Like the tag readers above, they only look at the file
+# headers. Each returns a dict with the keys in STREAM_INFO_KEYS, any of which
+# may be None if the format doesn't say, or None if the file can't be parsed.
+
+STREAM_INFO_KEYS = ['codec', 'sampleRate', 'channels', 'bitsPerSample', 'duration']
+
+MP3_BITRATES = {
+    # (MPEG-1?, layer) -> kbit/s by index
+    (True,  1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True,  2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True,  3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def streamInfo(codec, sampleRate=None, channels=None, bitsPerSample=None,
+                duration=None):
+    return {
+        'codec':            codec,
+        'sampleRate':       sampleRate,
+        'channels':         channels,
+        'bitsPerSample':    bitsPerSample,
+        'duration':         duration,
+    }
+
+def readFLACStreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            if f.read(4) != b'fLaC':
+                return None
+
+            header = f.read(4)
+            if len(header) < 4 or header[0] & 0x7f != 0:   # STREAMINFO comes first
+                return None
+
+            data = f.read(34)
+            if len(data) < 34:
+                return None
+    except OSError:
+        return None
+
+    bits = int.from_bytes(data[10:18], 'big')
+    sampleRate      = bits >> 44
+    channels        = ((bits >> 41) & 0x7) + 1
+    bitsPerSample   = ((bits >> 36) & 0x1f) + 1
+    totalSamples    = bits & 0xfffffffff
+
+    duration = totalSamples / sampleRate if sampleRate and totalSamples else None
+    return streamInfo('flac', sampleRate, channels, bitsPerSample, duration)
+
+def readOggStreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            packets = readOggPackets(f, 1)
+            if packets is None or packets[0][:7] != b'\x01vorbis' or len(packets[0]) < 16:
+                return None
+
+            channels = packets[0][11]
+            sampleRate, = struct.unpack_from('<I', packets[0], 12)
+
+            # The granule position of the last page is the number of samples
+            fileSize = os.fstat(f.fileno()).st_size
+            f.seek(max(0, fileSize - 65536))
+            tail = f.read()
+    except OSError:
+        return None
+
+    duration = None
+    last = tail.rfind(b'OggS')
+    if last >= 0 and last + 14 <= len(tail) and sampleRate:
+        granule, = struct.unpack_from('<q', tail, last + 6)
+        if granule > 0:
+            duration = granule / sampleRate
+
+    return streamInfo('vorbis', sampleRate, channels, None, duration)
+
+def readWaveStreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(12)
+            if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+                return None
+
+            info = streamInfo('pcm')
+            dataSize = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    break
+
+                chunkId, size = struct.unpack('<4sI', chunk)
+                if chunkId == b'fmt ':
+                    fmt = f.read(size)
+                    info['channels'], info['sampleRate'] = struct.unpack_from('<HI', fmt, 2)
+                    info['bitsPerSample'], = struct.unpack_from('<H', fmt, 14)
+                    f.seek(size % 2, os.SEEK_CUR)
+                elif chunkId == b'data':
+                    # Streamed WAVE files have bogus sizes here
+                    fileSize = os.fstat(f.fileno()).st_size
+                    dataSize = min(size, fileSize - f.tell())
+                    break
+                else:
+                    f.seek(size + size % 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+    if dataSize is not None and info['sampleRate'] and info['channels'] and info['bitsPerSample']:
+        frameSize = info['channels'] * ((info['bitsPerSample'] + 7) // 8)
+        info['duration'] = dataSize / frameSize / info['sampleRate']
+
+    return info
+
+def readAIFFStreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(12)
+            if header[:4] != b'FORM' or header[8:12] not in (b'AIFF', b'AIFC'):
+                return None
+
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    return None
+
+                chunkId, size = struct.unpack('>4sI', chunk)
+                if chunkId == b'COMM':
+                    comm = f.read(size)
+                    break
+
+                f.seek(size + size % 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+    if len(comm) < 18:
+        return None
+
+    channels, frames, bitsPerSample = struct.unpack_from('>HIH', comm, 0)
+
+    # The sample rate is an 80-bit IEEE 754 extended precision float
+    exponent, mantissa = struct.unpack_from('>HQ', comm, 8)
+    sampleRate = int(mantissa * 2.0 ** ((exponent & 0x7fff) - 16383 - 63))
+
+    duration = frames / sampleRate if sampleRate else None
+    return streamInfo('pcm', sampleRate, channels, bitsPerSample, duration)
+
+def readMP3StreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            start = f.tell()
+            data = f.read(65536)
+            fileSize = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None
+
+    # Find the first frame header
+    pos = 0
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 4 > len(data):
+            return None
+
+        header, = struct.unpack_from('>I', data, pos)
+        version     = (header >> 19) & 0x3      # 3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+        layer       = 4 - ((header >> 17) & 0x3)
+        bitrateIdx  = (header >> 12) & 0xf
+        rateIdx     = (header >> 10) & 0x3
+
+        if (header >> 21) & 0x7ff == 0x7ff and version != 1 and layer != 4 and \
+                bitrateIdx not in (0, 15) and rateIdx != 3:
+            break
+        pos += 1
+
+    mpeg1 = version == 3
+    sampleRate = MP3_SAMPLE_RATES[version][rateIdx]
+    channels = 1 if (header >> 6) & 0x3 == 3 else 2
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrateIdx] * 1000
+
+    if layer == 1:
+        samplesPerFrame = 384
+    elif layer == 3 and not mpeg1:
+        samplesPerFrame = 576
+    else:
+        samplesPerFrame = 1152
+
+    # VBR files carry the frame count in a Xing/Info or VBRI header inside the
+    # first frame
+    frames = None
+    if mpeg1:
+        xing = pos + 4 + (32 if channels == 2 else 17)
+    else:
+        xing = pos + 4 + (17 if channels == 2 else 9)
+
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags, = struct.unpack_from('>I', data, xing + 4)
+        if flags & 0x1:
+            frames, = struct.unpack_from('>I', data, xing + 8)
+    elif data[pos + 36:pos + 40] == b'VBRI':
+        frames, = struct.unpack_from('>I', data, pos + 50)
+
+    if frames:
+        duration = frames * samplesPerFrame / sampleRate
+    else:
+        duration = (fileSize - start - pos) * 8 / bitrate
+
+    return streamInfo('mp3', sampleRate, channels, None, duration)
+
+def readMP4StreamInfo(path):
+    try:
+        with open(path, 'rb') as f:
+            fileSize = os.fstat(f.fileno()).st_size
+
+            if f.read(8)[4:8] != b'ftyp':
+                return None
+
+            moov = findMP4Box(f, [b'moov'], 0, fileSize)
+            if moov is None:
+                return None
+
+            for boxType, start, end in list(mp4Boxes(f, *moov)):
+                if boxType != b'trak':
+                    continue
+
+                mdhd = findMP4Box(f, [b'mdia', b'mdhd'], start, end)
+                stsd = findMP4Box(f, [b'mdia', b'minf', b'stbl', b'stsd'], start, end)
+                if mdhd is None or stsd is None:
+                    continue
+
+                f.seek(mdhd[0])
+                data = f.read(32)
+                if data[0] == 1:
+                    timescale, duration = struct.unpack_from('>IQ', data, 20)
+                else:
+                    timescale, duration = struct.unpack_from('>II', data, 12)
+
+                # Full box header and entry count, then the first sample entry
+                f.seek(stsd[0] + 8)
+                entry = f.read(36)
+                if len(entry) < 36:
+                    continue
+
+                format = entry[4:8]
+                if format == b'mp4a':
+                    codec = 'aac'
+                elif format == b'alac':
+                    codec = 'alac'
+                else:
+                    continue    # Not an audio track
+
+                channels, bitsPerSample = struct.unpack_from('>HH', entry, 24)
+                sampleRate = struct.unpack_from('>I', entry, 32)[0] >> 16
+
+                if codec == 'aac':
+                    bitsPerSample = None
+
+                return streamInfo(codec, sampleRate, channels, bitsPerSample,
+                                    duration / timescale if timescale else None)
+    except (OSError, struct.error):
+        return None
+
+    return None
+
+def isMPEGAudioHeader(header):
+    '''Return True if header starts with the header of an MPEG audio frame,
+    of any layer, or of an ADTS frame of AAC'''
+
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return False
+
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    bitrate = header[2] >> 4
+    sampleRate = (header[2] >> 2) & 3
+
+    if layer == 0:
+        return header[1] & 0xf6 == 0xf0     # ADTS has a 12 bit sync word
+    else:
+        return version != 1 and bitrate != 15 and sampleRate != 3
+
+def sniffAudioFormat(path):
+    '''Tell what the file at path holds from its first few KB rather than
+    from its name. Return (format, info): aiff, alac, aac, flac, mp3, vorbis
+    or wave, or None if it isn't audio piggy can read, and the stream info if
+    telling the format took reading it anyway, or None.'''
+
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            tagged = f.tell() > 0
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        return None, None
+
+    if head[:4] == b'fLaC':
+        return 'flac', None
+    elif head[:4] == b'OggS' and len(head) > 27:
+        # The first packet follows the page header and its segment table
+        start = 27 + head[26]
+        if head[start:start + 7] == b'\x01vorbis':
+            return 'vorbis', None
+    elif head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'wave', None
+    elif head[:4] == b'FORM' and head[8:12] in [b'AIFF', b'AIFC']:
+        return 'aiff', None
+    elif head[4:8] == b'ftyp':
+        # AAC or ALAC, as the sample description of the audio track says
+        info = readMP4StreamInfo(path)
+        if info:
+            return info['codec'], info
+    else:
+        # Encoders pad the ID3v2 tag with zeros
+        if tagged:
+            head = head.lstrip(b'\x00')
+        if isMPEGAudioHeader(head):
+            return 'aac' if (head[1] >> 1) & 3 == 0 else 'mp3', None
+
+    return None, None
+
+# ------------------------------------------------------------------------------
+
+# Fingerprints that tell when two input files hold the same audio, and copies
+# of an output file for the duplicates
+
+def readFLACAudioMD5(path):
+    '''Return the MD5 of the decoded samples that flac stores in STREAMINFO,
+    as a hex string, or None if the encoder left it out'''
+
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            if f.read(4) != b'fLaC':
+                return None
+
+            header = f.read(4)
+            if len(header) < 4 or header[0] & 0x7f != 0:
+                return None
+
+            data = f.read(34)
+            if len(data) < 34:
+                return None
+    except OSError:
+        return None
+
+    md5 = data[18:34]
+    if md5 == bytes(16):
+        return None
+
+    # The format goes along with the samples, so that the same numbers at a
+    # different sample rate aren't the same audio
+    return data[10:18].hex() + md5.hex()
+
+def hashFile(path):
+    try:
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_BUFFER_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+    except OSError:
+        return None
+
+def readAhead(path):
+    '''Read a file through, so that it sits in the page cache by the time a
+    decoder gets to it. Return the number of bytes read.'''
+
+    buffer = bytearray(READ_BUFFER_SIZE)
+    size = 0
+
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            # Ask for the whole file up front, so the disk can read it in as
+            # few long runs as it likes
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            size += n
+
+    return size
+
+def fingerprint(audioFile):
+    '''Return a string that is the same for two files only if they hold the
+    same audio. FLAC files carry an MD5 of their samples, which tags don't
+    change. Everything else is hashed whole, so only exact copies match.'''
+
+    if isinstance(audioFile, FLACAudioFile):
+        md5 = readFLACAudioMD5(audioFile.path)
+        if md5:
+            return 'flac:' + md5
+
+    h = hashFile(audioFile.path)
+    return 'file:' + h if h else None
+
+def cloneFile(sourcePath, targetPath):
+    '''Copy a file, sharing its blocks with the original where the file
+    system can (a reflink)'''
+
+    with open(sourcePath, 'rb') as source, open(targetPath, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return
+        except OSError:
+            pass
+
+        shutil.copyfileobj(source, target, HASH_BUFFER_SIZE)
+
+def syncToDisk(path):
+    '''fsync() a file or a folder'''
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+partialNumbers = itertools.count(1)
+
+def makePartialPath(outputPath, folder=None):
+    '''Return a hidden path in folder, the folder of outputPath by default,
+    to write outputPath under until it is complete. The process ID and a
+    number make it unique to the writer, so that two writers of the same
+    output, in this process or in another one, never write into one file.'''
+
+    partialName = PARTIAL_PREFIX + str(os.getpid()) + '.' + \
+                    str(next(partialNumbers)) + '.' + os.path.basename(outputPath)
+    return os.path.join(folder or os.path.dirname(outputPath), partialName)
+
+def finalPath(partialPath):
+    '''Return the output path that makePartialPath() made partialPath for'''
+
+    folder, name = os.path.split(partialPath)
+    return os.path.join(folder, name[len(PARTIAL_PREFIX):].split('.', 2)[2])
+
+def startOutput(outputPath):
+    '''Return the path to write outputPath under until it is complete, and
+    note it in the journal. It's in the same folder, so that commitOutput()
+    can rename it into place atomically, or in the staging folder if there is
+    one. Either way, it keeps the extension, which some encoders go by.'''
+
+    if mover.stagingDirectory:
+        partialPath = mover.stage(outputPath)
+    else:
+        partialPath = makePartialPath(outputPath)
+
+    journal.add(partialPath)
+    return partialPath
+
+def commitOutput(partialPath, ok):
+    '''Rename an output that startOutput() named into place if ok, or delete
+    it otherwise. A staged output goes to the mover instead. Return True if
+    the output is in place, or on its way there.'''
+
+    if mover.isStaged(partialPath):
+        return mover.commit(partialPath, ok)
+
+    outputPath = finalPath(partialPath)
+
+    try:
+        if ok:
+            mover.place(partialPath, outputPath)
+        elif os.path.lexists(partialPath):
+            deleteFile(partialPath)
+    except OSError as e:
+        err('Could not move ' + partialPath + ' into place: ' + e.strerror)
+        ok = False
+
+    journal.remove(partialPath)
+    return ok
+
+def cloneOutput(sourcePath, outputPath, encoder=None, tags=None):
+    '''Copy sourcePath to outputPath with cloneFile(), then have the encoder
+    give the copy the tags, if there are any. Return True if that worked.'''
+
+    partialPath = startOutput(outputPath)
+
+    try:
+        if os.path.lexists(partialPath):
+            deleteFile(partialPath)
+        cloneFile(sourcePath, partialPath)
+    except OSError as e:
+        err('Could not copy ' + sourcePath + ' to ' + outputPath + ': ' + e.strerror)
+        return commitOutput(partialPath, False)
+
+    return commitOutput(partialPath, tags is None or encoder.retag(partialPath, tags))
+
+def copyDuplicateOutput(sourcePath, sourceTags, outputPath, encoder, tags):
+    '''Make outputPath a copy of the output at sourcePath, which was
+    transcoded from the same audio, and give it its own tags. If the tags are
+    the same too, a hard link will do. Return True if that worked.'''
+
+    if sourceTags != tags:
+        return cloneOutput(sourcePath, outputPath, encoder, tags)
+
+    partialPath = startOutput(outputPath)
+
+    try:
+        if os.path.lexists(partialPath):
+            deleteFile(partialPath)
+        os.link(sourcePath, partialPath)
+        return commitOutput(partialPath, True)
+    except OSError:
+        commitOutput(partialPath, False)
+        return cloneOutput(sourcePath, outputPath)  # Different file systems, perhaps
+
+def id3v2Frame(frameId, text, prefix=b''):
+    try:
+        data = b'\x00' + prefix + text.encode('latin-1')
+    except UnicodeEncodeError:
+        data = b'\x01' + prefix + text.encode('utf-16')
+    return frameId + struct.pack('>IH', len(data), 0) + data
+
+def writeID3v2Tag(path, tags):
+    '''Replace the ID3v2 tag at the start of an MP3 file with an ID3v2.3
+    tag of the given tags'''
+
+    frames = b''
+    if 'artist' in tags:
+        frames += id3v2Frame(b'TPE1', tags['artist'])
+    if 'album' in tags:
+        frames += id3v2Frame(b'TALB', tags['album'])
+    if 'title' in tags:
+        frames += id3v2Frame(b'TIT2', tags['title'])
+    if 'track' in tags:
+        frames += id3v2Frame(b'TRCK', tags['track'])
+    if 'year' in tags:
+        frames += id3v2Frame(b'TYER', tags['year'])
+    if 'comment' in tags:
+        # Language, then an empty description. The description's terminator
+        # has to match the encoding of the text, so spell it out.
+        try:
+            tags['comment'].encode('latin-1')
+            frames += id3v2Frame(b'COMM', tags['comment'], b'eng\x00')
+        except UnicodeEncodeError:
+            frames += id3v2Frame(b'COMM', tags['comment'], b'eng\xff\xfe\x00\x00')
+
+    size = len(frames)
+    header = b'ID3\x03\x00\x00' + bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f,
+                                        (size >> 7) & 0x7f, size & 0x7f])
+
+    try:
+        with open(path, 'rb') as f:
+            skipID3v2(f)
+            audio = f.read()
+
+        with open(path, 'wb') as f:
+            f.write(header + frames + audio)
+    except OSError as e:
+        err('Could not write tags into ' + path + ': ' + e.strerror)
+        return False
+
+    return True
+
+def mp4Box(boxType, data):
+    return struct.pack('>I4s', 8 + len(data), boxType) + data
+
+def mp4Children(f, start, end):
+    '''Yield (type, box start, box end) for every MP4 box between start and
+    end, headers included'''
+
+    pos = start
+    for boxType, dataStart, dataEnd in mp4Boxes(f, start, end):
+        yield boxType, pos, dataEnd
+        pos = dataEnd
+
+def mp4MetaBox(tags):
+    '''Return a meta box with the tags in an iTunes-style ilst'''
+
+    items = b''
+    for atom, key in MP4_ATOMS.items():
+        if key not in tags:
+            continue
+
+        if atom == b'trkn':
+            numbers = [int(n) for n in re.findall('\\d+', tags[key])[:2]]
+            if not numbers:
+                continue
+            track, total = (numbers + [0])[:2]
+            value = struct.pack('>HHHH', 0, track & 0xffff, total & 0xffff, 0)
+            dataType = 0        # Binary
+        else:
+            value = tags[key].encode('utf-8')
+            dataType = 1        # UTF-8
+
+        items += mp4Box(atom, mp4Box(b'data', struct.pack('>II', dataType, 0) + value))
+
+    hdlr = mp4Box(b'hdlr', b'\x00' * 8 + b'mdirappl' + b'\x00' * 9)
+    return mp4Box(b'meta', b'\x00' * 4 + hdlr + mp4Box(b'ilst', items))
+
+def replaceMP4Meta(moov, tags):
+    '''Return a copy of the moov box, given as bytes, with a meta box of the
+    tags in place of the old one. Everything else in udta stays.'''
+
+    f = io.BytesIO(moov)
+    headerSize = 16 if struct.unpack_from('>I', moov)[0] == 1 else 8
+    children = b''
+    udta = b''
+
+    for boxType, start, end in list(mp4Children(f, headerSize, len(moov))):
+        if boxType != b'udta':
+            children += moov[start:end]
+            continue
+
+        for childType, childStart, childEnd in list(mp4Children(f, start + 8, end)):
+            if childType != b'meta':
+                udta += moov[childStart:childEnd]
+
+    return mp4Box(b'moov', children + mp4Box(b'udta', udta + mp4MetaBox(tags)))
+
+def writeMP4Tags(path, tags):
+    '''Replace the tags of an MP4 file with the given tags. Only the moov box
+    is written: in place if it fits in the room it and the free boxes after
+    it take up, or else at the end of the file, with the old one turned into
+    a free box. The audio in mdat never moves, so its chunk offsets stay
+    valid and none of it has to be copied.'''
+
+    try:
+        with open(path, 'r+b') as f:
+            fileSize = os.fstat(f.fileno()).st_size
+            boxes = list(mp4Children(f, 0, fileSize))
+            moovs = [i for i, box in enumerate(boxes) if box[0] == b'moov']
+            if not moovs:
+                err('Could not write tags into ' + path + ': There is no moov box')
+                return False
+
+            i = moovs[0]
+            moovStart, moovEnd = boxes[i][1:]
+            f.seek(moovStart)
+            moov = replaceMP4Meta(f.read(moovEnd - moovStart), tags)
+
+            # The free boxes after moov are room to grow into
+            roomEnd = moovEnd
+            for boxType, start, end in boxes[i + 1:]:
+                if boxType not in [b'free', b'skip']:
+                    break
+                roomEnd = end
+            room = roomEnd - moovStart
+
+            if roomEnd == fileSize:
+                f.seek(moovStart)
+                f.write(moov)
+                f.truncate()
+            elif room == len(moov) or room >= len(moov) + 8:
+                f.seek(moovStart)
+                f.write(moov)
+                if room > len(moov):
+                    gap = room - len(moov)
+                    f.write(struct.pack('>I4s', gap, b'free') + b'\x00' * (gap - 8))
+            else:
+                f.seek(fileSize)
+                f.write(moov)
+                f.seek(moovStart + 4)
+                f.write(b'free')
+    except (OSError, struct.error) as e:
+        err('Could not write tags into ' + path + ': ' + str(e))
+        return False
+
+    return True
+
+# ------------------------------------------------------------------------------
+
+class AudioFile(object):
+    codec           = None      # As in the stream info
+
+    def __init__(self, path):
+        # AudioFile objects should not exist unless their respective files exist
+        # on disk!
+        assert os.path.isfile(path)
+        assert os.access(path, os.R_OK)
+
+        self.path = path                                    # Full path to the file on disk
+        self.dir, self.name = os.path.split(path)           # Absolute directory and filename
+        self.name_noext = os.path.splitext(self.name)[0]    # Filename without the period and the extension
+        self.decodedAudioFile = None                        # A decoded version of this file; typically a WaveAudioFile
+        self.tags = {}                                      # { artist, album, title, track, year, comment }
+        self.info = None                                    # See STREAM_INFO_KEYS
+        self.loaded = False                                 # Whether tags and info have been read
+        self.fingerprint = None                             # See fingerprint()
+
+        # Reading tags can be slow, so it's up to whoever is about to use them
+        # to call load()
+
+    def generateTempFileName(self, s, folder=None):
+        # This is not meant to be secure. It'd be nice to use the tempfile
+        # module, but we just need a *name*, not a file handle.
+        # TODO: On Mac OS X, we can use `getconf DARWIN_USER_TEMP_DIR`
+        name = os.path.join(folder or TMPDIR, NAME + '_' + str(time.time()) + '_' + s)
+        journal.add(name)
+        return name
+
+    def removeTemporaryFiles(self):
+        if self.decodedAudioFile:
+            deleteFile(self.decodedAudioFile.path)
+            journal.remove(self.decodedAudioFile.path)
+            self.decodedAudioFile = None
+
+    def decode(self, folder=None):
+        '''Decode into a WAVE file in folder, TMPDIR by default'''
+        pass
+
+    def streamCommand(self):
+        '''Return the argv of a command that writes this file to stdout as
+        WAVE data, or None if the decoder cannot stream'''
+        return None
+
+    def load(self):
+        '''Read the tags and the stream info unless they're already known'''
+
+        if not self.loaded:
+            self.loadTags()
+            if self.info is None:
+                self.loadInfo()
+            self.loaded = True
+
+    def loadTags(self):
+        pass
+
+    def loadInfo(self):
+        pass
+
+    def setTags(self, artist, album, title, track, year, comment):
+        self.tags['artist']     = artist
+        self.tags['album']      = album
+        self.tags['title']      = title
+        self.tags['track']      = track
+        self.tags['year']       = year
+        self.tags['comment']    = comment
+
+class PCMAudioFile(AudioFile):
+    def decode(self, folder=None):
+        return self
+
+class WaveAudioFile(PCMAudioFile):
+    codec           = 'pcm'
+
+    def loadInfo(self):
+        self.info = readWaveStreamInfo(self.path)
+
+class AIFFAudioFile(PCMAudioFile):
+    codec           = 'pcm'
+
+    def loadInfo(self):
+        self.info = readAIFFStreamInfo(self.path)
+
+class CompressedAudioFile(AudioFile):
+    def decodeCommand(self, outputPath):
+        '''Return the argv of a command that decodes this file into a WAVE
+        file at outputPath'''
+        pass
+
+    def decode(self, folder=None):
+        if self.decodedAudioFile:
+            return self.decodedAudioFile
+
+        outputPath = self.generateTempFileName(self.name + '.wav', folder)
+        return self.decoded(outputPath, runProcess(self.decodeCommand(outputPath)))
+
+    def decoded(self, outputPath, exitCode):
+        '''Adopt the WAVE file that decodeCommand() wrote to outputPath, or
+        clean up after it if it failed. Return the decoded AudioFile or None.'''
+
+        if exitCode == 0:
+            decodedAudioFile = WaveAudioFile(outputPath)
+            decodedAudioFile.tags = self.tags
+            self.decodedAudioFile = decodedAudioFile
+            return decodedAudioFile
+        else:
+            try:
+                deleteFile(outputPath)
+            except OSError:
+                pass
+            journal.remove(outputPath)
+            return None
+
+class ALACAudioFile(CompressedAudioFile):
+    codec           = 'alac'
+
+    # afconvert cannot write to stdout, so ALAC files are always decoded into
+    # a temporary file
+
+    def decodeCommand(self, outputPath):
+        # TODO: Hmm... we're assuming 16 bits per sample. Is this a good idea?
+        return [AFCONVERT, '-f', 'WAVE', '-d', 'LEI16', self.path, outputPath]
+
+    def loadInfo(self):
+        self.info = readMP4StreamInfo(self.path)
+
+    def loadTags(self):
+        tags = readMP4Tags(self.path)
+        if tags is None:
+            self.atomicParsleyLoadTags()
+        else:
+            self.tags.update(tags)
+
+    def atomicParsleyLoadTags(self):
+        tags = captureOutput([ATOMICPARSELEY, self.path, '-t'])
+
+        ar = re.compile('Atom "©ART" contains: (.+)', re.IGNORECASE)
+        al = re.compile('Atom "©alb" contains: (.+)', re.IGNORECASE)
+        ti = re.compile('Atom "©nam" contains: (.+)', re.IGNORECASE)
+        tr = re.compile('Atom "trkn" contains: (.+)', re.IGNORECASE)
+        yr = re.compile('Atom "©day" contains: (\d+)', re.IGNORECASE)
+#        cm = re.compile('Atom "©cmt" contains: (.+)', re.IGNORECASE)
+
+        for line in tags.splitlines():
+            m = ar.match(line)
+            if m:
+                self.tags['artist'] = m.group(1)
+
+            m = al.match(line)
+            if m:
+                self.tags['album'] = m.group(1)
+
+            m = ti.match(line)
+            if m:
+                self.tags['title'] = m.group(1)
+
+            m = tr.match(line)
+            if m:
+                self.tags['track'] = m.group(1)
+
+            m = yr.match(line)
+            if m:
+                self.tags['year'] = m.group(1)
+
+#            m = cm.match(line)
+#            if m:
+#                self.tags['comment'] = m.group(1)
+
+class XiphAudioFile(CompressedAudioFile):
+    def xiphLoadTags(self, tool):
+        tags = captureOutput(tool)
+
+        ar = re.compile('ARTIST=(.+)', re.IGNORECASE)
+        al = re.compile('ALBUM=(.+)', re.IGNORECASE)
+        ti = re.compile('TITLE=(.+)', re.IGNORECASE)
+        tr = re.compile('TRACKNUMBER=(.*)', re.IGNORECASE)
+        yr = re.compile('DATE=(.*)', re.IGNORECASE)
+        cm = re.compile('COMMENT=(.*)', re.IGNORECASE)
+
+        for line in tags.splitlines():
+            m = ar.match(line)
+            if m:
+                self.tags['artist'] = m.group(1)
+
+            m = al.match(line)
+            if m:
+                self.tags['album'] = m.group(1)
+
+            m = ti.match(line)
+            if m:
+                self.tags['title'] = m.group(1)
+
+            m = tr.match(line)
+            if m:
+                self.tags['track'] = m.group(1)
+
+            m = yr.match(line)
+            if m:
+                self.tags['year'] = m.group(1)
+
+            m = cm.match(line)
+            if m:
+                self.tags['comment'] = m.group(1)
+
+class FLACAudioFile(XiphAudioFile):
+    codec           = 'flac'
+
+    def decodeCommand(self, outputPath):
+        return [FLAC, '--silent', '--decode', '-o', outputPath, self.path]
+
+    def streamCommand(self):
+        return [FLAC, '--silent', '--decode', '--stdout', self.path]
+
+    def loadInfo(self):
+        self.info = readFLACStreamInfo(self.path)
+
+    def loadTags(self):
+        tags = readFLACTags(self.path)
+        if tags is None:
+            self.xiphLoadTags([METAFLAC, '--export-tags-to=-', self.path])
+        else:
+            self.tags.update(tags)
+
+class VorbisAudioFile(XiphAudioFile):
+    codec           = 'vorbis'
+
+    def decodeCommand(self, outputPath):
+        return [OGGDEC, '--quiet', '-o', outputPath, self.path]
+
+    def streamCommand(self):
+        return [OGGDEC, '--quiet', '-o', '-', self.path]
+
+    def loadInfo(self):
+        self.info = readOggStreamInfo(self.path)
+
+    def loadTags(self):
+        tags = readOggTags(self.path)
+        if tags is None:
+            self.xiphLoadTags([VORBISCOMMENT, '--list', self.path])
+        else:
+            self.tags.update(tags)
+
+class MP3AudioFile(CompressedAudioFile):
+    codec           = 'mp3'
+
+    def decodeCommand(self, outputPath):
+        return [MADPLAY, '--quiet', '-o', outputPath, self.path]
+
+    def streamCommand(self):
+        return [MADPLAY, '--quiet', '-o', 'wave:-', self.path]
+
+    def loadInfo(self):
+        self.info = readMP3StreamInfo(self.path)
+
+    def loadTags(self):
+        tags = readMP3Tags(self.path)
+        if tags is None:
+            self.madplayLoadTags()
+        else:
+            self.tags.update(tags)
+
+    def madplayLoadTags(self):
+        tags = captureOutput([MADPLAY, '--show-tags-only', self.path])
+
+        ar = re.compile('\s*artist: (.+)', re.IGNORECASE)
+        al = re.compile('\s*album: (.+)', re.IGNORECASE)
+        ti = re.compile('\s*title: (.+)', re.IGNORECASE)
+        tr = re.compile('\s*track: (.*)', re.IGNORECASE)
+        yr = re.compile('\s*year: (.*)', re.IGNORECASE)
+#        cm = re.compile('comment: (.*)', re.IGNORECASE)
+
+        for line in tags.splitlines():
+            m = ar.match(line)
+            if m:
+                self.tags['artist'] = m.group(1)
+
+            m = al.match(line)
+            if m:
+                self.tags['album'] = m.group(1)
+
+            m = ti.match(line)
+            if m:
+                self.tags['title'] = m.group(1)
+
+            m = tr.match(line)
+            if m:
+                self.tags['track'] = m.group(1)
+
+            m = yr.match(line)
+            if m:
+                self.tags['year'] = m.group(1)
+
+#            m = cm.match(line)
+#            if m:
+#                self.tags['comment'] = m.group(1)
+
+class MP4AudioFile(CompressedAudioFile):
+    codec           = 'aac'
+
+    def decodeCommand(self, outputPath):
+        return [FAAD, '--quiet', '-o', outputPath, self.path]
+
+    def streamCommand(self):
+        return [FAAD, '--quiet', '-w', self.path]
+
+    def loadInfo(self):
+        self.info = readMP4StreamInfo(self.path)
+
+    def loadTags(self):
+        tags = readMP4Tags(self.path)
+        if tags is None:
+            self.faadLoadTags()
+        else:
+            self.tags.update(tags)
+
+    def faadLoadTags(self):
+        tags = captureOutput([FAAD, '--info', self.path])
+
+        ar = re.compile('artist: (.+)', re.IGNORECASE)
+        al = re.compile('album: (.+)', re.IGNORECASE)
+        ti = re.compile('title: (.+)', re.IGNORECASE)
+        tr = re.compile('track: (.*)', re.IGNORECASE)
+        yr = re.compile('date: (.*)', re.IGNORECASE)
+#        cm = re.compile('COMMENT=(.*)', re.IGNORECASE)
+
+        for line in tags.splitlines():
+            m = ar.match(line)
+            if m:
+                self.tags['artist'] = m.group(1)
+
+            m = al.match(line)
+            if m:
+                self.tags['album'] = m.group(1)
+
+            m = ti.match(line)
+            if m:
+                self.tags['title'] = m.group(1)
+
+            m = tr.match(line)
+            if m:
+                self.tags['track'] = m.group(1)
+
+            m = yr.match(line)
+            if m:
+                self.tags['year'] = m.group(1)
+
+#            m = cm.match(line)
+#            if m:
+#                self.tags['comment'] = m.group(1)
+
+AUDIO_FILE_CLASSES = {
+    'aiff':     AIFFAudioFile,
+    'alac':     ALACAudioFile,
+    'aac':      MP4AudioFile,
+    'flac':     FLACAudioFile,
+    'mp3':      MP3AudioFile,
+    'vorbis':   VorbisAudioFile,
+    'wave':     WaveAudioFile,
+}
+
+def makeAudioFile(path):
+    '''Return an AudioFile for the file at path, going by its extension, or
+    None. Only the name is looked at, so that scanning a library that is up
+    to date doesn't open a single file; identifyAudioFile() makes sure of the
+    class once the file is queued.'''
+
+    if os.path.isfile(path) and os.access(path, os.R_OK):
+        name = os.path.basename(path)
+
+        try:
+            ext = os.path.splitext(name)[1].split('.')[1].lower()
+        except IndexError:
+            return None
+
+        # .m4a files can be either ALAC or AAC. Since MP4 comes first in this
+        # list, it masks ALAC until identifyAudioFile() looks inside.
+        if ext in AIFF_FILE_EXTENSIONS:
+            return AIFFAudioFile(path)
+        elif ext in MP4_FILE_EXTENSIONS:
+            return MP4AudioFile(path)
+        elif ext in ALAC_FILE_EXTENSIONS:
+            return ALACAudioFile(path)
+        elif ext in FLAC_FILE_EXTENSIONS:
+            return FLACAudioFile(path)
+        elif ext in MP3_FILE_EXTENSIONS:
+            return MP3AudioFile(path)
+        elif ext in VORBIS_FILE_EXTENSIONS:
+            return VorbisAudioFile(path)
+        elif ext in WAVE_FILE_EXTENSIONS:
+            return WaveAudioFile(path)
+
+    return None
+
+def identifyAudioFile(audioFile):
+    '''Make audioFile an object of the class that can read what's in it,
+    whatever its name says, so .m4a files get the right decoder for AAC and
+    for ALAC and misnamed files still get decoded. A codec that the index
+    remembers will do; otherwise the first few KB of the file tell. Return
+    False if it isn't audio piggy can read.'''
+
+    codec = audioFile.info['codec'] if audioFile.info else None
+    if codec and codec == audioFile.codec:
+        return True
+
+    info = None
+    if codec in AUDIO_FILE_CLASSES:
+        format = codec
+    else:
+        # The stream info says pcm for both WAVE and AIFF
+        format, info = sniffAudioFormat(audioFile.path)
+
+    audioFileClass = AUDIO_FILE_CLASSES.get(format)
+    if audioFileClass is None:
+        return False
+
+    # Every AudioFile class keeps the same attributes, only what it does with
+    # them differs
+    audioFile.__class__ = audioFileClass
+    if info:
+        audioFile.info = info
+    return True
+
+# ------------------------------------------------------------------------------
+
+class AudioEncoder(object):
+    extension       = None      # Appended to the output path
+    audioFileClass  = None      # The AudioFile subclass of the encoded file
+    readsStdin      = True      # Whether the encoder can read WAVE data from stdin
+
+    def __init__(self, opts):
+        self.opts = opts                    # As written in encoderSettings
+        self.args = shlex.split(opts)       # The same, as a list of arguments
+
+    def command(self, inputPath, outputPath, tags):
+        '''Return the argv that encodes the WAVE or AIFF file at inputPath
+        into outputPath. An inputPath of '-' means stdin.'''
+        pass
+
+    def retag(self, outputPath, tags):
+        '''Replace the tags of an output file that was copied from another
+        one. Return True if that worked.'''
+        return False
+
+    def finish(self, audioFile, outputPath, exitCode):
+        if exitCode == 0:
+            encodedAudioFile = self.audioFileClass(outputPath)
+            encodedAudioFile.tags = audioFile.tags
+            return encodedAudioFile
+        else:
+            try:
+                deleteFile(outputPath)
+            except OSError:
+                pass
+            return None
+
+class ALACAudioEncoder(AudioEncoder):
+    extension       = 'm4a'
+    audioFileClass  = ALACAudioFile
+    readsStdin      = False
+
+    def command(self, inputPath, outputPath, tags):
+        return [AFCONVERT, '-d', 'alac'] + self.args + [inputPath, outputPath]
+
+    def finish(self, audioFile, outputPath, exitCode):
+        # afconvert doesn't write tags. Adding them only rewrites the moov
+        # box, not the whole file.
+        if exitCode == 0:
+            with stats.stage(audioFile.path, 'tag') as record:
+                record.ok = writeMP4Tags(outputPath, audioFile.tags)
+                if not record.ok:
+                    exitCode = EXIT_FAILURE
+
+        return AudioEncoder.finish(self, audioFile, outputPath, exitCode)
+
+    def retag(self, outputPath, tags):
+        return writeMP4Tags(outputPath, tags)
+
+class FLACAudioEncoder(AudioEncoder):
+    extension       = 'flac'
+    audioFileClass  = FLACAudioFile
+
+    def command(self, inputPath, outputPath, tags):
+        cmd = [FLAC, '--silent'] + self.args
+
+        if 'artist' in tags:
+            cmd += ['-T', 'ARTIST=' + tags['artist']]
+        if 'album' in tags:
+            cmd += ['-T', 'ALBUM=' + tags['album']]
+        if 'title' in tags:
+            cmd += ['-T', 'TITLE=' + tags['title']]
+        if 'track' in tags:
+            cmd += ['-T', 'TRACKNUMBER=' + tags['track']]
+        if 'year' in tags:
+            cmd += ['-T', 'DATE=' + tags['year']]
+        if 'comment' in tags:
+            cmd += ['-T', 'COMMENT=' + tags['comment']]
+
+        # Decoders that write to a pipe cannot go back and fix up the sizes
+        # in the WAVE header
+        if inputPath == '-':
+            cmd += ['--ignore-chunk-sizes']
+
+        cmd += ['-o', outputPath, inputPath]
+        return cmd
+
+    def retag(self, outputPath, tags):
+        cmd = [METAFLAC, '--remove-all-tags']
+
+        if 'artist' in tags:
+            cmd += ['--set-tag=ARTIST=' + tags['artist']]
+        if 'album' in tags:
+            cmd += ['--set-tag=ALBUM=' + tags['album']]
+        if 'title' in tags:
+            cmd += ['--set-tag=TITLE=' + tags['title']]
+        if 'track' in tags:
+            cmd += ['--set-tag=TRACKNUMBER=' + tags['track']]
+        if 'year' in tags:
+            cmd += ['--set-tag=DATE=' + tags['year']]
+        if 'comment' in tags:
+            cmd += ['--set-tag=COMMENT=' + tags['comment']]
+
+        cmd += [outputPath]
+        return runProcess(cmd) == 0
+
+class OggencAudioEncoder(AudioEncoder):
+    extension       = 'ogg'
+    audioFileClass  = VorbisAudioFile
+
+    def command(self, inputPath, outputPath, tags):
+        cmd = [OGGENC, '--quiet'] + self.args
+
+        if 'artist' in tags:
+            cmd += ['-a', tags['artist']]
+        if 'album' in tags:
+            cmd += ['-l', tags['album']]
+        if 'title' in tags:
+            cmd += ['-t', tags['title']]
+        if 'track' in tags:
+            cmd += ['-N', tags['track']]
+        if 'year' in tags:
+            cmd += ['-d', tags['year']]
+        if 'comment' in tags:
+            cmd += ['-c', 'COMMENT=' + tags['comment']]
+
+        # Like flac's --ignore-chunk-sizes: read the pipe to its end instead
+        # of trusting the data length that a streaming decoder made up
+        if inputPath == '-':
+            cmd += ['--ignorelength']
+
+        cmd += ['-o', outputPath, inputPath]
+        return cmd
+
+    def retag(self, outputPath, tags):
+        # Without any -t, vorbiscomment reads the tags from stdin
+        cmd = [VORBISCOMMENT, '--write', '-c', os.devnull]
+
+        if 'artist' in tags:
+            cmd += ['-t', 'ARTIST=' + tags['artist']]
+        if 'album' in tags:
+            cmd += ['-t', 'ALBUM=' + tags['album']]
+        if 'title' in tags:
+            cmd += ['-t', 'TITLE=' + tags['title']]
+        if 'track' in tags:
+            cmd += ['-t', 'TRACKNUMBER=' + tags['track']]
+        if 'year' in tags:
+            cmd += ['-t', 'DATE=' + tags['year']]
+        if 'comment' in tags:
+            cmd += ['-t', 'COMMENT=' + tags['comment']]
+
+        cmd += [outputPath]
+        return runProcess(cmd) == 0
+
+class LAMEAudioEncoder(AudioEncoder):
+    extension       = 'mp3'
+    audioFileClass  = MP3AudioFile
+
+    def command(self, inputPath, outputPath, tags):
+        cmd = [LAME, '--silent'] + self.args
+
+        if 'artist' in tags:
+            cmd += ['--ta', tags['artist']]
+        if 'album' in tags:
+            cmd += ['--tl', tags['album']]
+        if 'title' in tags:
+            cmd += ['--tt', tags['title']]
+        if 'track' in tags:
+            cmd += ['--tn', tags['track']]
+        if 'year' in tags:
+            cmd += ['--ty', tags['year']]
+        if 'comment' in tags:
+            cmd += ['--tc', tags['comment']]
+
+        # The same, for LAME 3.99 and later
+        if inputPath == '-':
+            cmd += ['--ignorelength']
+
+        cmd += [inputPath, outputPath]
+        return cmd
+
+    def retag(self, outputPath, tags):
+        return writeID3v2Tag(outputPath, tags)
+
+# ------------------------------------------------------------------------------
+
+class ScanProgress(object):
+    '''Keep track of how far the input directories have been scanned while
+    the workers are already transcoding'''
+
+    def __init__(self):
+        self.count      = 0         # Number of QueueEntry objects queued so far
+        self.skipped    = 0         # Number of files that were already up to date
+        self.done       = False     # Whether count is the final total
+        self.seconds    = 0.0       # How long the scan took, blocking included
+
+    def total(self):
+        if self.done:
+            return str(self.count)
+        else:
+            return '?'
+
+class Manifest(object):
+    '''Remember which source file, and which encoder options, every output
+    file in one setting's folder was made from, so that later runs can skip
+    whatever is still up to date.
+
+    Records are appended to the file as they happen, so an interrupted run
+    loses nothing. Later lines win when the file is read back, and close()
+    rewrites it without the duplicates.'''
+
+    def __init__(self, folder, shard=None):
+        self.folder     = folder
+        self.path       = os.path.join(folder, MANIFEST_NAME)
+        self.entries    = {}        # Output path relative to folder -> record
+        self.own        = {}        # The records that belong in self.path
+        self.seen       = set()     # Keys whose sources were found by this run
+        self.lock       = threading.Lock()
+        self.log        = None
+
+        # Every shard keeps its own file, since they would clobber each
+        # other's rewrites in close(), but reads the others' too. A record
+        # only says an output is up to date for one exact source, so it
+        # doesn't matter which file it came from.
+        self.path += shardSuffix(shard)
+
+        for path in self.manifestPaths():
+            self.load(path)
+
+    def manifestPaths(self):
+        '''Return every manifest file in the folder, this one last'''
+
+        try:
+            names = sorted(name for name in os.listdir(self.folder)
+                            if name.startswith(MANIFEST_NAME) and
+                                not name.endswith('.tmp'))
+        except FileNotFoundError:
+            return [self.path]
+
+        paths = [os.path.join(self.folder, name) for name in names]
+        return [path for path in paths if path != self.path] + [self.path]
+
+    def load(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # Probably cut short by a crash
+
+                    for entries in [self.entries] + \
+                                    ([self.own] if path == self.path else []):
+                        if record.get('deleted'):
+                            entries.pop(record['key'], None)
+                        else:
+                            entries[record['key']] = record
+        except FileNotFoundError:
+            pass
+
+    def isUpToDate(self, key, stat, opts, outputPath=None):
+        '''Return True if the record of key matches the source and the
+        options. Unless outputPath is None, the output must also exist.'''
+
+        record = self.entries.get(key)
+
+        return record is not None and \
+                record['size'] == stat.st_size and \
+                record['mtime'] == stat.st_mtime_ns and \
+                record['opts'] == opts and \
+                (outputPath is None or os.path.isfile(outputPath))
+
+    def see(self, key):
+        with self.lock:
+            self.seen.add(key)
+
+    def record(self, key, sourcePath, stat, opts):
+        self.append({
+            'key':      key,
+            'source':   sourcePath,
+            'size':     stat.st_size,
+            'mtime':    stat.st_mtime_ns,
+            'opts':     opts,
+        })
+
+    def forget(self, key):
+        self.append({'key': key, 'deleted': True})
+
+    def append(self, record):
+        with self.lock:
+            if record.get('deleted'):
+                self.entries.pop(record['key'], None)
+                self.own.pop(record['key'], None)
+            else:
+                self.entries[record['key']] = record
+                self.own[record['key']] = record
+
+            if self.log is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self.log = open(self.path, 'a', encoding='utf-8')
+
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def unseen(self, rootNames):
+        '''Return the keys under the given input roots whose sources weren't
+        found by this run'''
+
+        with self.lock:
+            return [key for key in self.entries
+                    if key.split(os.sep, 1)[0] in rootNames and
+                        key not in self.seen]
+
+    def close(self):
+        with self.lock:
+            if self.log is None:
+                return
+
+            self.log.close()
+            self.log = None
+
+            tempPath = self.path + '.tmp'
+            with open(tempPath, 'w', encoding='utf-8') as f:
+                for record in self.own.values():
+                    f.write(json.dumps(record) + '\n')
+            os.replace(tempPath, self.path)
+
+class Journal(object):
+    '''Keep track of the temporary files a run makes, decoded audio and
+    outputs that aren't complete yet, so that --resume can delete whatever an
+    interrupted run left behind without searching for it. Until open() is
+    called, nothing is kept.
+
+    Like the Manifest, the journal is appended to as things happen, and
+    close() rewrites it with just the files that may still be around.'''
+
+    def __init__(self):
+        self.path       = None
+        self.files      = set()     # Temporary files that may still exist
+        self.lock       = threading.Lock()
+        self.log        = None
+
+    def open(self, path):
+        self.path = path
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # Probably cut short by a crash
+
+                    if record['open']:
+                        self.files.add(record['path'])
+                    else:
+                        self.files.discard(record['path'])
+        except FileNotFoundError:
+            pass
+
+    def add(self, path):
+        if self.path:
+            self.append({'path': path, 'open': True})
+
+    def remove(self, path):
+        if self.path and path in self.files:
+            self.append({'path': path, 'open': False})
+
+    def append(self, record):
+        with self.lock:
+            if record['open']:
+                self.files.add(record['path'])
+            else:
+                self.files.discard(record['path'])
+
+            if self.log is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.log = open(self.path, 'a', encoding='utf-8')
+
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def deleteLeftovers(self):
+        '''Delete the temporary files in the journal. Call this before the
+        run starts, when all of them are left over from earlier runs.'''
+
+        for path in sorted(self.files):
+            try:
+                deleteFile(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                err('Could not delete ' + path + ': ' + e.strerror)
+                continue
+
+            self.remove(path)
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+            if self.path is None:
+                return
+
+            if not self.files:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                return
+
+            tempPath = self.path + '.tmp'
+            with open(tempPath, 'w', encoding='utf-8') as f:
+                for path in sorted(self.files):
+                    f.write(json.dumps({'path': path, 'open': True}) + '\n')
+            os.replace(tempPath, self.path)
+
+journal = Journal()     # Shared by every thread
+
+class OutputMover(object):
+    '''Put complete outputs where they belong and sync them to disk as the
+    fsync policy says: not at all, every file before it's renamed into
+    place, or every album once the last of its files is finished.
+
+    With a staging folder, the encoders write there instead, on a fast local
+    disk, and a thread of its own copies the complete outputs into the output
+    folders in the order they came in. Whatever is handed to after() runs
+    once the outputs handed over before it have been moved. The encoders go
+    on meanwhile; only copying the output of a duplicate waits for it to be
+    moved, with wait(), or on the event loop with waitAsync(). Until open()
+    is called, outputs are renamed into place right away.
+
+    Output folders are only made once, and known to exist from then on.'''
+
+    def __init__(self):
+        self.stagingDirectory = None
+        self.fsync      = 'none'    # See FSYNC_POLICIES
+        self.folders    = set()     # Output folders known to exist
+        self.staged     = {}        # Staged path -> output path
+        self.moving     = set()     # Outputs in the staging folder waiting to be moved
+        self.failed     = set()     # Outputs that never made it into place
+        self.writing    = collections.Counter()     # Album -> entries not finished yet
+        self.unsynced   = {}        # Album -> outputs in place but not synced
+        self.work       = collections.deque()       # (function, args) for the thread
+        self.condition  = threading.Condition()
+        self.waiters    = AsyncWaiters()    # Coroutines waiting for a move
+        self.thread     = None
+
+    def open(self, stagingDirectory, fsync):
+        self.stagingDirectory = stagingDirectory
+        self.fsync = fsync
+
+        if stagingDirectory:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def makeDirectories(self, folder):
+        '''Make a folder and its parents, unless they're known to exist.
+        Return True if it had to look.'''
+
+        with self.condition:
+            if folder in self.folders:
+                return False
+
+        os.makedirs(folder, exist_ok=True)
+
+        with self.condition:
+            while folder not in self.folders:
+                self.folders.add(folder)
+                folder = os.path.dirname(folder)
+
+        return True
+
+    def forgetDirectories(self):
+        '''Call this after deleting output folders'''
+
+        with self.condition:
+            self.folders.clear()
+
+    def stage(self, outputPath):
+        '''Return a path in the staging folder to write outputPath under.
+        Other piggy processes may share the folder.'''
+
+        stagedPath = makePartialPath(outputPath, self.stagingDirectory)
+
+        with self.condition:
+            self.staged[stagedPath] = outputPath
+
+        return stagedPath
+
+    def isStaged(self, path):
+        with self.condition:
+            return path in self.staged
+
+    def commit(self, stagedPath, ok):
+        '''Have the thread move a staged output into place if ok, or delete
+        it otherwise. Return ok.'''
+
+        with self.condition:
+            outputPath = self.staged.pop(stagedPath)
+            if ok:
+                self.moving.add(outputPath)
+
+        if ok:
+            self.after(self.move, stagedPath, outputPath)
+            return True
+
+        try:
+            if os.path.lexists(stagedPath):
+                deleteFile(stagedPath)
+        except OSError as e:
+            err('Could not delete ' + stagedPath + ': ' + e.strerror)
+
+        journal.remove(stagedPath)
+        return False
+
+    def place(self, partialPath, outputPath):
+        '''Rename a complete output into place. Raise OSError if that, or
+        syncing it, fails.'''
+
+        folder = os.path.dirname(outputPath)
+
+        if self.fsync == 'file':
+            syncToDisk(partialPath)
+
+        os.replace(partialPath, outputPath)
+
+        if self.fsync == 'file':
+            syncToDisk(folder)
+        elif self.fsync == 'album':
+            with self.condition:
+                self.unsynced.setdefault(folder, []).append(outputPath)
+
+    def move(self, stagedPath, outputPath):
+        folder = os.path.dirname(outputPath)
+        partialPath = makePartialPath(outputPath)
+        journal.add(partialPath)
+
+        try:
+            self.makeDirectories(folder)
+            shutil.copyfile(stagedPath, partialPath)
+            self.place(partialPath, outputPath)
+            ok = True
+        except OSError as e:
+            err('Could not move ' + stagedPath + ' to ' + outputPath + ': ' + str(e))
+            ok = False
+
+        for path in [partialPath, stagedPath]:
+            try:
+                if os.path.lexists(path):
+                    deleteFile(path)
+            except OSError as e:
+                err('Could not delete ' + path + ': ' + e.strerror)
+            journal.remove(path)
+
+        with self.condition:
+            self.moving.discard(outputPath)
+            if not ok:
+                self.failed.add(outputPath)
+            self.condition.notify_all()
+            self.waiters.wake()
+
+    def wait(self, outputPath):
+        '''Block until the output is no longer on its way into place'''
+
+        with self.condition:
+            while outputPath in self.moving:
+                self.condition.wait()
+
+    async def waitAsync(self, outputPath):
+        '''wait(), for coroutines'''
+
+        while True:
+            with self.condition:
+                if outputPath not in self.moving:
+                    return
+                waiter = self.waiters.add()
+
+            await waiter
+
+    def landed(self, outputPath):
+        '''Return False if the output was staged but couldn't be moved'''
+
+        with self.condition:
+            return outputPath not in self.failed
+
+    def albums(self, entry):
+        return set(os.path.dirname(pair.outputPath)
+                    for pair in entry.encoderAndOutputPaths)
+
+    def expect(self, entry):
+        '''Count a queued entry against its albums, so that an album is
+        synced once, after the last of its files is finished'''
+
+        if self.fsync == 'album':
+            with self.condition:
+                for album in self.albums(entry):
+                    self.writing[album] += 1
+
+    def finished(self, entry):
+        if self.fsync != 'album':
+            return
+
+        done = []
+        with self.condition:
+            for album in self.albums(entry):
+                self.writing[album] -= 1
+                if self.writing[album] <= 0:
+                    del self.writing[album]
+                    done.append(album)
+
+        for album in done:
+            self.syncAlbum(album)
+
+    def syncAlbum(self, album):
+        with self.condition:
+            paths = self.unsynced.pop(album, [])
+
+        if not paths:
+            return
+
+        try:
+            for path in paths:
+                syncToDisk(path)
+            syncToDisk(album)
+        except OSError as e:
+            err('Could not sync ' + album + ' to disk: ' + e.strerror)
+
+    def after(self, function, *args):
+        '''Call function(*args) once every output handed over so far has been
+        moved; right away, without a staging folder'''
+
+        if self.thread is None:
+            function(*args)
+            return
+
+        with self.condition:
+            self.work.append((function, args))
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.work:
+                    self.condition.wait()
+                function, args = self.work.popleft()
+
+            if function is None:
+                return
+
+            function(*args)
+
+    def close(self):
+        '''Wait for the outputs that are still on their way, then sync
+        whatever the fsync policy still owes'''
+
+        if self.thread:
+            self.after(None)
+            self.thread.join()
+            self.thread = None
+
+        for album in list(self.unsynced):
+            self.syncAlbum(album)
+
+mover = OutputMover()   # Shared by every thread
+
+class Makespan(object):
+    '''Collect the estimated cost and the actual run time of every entry, so
+    that the schedule's prediction can be compared with what happened'''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.jobs       = []    # (dispatch order, alphabetical order, cost, seconds)
+        self.workers    = 0     # How many jobs can run at once
+
+    def add(self, entry, seconds):
+        with self.lock:
+            self.jobs.append((entry.number, entry.scanNumber, entry.cost(), seconds))
+
+    def predict(self, jobs, workers, secondsPerCost):
+        '''Simulate handing out jobs, in order, to whichever worker frees up
+        first and return when the last one finishes'''
+
+        finishTimes = [0.0] * workers
+        for cost in jobs:
+            heapq.heapreplace(finishTimes, finishTimes[0] + cost * secondsPerCost)
+
+        return max(finishTimes)
+
+    def report(self, actual):
+        workers = self.workers
+        totalCost = sum(job[2] for job in self.jobs)
+        totalSeconds = sum(job[3] for job in self.jobs)
+        if totalCost <= 0 or workers < 1:
+            return
+
+        # No schedule can beat this
+        lowerBound = max(totalSeconds / workers, max(job[3] for job in self.jobs))
+
+        # Calibrate the cost model against this run
+        secondsPerCost = totalSeconds / totalCost
+
+        dispatched = [job[2] for job in sorted(self.jobs)]
+        alphabetical = [job[2] for job in sorted(self.jobs, key=lambda j: j[1])]
+
+        msg('Makespan: ' + formatDuration(actual) + ' actual, ' +
+            formatDuration(self.predict(dispatched, workers, secondsPerCost)) +
+            ' predicted for this order, ' +
+            formatDuration(self.predict(alphabetical, workers, secondsPerCost)) +
+            ' predicted for alphabetical order, ' +
+            formatDuration(lowerBound) + ' lower bound')
+
+class LibraryIndex(object):
+    '''An SQLite database of what has been learned about every input file:
+    its tags, its stream info and, once somebody computes it, a hash of its
+    contents. A row is only trusted if the file's size, mtime and inode all
+    still match, so a warm scan costs a stat() per file.'''
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version != self.VERSION:
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute('PRAGMA user_version=' + str(self.VERSION))
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                            path            TEXT PRIMARY KEY,
+                            size            INTEGER,
+                            mtime_ns        INTEGER,
+                            inode           INTEGER,
+                            tags            TEXT,
+                            codec           TEXT,
+                            sample_rate     INTEGER,
+                            channels        INTEGER,
+                            bits_per_sample INTEGER,
+                            duration        REAL,
+                            hash            TEXT)''')
+        self.db.commit()
+
+    def lookup(self, audioFile, stat):
+        '''Fill in the tags and info of audioFile from the index. Return True
+        if the index knew about the file.'''
+
+        with self.lock:
+            row = self.db.execute('''SELECT tags, hash, codec, sample_rate,
+                                    channels, bits_per_sample, duration FROM files
+                                    WHERE path = ? AND size = ? AND
+                                    mtime_ns = ? AND inode = ?''',
+                                    (os.path.abspath(audioFile.path),
+                                    stat.st_size, stat.st_mtime_ns,
+                                    stat.st_ino)).fetchone()
+
+        if row is None:
+            return False
+
+        audioFile.tags = json.loads(row[0])
+        audioFile.fingerprint = row[1]
+        if row[2] is not None:
+            audioFile.info = streamInfo(*row[2:])
+        audioFile.loaded = True
+        return True
+
+    def store(self, audioFile, stat):
+        info = audioFile.info or streamInfo(None)
+
+        with self.lock:
+            self.db.execute('''INSERT OR REPLACE INTO files VALUES
+                            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (os.path.abspath(audioFile.path), stat.st_size,
+                            stat.st_mtime_ns, stat.st_ino,
+                            json.dumps(audioFile.tags)) +
+                            tuple(info[k] for k in STREAM_INFO_KEYS) +
+                            (audioFile.fingerprint,))
+
+            # Committing is what makes SQLite slow, so do it in batches
+            self.pending += 1
+            if self.pending >= INDEX_COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def storeFingerprint(self, audioFile, stat):
+        with self.lock:
+            self.db.execute('''UPDATE files SET hash = ? WHERE path = ? AND
+                            size = ? AND mtime_ns = ? AND inode = ?''',
+                            (audioFile.fingerprint, os.path.abspath(audioFile.path),
+                            stat.st_size, stat.st_mtime_ns, stat.st_ino))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class Passthrough(object):
+    '''An input an EncoderSetting can take as it is: a codec, as in the stream
+    info, and optionally limits on its other stream parameters'''
+
+    def __init__(self, codec, maxSampleRate=None, maxChannels=None,
+                    maxBitsPerSample=None):
+        self.codec              = codec
+        self.maxSampleRate      = maxSampleRate
+        self.maxChannels        = maxChannels
+        self.maxBitsPerSample   = maxBitsPerSample
+
+    def accepts(self, info):
+        if info is None or info['codec'] != self.codec:
+            return False
+
+        for key, limit in [('sampleRate', self.maxSampleRate),
+                            ('channels', self.maxChannels),
+                            ('bitsPerSample', self.maxBitsPerSample)]:
+            if limit is not None and (info[key] is None or info[key] > limit):
+                return False
+
+        return True
+
+class EncoderSetting(object):
+    def __init__(self, name, folder, extension, encoder, cost, passthrough=None):
+        self.name       = name
+        self.folder     = folder
+        self.extension  = extension
+        self.encoder    = encoder
+        self.cost       = cost      # Rough CPU time per second of audio, relative to flac
+        self.passthrough = passthrough or []    # Passthrough objects
+
+    def acceptsAsIs(self, audioFile):
+        '''Return True if transcoding the audioFile with this setting would
+        gain nothing over copying it and rewriting its tags'''
+
+        return any(p.accepts(audioFile.info) for p in self.passthrough)
+
+def findEncoderSetting(name):
+    for s in encoderSettings:
+        if s.name == name:
+            return s
+
+    return None
+
+class EncoderAndOutputPath(object):
+    def __init__(self, setting, outputPath, manifest=None, manifestKey=None):
+        self.setting        = setting
+        self.outputPath     = outputPath
+        self.encoder        = setting.encoder
+        self.manifest       = manifest      # Where to record a successful encode
+        self.manifestKey    = manifestKey
+
+class QueueEntry(object):
+    def __init__(self, number, inputAudioFile, stat=None):
+        self.number                = number
+        self.scanNumber            = number     # Position in alphabetical order
+        self.inputAudioFile        = inputAudioFile
+        self.stat                  = stat       # os.stat_result of the input at scan time
+        self.encoderAndOutputPaths = []
+        self.reserved              = 0          # Bytes of decoded audio held in the PCMBuffer
+        self.spilled               = 0          # Bytes of decoded audio in the spill folder
+        self.decodeSeconds         = 0
+        self.jobId                 = None       # Set when leased from a coordinator
+        self.device                = None       # InputDevice it's read from
+        self.estimate              = 0          # duration() when it was queued
+
+    def duration(self):
+        '''Return the length of the audio in seconds, or a guess based on the
+        size of the file if the headers don't say'''
+
+        info = self.inputAudioFile.info
+        if info and info['duration']:
+            return info['duration']
+        elif self.stat:
+            return self.stat.st_size / ASSUMED_BYTE_RATE
+        else:
+            return 0
+
+    def decodedSize(self):
+        '''Estimate how many bytes of WAVE data decoding this entry makes'''
+
+        info = self.inputAudioFile.info or {}
+        sampleRate = info.get('sampleRate') or 44100
+        channels = info.get('channels') or 2
+        bitsPerSample = info.get('bitsPerSample') or 16
+
+        return int(self.duration() * sampleRate * channels * ((bitsPerSample + 7) // 8))
+
+    def cost(self):
+        '''Estimate how long this entry takes to transcode, in seconds of
+        flac encoding. Copying a file as it is costs next to nothing.'''
+
+        return self.duration() * sum(pair.setting.cost
+                                        for pair in self.encoderAndOutputPaths
+                                        if not pair.setting.acceptsAsIs(self.inputAudioFile))
+
+    def addEncoderAndOutputPath(self, setting, outputPath, manifest=None,
+                                manifestKey=None):
+        self.encoderAndOutputPaths.append(EncoderAndOutputPath(setting,
+                                            outputPath, manifest, manifestKey))
+
+# ------------------------------------------------------------------------------
+
+class Options(object):
+    def __init__(self):
+        self.settings           = []    # EncoderSetting objects
+        self.inputDirectories   = []
+        self.outputDirectory    = ''
+        self.stream             = True  # Pipe decoders into encoders when possible
+        self.incremental        = False # Skip outputs that are up to date
+        self.resume             = False # Like incremental, and clean up after a crash
+        self.watch              = False # Keep transcoding new and changed files
+        self.prune              = False # Delete outputs whose sources are gone
+        self.indexPath          = None  # SQLite library index, if any
+        self.longestFirst       = False # Schedule the most expensive files first
+        self.decoders           = 0     # Decoder threads, or 0 for half the cores
+        self.reportPath         = None  # Where to write the JSON or CSV run report
+        self.engine             = 'threads' # See ENGINES
+        self.slots              = 0     # Child processes at once, or 0 for one per core
+        self.dedup              = False # Transcode files with the same audio only once
+        self.tempBudget         = 0     # Bytes of decoded audio in TMPDIR, or 0 for PCM_BUFFER_SIZE
+        self.spillDirectory     = None  # Where decoded audio too big for the budget goes
+        self.minSlots           = 0     # Bounds of the adaptive number of processes,
+        self.maxSlots           = 0     # or 0 to keep it fixed
+        self.shard              = None  # (K, N) to transcode only shard K of N
+        self.shardBy            = 'path' # See SHARD_METHODS
+        self.mergePath          = None  # Where to write the merged shard reports
+        self.mergeInputs        = []    # The shard reports to merge
+        self.serveAddress       = None  # Hand out the work to piggy work clients here
+        self.workAddress        = None  # Lease the work from the coordinator here
+        self.readers            = 0     # Files read at once per device, or 0 to go by the device
+        self.stagingDirectory   = None  # Where the encoders write before the outputs are moved
+        self.fsync              = 'none' # See FSYNC_POLICIES
+
+def parseCommandLine():
+    # return an Options object
+
+    # piggy.py serve ADDRESS [OPTIONS] OUTPUT hands out the work to clients,
+    # piggy.py work ADDRESS [OPTIONS] does it. ADDRESS is HOST:PORT or the
+    # path of a Unix socket. A client gets its settings and folders from the
+    # coordinator.
+
+    # Accept the following command line arguments:
+    #   -s  Encoder Setting  (at least one)
+    #   -i  Input Directory  (at least one)
+    #   -t  Decode into temporary files in TMPDIR instead of streaming
+    #   -u  Only transcode files that are new or changed since the last run
+    #   -p  Delete outputs whose source files have disappeared
+    #   -c  Cache tags and stream info in this SQLite database
+    #   -l  Transcode the longest files first instead of in alphabetical order
+    #   -d  Number of decoder threads
+    #   -r  Write a report of where the time went to this .json or .csv file
+    #   -e  Execution engine: threads, processes or asyncio
+    #   -j  Number of child processes to run at once, or MIN:MAX to adapt
+    #       the number to the load
+    #   -b  Budget for decoded audio in TMPDIR, like 512M or 4G
+    #   -m  Transcode files with the same audio once and copy the outputs
+    #   -x  Spill folder for decoded files that are bigger than the budget
+    #   --shard K/N     Transcode only the Kth of N disjoint parts of the library
+    #   --shard-by      Split the library by path hash or by duration
+    #   --merge OUTPUT  Merge the JSON reports of the shards given as arguments
+    #   --resume        Pick up where an interrupted run left off
+    #   --watch         After the scan, keep transcoding new and changed files
+    #   --readers N     Read at most N files at once from every input device
+    #   --stage DIR     Write the outputs in this folder and move them in the background
+    #   --fsync POLICY  Sync outputs to disk: none, every file or every album
+    #       Output Directory (exactly one)
+
+    options             = Options()
+    settings            = options.settings
+    inputDirectories    = options.inputDirectories
+
+    args = sys.argv[1:]
+    if args[:1] == ['serve'] or args[:1] == ['work']:
+        if len(args) < 2:
+            err('You must specify the address to ' + args[0] + ' on')
+            sys.exit(EXIT_CMDFAILURE)
+
+        if args[0] == 'serve':
+            options.serveAddress = args[1]
+        else:
+            options.workAddress = args[1]
+        args = args[2:]
+
+    try:
+        opts, args = getopt.getopt(args, 's:i:tupc:ld:r:e:j:b:x:m',
+                                    ['shard=', 'shard-by=', 'merge=', 'resume',
+                                    'watch', 'readers=', 'stage=', 'fsync='])
+    except getopt.GetoptError as e:
+        err(e)
+        sys.exit(EXIT_CMDFAILURE)
+
+    for opt, arg in opts:
+        if opt == '--merge':
+            if len(args) < 1:
+                err('You must specify at least one report to merge')
+                sys.exit(EXIT_CMDFAILURE)
+
+            options.mergePath = arg
+            options.mergeInputs = args
+            return options
+
+    if options.workAddress:
+        if args or any(opt in ['-s', '-i'] for opt, arg in opts):
+            err('A worker gets its settings and folders from the coordinator')
+            sys.exit(EXIT_CMDFAILURE)
+    elif len(args) != 1:
+        err('You must specify exactly one output directory')
+        sys.exit(EXIT_CMDFAILURE)
+    else:
+        options.outputDirectory = os.path.normpath(args[0])
+
+    for opt, arg in opts:
+        if opt == '-s':
+            setting = findEncoderSetting(arg)
+
+            if setting:
+                if settings.count(setting) > 0:
+                    err('Encoder setting "' + arg + '" was specified more than once')
+                    sys.exit(EXIT_CMDFAILURE)
+                else:
+                    settings.append(setting)
+            else:
+                err('Encoder setting "' + arg + '" does not exist')
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-i':
+            dir = os.path.normpath(arg)
+            if os.path.isdir(dir):
+                for d in inputDirectories:
+                    if os.path.basename(d) == os.path.basename(dir):
+                        err('WARNING: Duplicate basenames in input directories: ' + os.path.basename(dir))
+                inputDirectories.append(dir)
+            else:
+                err('Not a directory: ' + dir)
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-t':
+            options.stream = False
+        elif opt == '-u':
+            options.incremental = True
+        elif opt == '--resume':
+            options.incremental = True
+            options.resume = True
+        elif opt == '--watch':
+            options.incremental = True
+            options.watch = True
+        elif opt == '-p':
+            options.prune = True
+        elif opt == '-c':
+            options.indexPath = arg
+        elif opt == '-l':
+            options.longestFirst = True
+        elif opt == '-d':
+            try:
+                options.decoders = int(arg)
+            except ValueError:
+                options.decoders = 0
+
+            if options.decoders < 1:
+                err('The number of decoders must be a positive integer')
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-r':
+            options.reportPath = arg
+        elif opt == '-e':
+            if arg in ENGINES:
+                options.engine = arg
+            else:
+                err('Engine "' + arg + '" does not exist; pick one of ' +
+                    ', '.join(sorted(ENGINES)))
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-m':
+            options.dedup = True
+        elif opt == '-b':
+            options.tempBudget = parseSize(arg)
+
+            if options.tempBudget < 1:
+                err('The budget must be a positive size, like 512M or 4G')
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-x':
+            if os.path.isdir(arg):
+                options.spillDirectory = os.path.normpath(arg)
+            else:
+                err('Not a directory: ' + arg)
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '-j':
+            try:
+                bounds = [int(n) for n in arg.split(':')]
+            except ValueError:
+                bounds = [0]
+
+            if len(bounds) > 2 or min(bounds) < 1 or bounds != sorted(bounds):
+                err('The number of processes must be a positive integer or MIN:MAX')
+                sys.exit(EXIT_CMDFAILURE)
+
+            if len(bounds) == 2:
+                options.slots = 0
+                options.minSlots, options.maxSlots = bounds
+            else:
+                options.slots = bounds[0]
+                options.minSlots = options.maxSlots = 0
+        elif opt == '--shard':
+            match = re.fullmatch(r'(\d+)/(\d+)', arg)
+
+            if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+                err('The shard must be K/N, with 1 <= K <= N')
+                sys.exit(EXIT_CMDFAILURE)
+
+            options.shard = (int(match.group(1)), int(match.group(2)))
+        elif opt == '--readers':
+            try:
+                options.readers = int(arg)
+            except ValueError:
+                options.readers = 0
+
+            if options.readers < 1:
+                err('The number of readers must be a positive integer')
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '--stage':
+            if os.path.isdir(arg):
+                options.stagingDirectory = os.path.normpath(arg)
+            else:
+                err('Not a directory: ' + arg)
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '--fsync':
+            if arg in FSYNC_POLICIES:
+                options.fsync = arg
+            else:
+                err('Fsync policy "' + arg + '" does not exist; pick one of ' +
+                    ', '.join(FSYNC_POLICIES))
+                sys.exit(EXIT_CMDFAILURE)
+        elif opt == '--shard-by':
+            if arg in SHARD_METHODS:
+                options.shardBy = arg
+            else:
+                err('Cannot shard by "' + arg + '"; pick one of ' +
+                    ', '.join(SHARD_METHODS))
+                sys.exit(EXIT_CMDFAILURE)
+
+    if options.workAddress:
+        return options
+
+    if options.watch and (options.serveAddress or options.shardBy == 'duration'):
+        err('Watching does not work with serve or with --shard-by duration')
+        sys.exit(EXIT_CMDFAILURE)
+
+    if len(settings) < 1:
+        err('You must specify at least one encoder setting')
+        sys.exit(EXIT_CMDFAILURE)
+
+    if len(inputDirectories) < 1:
+        err('You must specify at least one input folder')
+        sys.exit(EXIT_CMDFAILURE)
+
+    return options
+
+def scanDirectory(path):
+    '''Yield a DirEntry for every file under a directory, in sorted order'''
+
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        err('Could not read directory ' + path + ': ' + e.strerror)
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scanDirectory(entry.path)
+        elif entry.is_dir():
+            dbg('Not following symlink ' + entry.path)
+        elif entry.name.startswith('.'):
+            # Skip every hidden file
+            dbg('Ignoring file ' + entry.path)
+        else:
+            yield entry
+
+def shardSuffix(shard):
+    '''Return what to append to the name of a file that every shard keeps
+    its own copy of'''
+
+    if shard:
+        return '.shard-%d-of-%d' % shard
+    else:
+        return ''
+
+def shardOf(key, shards):
+    '''Return which of the shards, counting from 1, a manifest key belongs to.
+    The hash doesn't depend on the machine or on PYTHONHASHSEED.'''
+
+    digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards + 1
+
+def balanceShards(candidates, shards):
+    '''Assign (manifestKey, QueueEntry) pairs to shards so that every shard
+    gets about the same amount of audio: the longest file goes to the shard
+    with the least so far. Return the set of keys for every shard.'''
+
+    loads = [(0.0, shard) for shard in range(1, shards + 1)]
+    keys = dict((shard, set()) for shard in range(1, shards + 1))
+
+    for key, queueEntry in sorted(candidates,
+                                    key=lambda c: (-c[1].duration(), c[0])):
+        load, shard = heapq.heappop(loads)
+        keys[shard].add(key)
+        heapq.heappush(loads, (load + queueEntry.duration(), shard))
+
+    return keys
+
+def makeManifestKey(rootPath, filePath):
+    '''Return the path of filePath's outputs relative to a setting's folder,
+    without the extension. It starts with the name of the input folder.'''
+
+    # Add a trailing slash to the rootPath
+    rootStr = os.path.join(rootPath, '')
+    rootName = os.path.basename(rootPath)
+
+    relativeFilePath = filePath.split(rootStr, 1)[1]
+    relativeFilePathWithoutExtension = os.path.splitext(relativeFilePath)[0]
+    return os.path.join(rootName, relativeFilePathWithoutExtension)
+
+def isInShard(manifestKey, options):
+    '''Return False if the key belongs to another shard. Sharding by duration
+    has to wait for the whole scan, so this lets everything through.'''
+
+    return not options.shard or options.shardBy != 'path' or \
+            shardOf(manifestKey, options.shard[1]) == options.shard[0]
+
+def makeQueueEntry(audioFile, stat, manifestKey, options, manifests, index):
+    '''Return a QueueEntry with a pair for every setting whose output isn't
+    up to date. Its number is up to the caller.'''
+
+    queueEntry = QueueEntry(0, audioFile, stat)
+
+    if index:
+        index.lookup(audioFile, stat)
+
+    for setting in options.settings:
+        outputPath = os.path.join(options.outputDirectory, setting.folder,
+                                    manifestKey)
+        manifest = manifests[setting.name]
+
+        # Outputs only ever appear complete, so a resumed run can take the
+        # manifest's word for it
+        if options.incremental and manifest.isUpToDate(
+                manifestKey, stat, setting.encoder.opts,
+                None if options.resume else outputPath + '.' + setting.extension):
+            continue
+
+        queueEntry.addEncoderAndOutputPath(setting, outputPath, manifest,
+                                            manifestKey)
+
+    return queueEntry
+
+def populateQueue(inputQueue, options, scan, manifests, index):
+    '''Scan the input directories and put a QueueEntry for every audio file
+    into the queue. The queue is bounded, so this blocks whenever the workers
+    fall behind.
+
+    When scheduling the longest files first, nothing is queued until the
+    whole scan is done, since any file might turn out to be the longest.
+    The same goes for sharding by duration.'''
+
+    pending = []
+    candidates = []     # (manifestKey, QueueEntry) pairs to shard by duration
+
+    def admit(queueEntry):
+        if not queueEntry.encoderAndOutputPaths:
+            dbg('Up to date: ' + queueEntry.inputAudioFile.path)
+            scan.skipped += 1
+            return
+
+        queueEntry.number = queueEntry.scanNumber = scan.count + 1
+        scan.count += 1
+
+        if options.longestFirst:
+            # Estimating the cost needs the duration
+            if queueEntry.inputAudioFile.info is None:
+                queueEntry.inputAudioFile.loadInfo()
+            pending.append(queueEntry)
+        else:
+            inputQueue.put(queueEntry)
+
+    for rootPath in options.inputDirectories:
+        # Clean up the root path (and remove the trailing slash)
+        rootPath = os.path.normpath(rootPath)
+
+        for dirEntry in scanDirectory(rootPath):
+            filePath = dirEntry.path
+            audioFile = makeAudioFile(filePath)
+            if audioFile:
+                manifestKey = makeManifestKey(rootPath, filePath)
+
+                # Every shard sees every file, so that pruning still works
+                for setting in options.settings:
+                    manifests[setting.name].see(manifestKey)
+
+                if not isInShard(manifestKey, options):
+                    continue
+
+                queueEntry = makeQueueEntry(audioFile, dirEntry.stat(),
+                                            manifestKey, options, manifests,
+                                            index)
+
+                if options.shard and options.shardBy == 'duration':
+                    # Up to date or not, every file counts towards the
+                    # balance, or the shards would disagree about it
+                    if audioFile.info is None:
+                        audioFile.loadInfo()
+                    candidates.append((manifestKey, queueEntry))
+                else:
+                    admit(queueEntry)
+            else:
+#               TODO: It might be a good idea to keep track of these and dump
+#               them when transcoding has finished
+                err('Could not make an AudioFile out of ' + filePath)
+
+    if candidates:
+        keys = balanceShards(candidates, options.shard[1])[options.shard[0]]
+        for manifestKey, queueEntry in candidates:
+            if manifestKey in keys:
+                admit(queueEntry)
+
+    if pending:
+        pending.sort(key=lambda e: e.cost(), reverse=True)
+        msg('Scheduled ' + str(len(pending)) + ' files with ' +
+            formatDuration(sum(e.duration() for e in pending)) + ' of audio, ' +
+            'the longest first')
+
+        for number, queueEntry in enumerate(pending, 1):
+            queueEntry.number = number
+            inputQueue.put(queueEntry)
+
+    scan.done = True
+
+def pruneOutputs(options, manifests):
+    '''Delete the outputs whose source files weren't found by this run'''
+
+    rootNames = set(os.path.basename(os.path.normpath(d))
+                    for d in options.inputDirectories)
+
+    for setting in options.settings:
+        manifest = manifests[setting.name]
+
+        for key in manifest.unseen(rootNames):
+            outputPath = os.path.join(manifest.folder, key) + '.' + setting.extension
+            msg('Pruning ' + outputPath)
+
+            try:
+                deleteFile(outputPath)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                err('Could not delete "' + outputPath + '": ' + e.strerror)
+                continue
+
+            manifest.forget(key)
+
+            # Clean up the directories that are now empty
+            try:
+                os.removedirs(os.path.dirname(outputPath))
+            except OSError:
+                pass
+            mover.forgetDirectories()
+
+class InotifyWatcher(object):
+    '''Report the files under some folders that may have changed, as Linux's
+    inotify tells about them. Every folder needs its own watch, so new
+    folders are watched as they turn up.'''
+
+    def __init__(self, roots):
+        self.libc       = ctypes.CDLL(None, use_errno=True)
+        self.fd         = self.libc.inotify_init1(os.O_CLOEXEC)
+        self.folders    = {}        # Watch descriptor -> folder
+
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        for root in roots:
+            self.watchTree(root)
+
+    def watchTree(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), INOTIFY_MASK)
+        if wd < 0:
+            err('Could not watch ' + folder + ': ' + os.strerror(ctypes.get_errno()))
+            return
+
+        self.folders[wd] = folder
+
+        try:
+            with os.scandir(folder) as it:
+                folders = [e.path for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+
+        for f in folders:
+            self.watchTree(f)
+
+    def poll(self, stop):
+        '''Wait a little and return the paths of the files that changed'''
+
+        ready = select.select([self.fd], [], [], WATCH_TICK)[0]
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events got lost, so anything may have changed
+                err('Too many changes at once; looking at every file')
+                paths += [e.path for root in self.folders.values()
+                            for e in scanDirectory(root)]
+                continue
+
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            elif mask & IN_IGNORED:
+                del self.folders[wd]    # The folder is gone
+                continue
+
+            path = os.path.join(folder, name)
+            if not mask & IN_ISDIR:
+                paths.append(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # Whatever is in there already won't make any events
+                self.watchTree(path)
+                paths += [e.path for e in scanDirectory(path)]
+
+        return paths
+
+class PollingWatcher(object):
+    '''Report the files under some folders that changed since the last
+    poll, by looking at all of them. For when inotify isn't there.'''
+
+    def __init__(self, roots):
+        self.roots      = roots
+        self.files      = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+
+        for root in self.roots:
+            for dirEntry in scanDirectory(root):
+                try:
+                    stat = dirEntry.stat()
+                except OSError:
+                    continue
+                files[dirEntry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        return files
+
+    def poll(self, stop):
+        if stop.wait(WATCH_POLL_INTERVAL):
+            return []
+
+        files = self.snapshot()
+        paths = [path for path, signature in files.items()
+                    if self.files.get(path) != signature]
+        self.files = files
+
+        return paths
+
+def startWatching(options):
+    '''Start keeping track of changes to the input directories. Do this
+    before the first scan, so that nothing that changes during it is missed.'''
+
+    roots = [os.path.normpath(d) for d in options.inputDirectories]
+
+    try:
+        return InotifyWatcher(roots)
+    except (AttributeError, OSError) as e:
+        err('Could not use inotify (' + str(e) + '); looking for changes every ' +
+            str(WATCH_POLL_INTERVAL) + ' seconds instead')
+        return PollingWatcher(roots)
+
+def watchDirectories(watcher, inputQueue, options, scan, manifests, index,
+                        isInFlight, stop):
+    '''Queue the audio files that show up or change in the input
+    directories until stop is set, as the watcher from startWatching()
+    reports them. A file is only queued once it has been left alone for a
+    while, so that half-copied files are left alone too.
+
+    A file that changes while isInFlight(path) says it's still being
+    transcoded isn't queued a second time. It's looked at again once that's
+    done, and queued then if it's still out of date.'''
+
+    roots = [os.path.normpath(d) for d in options.inputDirectories]
+
+    msg('Watching the input folders for new and changed files')
+
+    settling = {}       # Path -> (size and mtime, when it last changed)
+    waiting = set()     # Paths that changed while they were in flight
+
+    while not stop.is_set():
+        now = time.monotonic()
+        for path in watcher.poll(stop):
+            if not os.path.basename(path).startswith('.'):
+                settling[path] = (None, now)
+
+        for path in list(waiting):
+            if not isInFlight(path):
+                waiting.discard(path)
+                settling.setdefault(path, (None, now))
+
+        for path, (signature, since) in list(settling.items()):
+            if now - since < WATCH_SETTLE:
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del settling[path]      # Gone already
+                continue
+
+            # Still being written, or not looked at yet
+            if (stat.st_size, stat.st_mtime_ns) != signature:
+                settling[path] = ((stat.st_size, stat.st_mtime_ns), now)
+                continue
+
+            del settling[path]
+            if isInFlight(path):
+                dbg('Still transcoding ' + path + '; looking at it again after that')
+                waiting.add(path)
+                continue
+
+            rootPath = max((r for r in roots if path.startswith(os.path.join(r, ''))),
+                            key=len, default=None)
+            audioFile = makeAudioFile(path)
+            if rootPath is None or audioFile is None:
+                continue
+
+            manifestKey = makeManifestKey(rootPath, path)
+            for setting in options.settings:
+                manifests[setting.name].see(manifestKey)
+
+            if not isInShard(manifestKey, options):
+                continue
+
+            queueEntry = makeQueueEntry(audioFile, stat, manifestKey, options,
+                                        manifests, index)
+            if queueEntry.encoderAndOutputPaths:
+                queueEntry.number = queueEntry.scanNumber = scan.count + 1
+                scan.count += 1
+                inputQueue.put(queueEntry)
+            else:
+                dbg('Up to date: ' + path)
+
+    msg('Stopped watching; finishing the files that are already queued')
+
+def stopWatchingOnSignals(stop):
+    '''Make the first SIGINT or SIGTERM set stop, so that piggy finishes
+    what's queued and exits. A second SIGINT interrupts piggy as usual.'''
+
+    def handler(signum, frame):
+        stop.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+def dumpShitList(shitList):
+    '''Print the paths of the files that could not be transcoded and return
+    them'''
+
+    paths = []
+
+    while True:
+        try:
+            paths.append(shitList.get(block=False).inputAudioFile.path)
+        except queue.Empty:
+            break
+
+    dumpFailures(paths)
+    return paths
+
+def dumpFailures(paths):
+    if paths:
+        err('The following ' + str(len(paths)) + ' files could not be transcoded:')
+
+        for path in paths:
+            err('  ' + path)
+
+def mergeReports(outputPath, reportPaths):
+    '''Combine the JSON reports of the shards of one run into one report, as
+    if a single machine had done all the work'''
+
+    merged = {
+        'wallSeconds':  0.0,
+        'slots':        0,
+        'shards':       [],
+        'failures':     [],
+        'scan':         {'files': 0, 'skipped': 0, 'seconds': 0.0},
+        'stages':       {},
+        'settings':     {},
+        'devices':      {},
+        'files':        {},
+    }
+
+    for path in reportPaths:
+        try:
+            with open(path) as f:
+                report = json.load(f)
+        except (OSError, ValueError) as e:
+            err('Could not read the report ' + path + ': ' + str(e))
+            sys.exit(EXIT_FAILURE)
+
+        # The shards run side by side
+        merged['wallSeconds'] = max(merged['wallSeconds'], report['wallSeconds'])
+        merged['slots'] += report['slots']
+        merged['shards'].append(report.get('shard'))
+        merged['failures'].extend(report.get('failures', []))
+
+        scan = report.get('scan', {})
+        merged['scan']['files'] += scan.get('files', 0)
+        merged['scan']['skipped'] += scan.get('skipped', 0)
+        merged['scan']['seconds'] = max(merged['scan']['seconds'],
+                                        scan.get('seconds', 0.0))
+
+        for section in ['stages', 'settings', 'devices', 'files']:
+            for key, totals in report.get(section, {}).items():
+                into = merged[section].setdefault(key,
+                                                    StageTotals().asDict())
+                for field in StageTotals.FIELDS:
+                    if field == 'maxRssKiB':
+                        into[field] = max(into[field], totals.get(field, 0))
+                    else:
+                        into[field] += totals.get(field, 0)
+
+    shards = [tuple(s) for s in merged['shards'] if s]
+    if shards and len(set(shards)) != len(shards):
+        err('WARNING: The same shard was merged more than once')
+    if shards and len(shards) != shards[0][1]:
+        err('WARNING: Merged ' + str(len(shards)) + ' of ' +
+            str(shards[0][1]) + ' shards')
+
+    with open(outputPath, 'w') as f:
+        json.dump(merged, f, indent=2, sort_keys=True)
+
+    msg('Merged ' + str(len(reportPaths)) + ' reports of ' +
+        str(merged['scan']['files']) + ' files into ' + outputPath)
+    dumpFailures(merged['failures'])
+
+# ------------------------------------------------------------------------------
+
+def needsDecoding(entry, stream, slots):
+    '''Return True if at least one of the encoders of this entry has to read
+    the decoded audio from a file, or if there are more encoders than can run
+    at once. In the latter case, decoding into a file once beats streaming a
+    fresh decode into every batch.'''
+
+    pairs = [pair for pair in entry.encoderAndOutputPaths
+                if not pair.setting.acceptsAsIs(entry.inputAudioFile)]
+
+    if not pairs:
+        return False
+
+    if not stream or entry.inputAudioFile.streamCommand() is None:
+        return True
+
+    if len(pairs) > slots.size:
+        return True
+
+    for pair in pairs:
+        if not pair.encoder.readsStdin:
+            return True
+
+    return False
+
+def encodeConcurrently(audioFile, pairs):
+    '''Run the encoders of all the pairs at the same time. If audioFile has
+    been decoded into a temporary file, every encoder reads that file.
+    Otherwise, a single decoder streams into all of the encoders at once.
+
+    The caller must hold one process slot per pair. Return the list of pairs
+    whose encoders failed.'''
+
+    tags = audioFile.tags
+    outputPaths = [startOutput(pair.outputPath + '.' + pair.encoder.extension)
+                    for pair in pairs]
+    records = [StageRecord(audioFile.path, 'encode', pair.setting.name) for pair in pairs]
+    processes = []
+    decoder = None
+    decoderRecord = None
+    bytesStreamed = 0
+
+    if audioFile.decodedAudioFile or isinstance(audioFile, PCMAudioFile):
+        inputPath = audioFile.decode().path
+        bytesStreamed = os.path.getsize(inputPath)
+
+        for pair, outputPath, record in zip(pairs, outputPaths, records):
+            processes.append(startProcess(pair.encoder.command(inputPath,
+                                            outputPath, tags), record=record))
+    else:
+        decoderRecord = StageRecord(audioFile.path, 'decode')
+        decoderRecord.bytesIn = os.path.getsize(audioFile.path)
+        readEnd, writeEnd = os.pipe()
+        decoder = startProcess(audioFile.streamCommand(), stdout=writeEnd,
+                                record=decoderRecord)
+        os.close(writeEnd)
+
+        if len(pairs) == 1:
+            # Nothing to fan out to; let the encoder read the decoder's pipe
+            # directly. That way there's no telling how many bytes went
+            # through it, though.
+            processes.append(startProcess(pairs[0].encoder.command('-',
+                                            outputPaths[0], tags),
+                                            stdin=readEnd, record=records[0]))
+            os.close(readEnd)
+        else:
+            sinks = []
+            for pair, outputPath, record in zip(pairs, outputPaths, records):
+                sinkReadEnd, sinkWriteEnd = os.pipe()
+                processes.append(startProcess(pair.encoder.command('-',
+                                            outputPath, tags),
+                                            stdin=sinkReadEnd, record=record))
+                os.close(sinkReadEnd)
+                sinks.append(sinkWriteEnd)
+
+            bytesStreamed = tee(readEnd, sinks)
+
+    exitCodes = [p.wait() for p in processes]
+    decoderExitCode = decoder.wait() if decoder else 0
+
+    if decoderRecord:
+        decoderRecord.ok = decoderExitCode == 0
+        decoderRecord.wallNs = decoder.elapsedNs
+        decoderRecord.bytesOut = bytesStreamed
+        stats.add(decoderRecord)
+
+    failed = []
+    for pair, outputPath, exitCode, record, p in zip(pairs, outputPaths,
+                                                    exitCodes, records, processes):
+        record.ok = exitCode == 0
+        record.wallNs = p.elapsedNs
+        record.bytesIn = bytesStreamed
+        try:
+            record.bytesOut = os.path.getsize(outputPath)
+        except OSError:
+            pass
+        stats.add(record)
+
+        encodedAudioFile = pair.encoder.finish(audioFile, outputPath,
+                                                decoderExitCode or exitCode)
+        if not commitOutput(outputPath, encodedAudioFile is not None):
+            failed.append(pair)
+
+    return failed
+
+async def encodeConcurrentlyAsync(audioFile, pairs):
+    '''encodeConcurrently(), for the asyncio engine. The caller must hold one
+    AsyncProcessSlots slot per pair.'''
+
+    tags = audioFile.tags
+    outputPaths = [startOutput(pair.outputPath + '.' + pair.encoder.extension)
+                    for pair in pairs]
+    records = [StageRecord(audioFile.path, 'encode', pair.setting.name) for pair in pairs]
+    processes = []
+    decoder = None
+    decoderRecord = None
+    bytesStreamed = 0
+
+    if audioFile.decodedAudioFile or isinstance(audioFile, PCMAudioFile):
+        inputPath = audioFile.decode().path
+        bytesStreamed = os.path.getsize(inputPath)
+
+        for pair, outputPath, record in zip(pairs, outputPaths, records):
+            processes.append(await startProcessAsync(pair.encoder.command(
+                                inputPath, outputPath, tags), record=record))
+    else:
+        decoderRecord = StageRecord(audioFile.path, 'decode')
+        decoderRecord.bytesIn = os.path.getsize(audioFile.path)
+
+        if len(pairs) == 1:
+            readEnd, writeEnd = os.pipe()
+            decoder = await startProcessAsync(audioFile.streamCommand(),
+                                stdout=writeEnd, record=decoderRecord)
+            os.close(writeEnd)
+            processes.append(await startProcessAsync(pairs[0].encoder.command(
+                                '-', outputPaths[0], tags), stdin=readEnd,
+                                record=records[0]))
+            os.close(readEnd)
+        else:
+            decoder = await startProcessAsync(audioFile.streamCommand(),
+                                stdout=asyncio.subprocess.PIPE,
+                                record=decoderRecord)
+            for pair, outputPath, record in zip(pairs, outputPaths, records):
+                processes.append(await startProcessAsync(pair.encoder.command(
+                                '-', outputPath, tags),
+                                stdin=asyncio.subprocess.PIPE, record=record))
+
+            if decoder.process:
+                bytesStreamed = await teeAsync(decoder.process.stdout,
+                                    [p.process.stdin for p in processes if p.process])
+            else:
+                for p in processes:
+                    if p.process:
+                        p.process.stdin.close()
+
+    exitCodes = [await p.wait() for p in processes]
+    decoderExitCode = await decoder.wait() if decoder else 0
+
+    if decoderRecord:
+        decoderRecord.ok = decoderExitCode == 0
+        decoderRecord.wallNs = decoder.elapsedNs
+        decoderRecord.bytesOut = bytesStreamed
+        stats.add(decoderRecord)
+
+    loop = asyncio.get_running_loop()
+    failed = []
+    for pair, outputPath, exitCode, record, p in zip(pairs, outputPaths,
+                                                    exitCodes, records, processes):
+        record.ok = exitCode == 0
+        record.wallNs = p.elapsedNs
+        record.bytesIn = bytesStreamed
+        try:
+            record.bytesOut = os.path.getsize(outputPath)
+        except OSError:
+            pass
+        stats.add(record)
+
+        # Some encoders run a tagger when they finish
+        encodedAudioFile = await loop.run_in_executor(None, pair.encoder.finish,
+                                audioFile, outputPath, decoderExitCode or exitCode)
+        if not commitOutput(outputPath, encodedAudioFile is not None):
+            failed.append(pair)
+
+    return failed
+
+def readTagsAndInfo(path, audioFileClass):
+    '''Return the tags and the stream info of the file at path, which
+    identifyAudioFile() found to be an audioFileClass. This runs in the
+    worker processes of the process pool engine.'''
+
+    if not (os.path.isfile(path) and os.access(path, os.R_OK)):
+        return {}, None
+
+    audioFile = audioFileClass(path)
+    audioFile.load()
+    return audioFile.tags, audioFile.info
+
+class DuplicateClaim(object):
+    def __init__(self, entry, pair):
+        self.entry      = entry     # The QueueEntry that transcodes the pair
+        self.outputPath = pair.outputPath + '.' + pair.encoder.extension
+        self.ok         = False     # Whether the transcode worked
+        self.done       = threading.Event()
+        self.waiters    = AsyncWaiters()
+
+class Deduplicator(object):
+    '''Transcode the audio of files that have the same fingerprint only once
+    per encoder setting. The first entry to claim a fingerprint and setting
+    transcodes it; the others wait for that and copy the output.
+
+    An entry claims all of its settings at once, so if two entries share
+    several of them, one owns them all and neither waits for the other.'''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.claims     = {}        # (fingerprint, setting name) -> DuplicateClaim
+
+    def key(self, entry, pair):
+        return entry.inputAudioFile.fingerprint, pair.setting.name
+
+    def claim(self, entry, pairs):
+        '''Split the pairs of the entry into the ones it has to transcode
+        and (pair, claim) tuples for the ones another entry transcodes'''
+
+        if entry.inputAudioFile.fingerprint is None:
+            return pairs, []
+
+        owned = []
+        duplicates = []
+
+        with self.lock:
+            for pair in pairs:
+                claim = self.claims.get(self.key(entry, pair))
+                if claim is None:
+                    self.claims[self.key(entry, pair)] = DuplicateClaim(entry, pair)
+                    owned.append(pair)
+                elif claim.outputPath == pair.outputPath + '.' + pair.encoder.extension:
+                    owned.append(pair)      # The very same file, found twice
+                else:
+                    duplicates.append((pair, claim))
+
+        return owned, duplicates
+
+    def publish(self, entry, pairs, failedPairs):
+        '''Let whoever waits for the pairs of the entry know how they went'''
+
+        for pair in pairs:
+            with self.lock:
+                claim = self.claims.get(self.key(entry, pair))
+
+                if claim and claim.entry is entry and not claim.done.is_set():
+                    claim.ok = pair not in failedPairs
+                    claim.done.set()
+                    claim.waiters.wake()
+
+    async def waitAsync(self, claim):
+        '''claim.done.wait(), for coroutines'''
+
+        while True:
+            with self.lock:
+                if claim.done.is_set():
+                    return
+                waiter = claim.waiters.add()
+
+            await waiter
+
+    def abandon(self, entry):
+        '''Fail whatever the entry claimed and never got to'''
+
+        self.publish(entry, entry.encoderAndOutputPaths, entry.encoderAndOutputPaths)
+
+class InputDevice(object):
+    '''A device that input files live on, and how many of them may be read
+    from it at once'''
+
+    def __init__(self, dev, mounts, readers=0):
+        number = str(os.major(dev)) + ':' + str(os.minor(dev))
+        mountPoint, fsType, source = mounts.get(number, (None, None, ''))
+
+        self.name       = source + ' on ' + mountPoint if mountPoint else number
+        self.kind       = deviceKind(dev, fsType, source)
+        self.reading    = 0
+
+        if readers:
+            self.limit = readers
+        elif self.kind == 'rotational':
+            self.limit = ROTATIONAL_READERS
+        elif self.kind == 'network':
+            self.limit = NETWORK_READERS
+        else:
+            self.limit = None       # No limit
+
+    def hasRoom(self):
+        return self.limit is None or self.reading < self.limit
+
+class InputQueue(object):
+    '''Hand the scanned entries over to the readers, grouped by the device
+    they are on. The entries of one device come out in the order they went
+    in, which keeps the files of a folder together, and the devices take
+    turns. An entry is only handed out while its device has room for another
+    reader, so that a busy disk doesn't hold up the others, and it keeps its
+    reader until done() is called.'''
+
+    def __init__(self, maxEntries, readers=0):
+        self.maxEntries = maxEntries
+        self.readers    = readers   # Per device, or 0 to go by the device
+        self.entries    = collections.OrderedDict()     # InputDevice -> deque
+        self.devices    = {}        # st_dev -> InputDevice
+        self.mounts     = None
+        self.count      = 0
+        self.closed     = False
+        self.condition  = threading.Condition()
+
+    def device(self, entry):
+        dev = entry.stat.st_dev if entry.stat else 0
+
+        if dev not in self.devices:
+            if self.mounts is None:
+                self.mounts = readMountInfo()
+
+            device = self.devices[dev] = InputDevice(dev, self.mounts, self.readers)
+            if device.limit:
+                msg('Reading ' + str(device.limit) + ' file' +
+                    ('s' if device.limit > 1 else '') + ' at a time from ' +
+                    device.name + ' (' + device.kind + ')')
+
+        return self.devices[dev]
+
+    def put(self, entry):
+        with self.condition:
+            entry.device = self.device(entry)
+            while self.count >= self.maxEntries:
+                self.condition.wait()
+            self.entries.setdefault(entry.device, collections.deque()).append(entry)
+            self.count += 1
+            self.condition.notify_all()
+
+    def close(self):
+        '''Let get() return None once the entries run out'''
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while True:
+                for device, entries in self.entries.items():
+                    if entries and device.hasRoom():
+                        # The other devices go first next time
+                        self.entries.move_to_end(device)
+                        device.reading += 1
+                        self.count -= 1
+                        self.condition.notify_all()
+                        return entries.popleft()
+
+                if self.closed and not self.count:
+                    return None
+
+                self.condition.wait()
+
+    def done(self, entry):
+        with self.condition:
+            entry.device.reading -= 1
+            self.condition.notify_all()
+
+class PCMBuffer(object):
+    '''Hand entries from the decoders over to the encoders. The buffer is
+    bounded both by the number of entries waiting in it and by the bytes of
+    decoded audio in TMPDIR, which stay accounted for until the encoders are
+    done with them.'''
+
+    def __init__(self, maxEntries, maxBytes):
+        self.entries    = collections.deque()
+        self.maxEntries = maxEntries
+        self.maxBytes   = maxBytes
+        self.bytes      = 0
+        self.spilled    = 0         # Bytes in the spill folder, which has no budget
+        self.condition  = threading.Condition()
+        self.waiters    = AsyncWaiters()    # Coroutines waiting for room
+
+    def fits(self, size):
+        # A file that is too big for the whole buffer still gets in once the
+        # buffer is empty
+        return self.bytes == 0 or self.bytes + size <= self.maxBytes
+
+    def reserve(self, size):
+        '''Block until size more bytes of decoded audio fit'''
+
+        with self.condition:
+            while not self.fits(size):
+                self.condition.wait()
+            self.bytes += size
+
+    async def reserveAsync(self, size):
+        '''reserve(), for coroutines. The wait happens on the event loop, not
+        in one of its executor threads, which the entries holding the room may
+        need in order to finish and give it back.'''
+
+        while True:
+            with self.condition:
+                if self.fits(size):
+                    self.bytes += size
+                    return
+                waiter = self.waiters.add()
+
+            await waiter
+
+    def release(self, size):
+        with self.condition:
+            self.bytes -= size
+            self.condition.notify_all()
+            self.waiters.wake()
+
+    def spill(self, size):
+        with self.condition:
+            self.spilled += size
+
+    def usage(self):
+        s = formatBytes(self.bytes) + ' of ' + formatBytes(self.maxBytes) + ' in ' + TMPDIR
+        if self.spilled:
+            s += ', ' + formatBytes(self.spilled) + ' spilled'
+        return s
+
+    def put(self, entry):
+        with self.condition:
+            while entry is not None and len(self.entries) >= self.maxEntries:
+                self.condition.wait()
+            self.entries.append(entry)
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.entries:
+                self.condition.wait()
+            entry = self.entries.popleft()
+            self.condition.notify_all()
+            return entry
+
+class Pipeline(object):
+    '''Run the stages of transcoding. A pool of reader threads reads the
+    input files into the page cache, no more at once from one device than it
+    handles well. A pool of decoder threads reads tags and, where an encoder
+    can't stream, decodes ahead into TMPDIR. A pool of encoder threads, as
+    many as there are process slots, runs the encoders. The queues between
+    them keep every stage from running too far ahead.'''
+
+    def __init__(self, options, manifests, index):
+        self.options    = options
+        self.manifests  = manifests
+        self.index      = index
+        self.inputQueue = InputQueue(SCAN_AHEAD, options.readers)
+        self.readyQueue = queue.Queue(maxsize=READ_AHEAD)
+        self.shitList   = queue.Queue()
+        self.scan       = ScanProgress()
+        self.makespan   = Makespan()
+        self.slots      = ProcessSlots(options.maxSlots or options.slots or numCores())
+        self.governor   = None
+        self.dedup      = Deduplicator() if options.dedup else None
+        self.client     = None      # WorkClient, if the jobs come from a coordinator
+        self.stopWatching = threading.Event()
+        self.inFlight   = {}        # Input path -> QueueEntry not finished yet, with --watch
+        self.lock       = threading.Lock()
+
+        if options.maxSlots:
+            self.slots.resize(max(options.minSlots, min(options.maxSlots, numCores())))
+            self.governor = Governor(self.slots, options.minSlots, options.maxSlots)
+        self.pcmBuffer  = PCMBuffer(PCM_BUFFER_LENGTH,
+                                    options.tempBudget or PCM_BUFFER_SIZE)
+
+        self.makespan.workers = self.slots.size
+
+        if options.decoders:
+            self.decoders = options.decoders
+        else:
+            self.decoders = max(1, self.slots.limit // 2)
+
+    def prefix(self, entry):
+        return '[{:> 6} / {:>6}]: '.format(entry.number, self.scan.total())
+
+    def loadTags(self, entry):
+        if not entry.inputAudioFile.loaded:
+            with stats.stage(entry.inputAudioFile.path, 'tags'):
+                entry.inputAudioFile.load()
+            if self.index:
+                self.index.store(entry.inputAudioFile, entry.stat)
+
+    def fingerprint(self, entry):
+        audioFile = entry.inputAudioFile
+
+        if self.dedup and audioFile.fingerprint is None:
+            with stats.stage(audioFile.path, 'fingerprint'):
+                audioFile.fingerprint = fingerprint(audioFile)
+            if self.index and entry.stat:
+                self.index.storeFingerprint(audioFile, entry.stat)
+
+    def claim(self, entry, pairs):
+        '''Return the pairs that the entry has to transcode itself, and the
+        ones to copy from a file with the same audio'''
+
+        if self.dedup:
+            return self.dedup.claim(entry, pairs)
+        else:
+            return pairs, []
+
+    def passThrough(self, entry, pairs, prefix):
+        '''Copy the input as the output of every pair whose setting can take
+        it as it is, and rewrite its tags. Return the pairs that have to be
+        transcoded.'''
+
+        audioFile = entry.inputAudioFile
+        leftovers = []
+        copied = []
+
+        for pair in pairs:
+            if not pair.setting.acceptsAsIs(audioFile):
+                leftovers.append(pair)
+                continue
+
+            outputPath = pair.outputPath + '.' + pair.encoder.extension
+            dbg(prefix + 'Copying as it is for ' + pair.setting.name)
+
+            with stats.stage(audioFile.path, 'passthrough',
+                                pair.setting.name) as record:
+                record.bytesIn = entry.stat.st_size if entry.stat else 0
+                record.ok = cloneOutput(audioFile.path, outputPath,
+                                        pair.encoder, audioFile.tags)
+
+            if record.ok:
+                record.bytesOut = record.bytesIn
+                copied.append(pair)
+            else:
+                leftovers.append(pair)
+
+        self.recordOutputs(entry, copied, [], prefix)
+        return leftovers
+
+    def copyDuplicates(self, entry, duplicates, prefix):
+        '''Wait for the files with the same audio to be transcoded and copy
+        their outputs. Return the pairs that have to be transcoded after all.'''
+
+        leftovers = []
+        for pair, claim in duplicates:
+            claim.done.wait()
+            mover.wait(claim.outputPath)
+
+            if not self.copyDuplicate(entry, pair, claim, prefix):
+                leftovers.append(pair)
+
+        return leftovers
+
+    def copyDuplicate(self, entry, pair, claim, prefix):
+        '''Copy the output of a finished claim as the output of the pair.
+        Return True if that worked.'''
+
+        outputPath = pair.outputPath + '.' + pair.encoder.extension
+
+        with stats.stage(entry.inputAudioFile.path, 'copy',
+                            pair.setting.name) as record:
+            record.ok = claim.ok and mover.landed(claim.outputPath) and \
+                            copyDuplicateOutput(claim.outputPath,
+                            claim.entry.inputAudioFile.tags, outputPath,
+                            pair.encoder, entry.inputAudioFile.tags)
+
+        if record.ok:
+            dbg(prefix + 'Copied ' + claim.outputPath)
+            self.recordOutputs(entry, [pair], [], prefix)
+
+        return record.ok
+
+    def encodeBatches(self, entry, pairs, prefix):
+        '''Encode with as many settings at once as the process slots allow.
+        This only takes more than one round if there are more settings than
+        slots. Return True if any of them failed.'''
+
+        slots = self.slots
+        failed = False
+
+        while pairs:
+            batch = pairs[:slots.limit]
+            pairs = pairs[slots.limit:]
+
+            for pair in batch:
+                dbg(prefix + 'Encoding with ' + pair.setting.name)
+
+            slots.acquire(len(batch))
+            try:
+                failedPairs = encodeConcurrently(entry.inputAudioFile, batch)
+            finally:
+                slots.release(len(batch))
+
+            if self.recordOutputs(entry, batch, failedPairs, prefix):
+                failed = True
+
+        return failed
+
+    def admit(self, entry):
+        '''Wait until the decoded audio of the entry fits in the budget for
+        TMPDIR. An entry too big to ever fit goes to the spill folder, if
+        there is one. Return the folder to decode into.'''
+
+        size = entry.decodedSize()
+        if self.spills(entry, size):
+            return self.options.spillDirectory
+
+        entry.reserved = size
+        self.pcmBuffer.reserve(size)
+        return TMPDIR
+
+    def spills(self, entry, size):
+        '''Send the entry to the spill folder if it can never fit in the
+        budget and there is one. Return True if it went there.'''
+
+        if self.options.spillDirectory and size > self.pcmBuffer.maxBytes:
+            entry.spilled = size
+            self.pcmBuffer.spill(size)
+            return True
+
+        return False
+
+    def settle(self, entry, decodedAudioFile):
+        '''Account for what actually landed on disk instead of the estimate,
+        and return its size'''
+
+        size = os.path.getsize(decodedAudioFile.path)
+
+        if entry.spilled:
+            self.pcmBuffer.spill(size - entry.spilled)
+            entry.spilled = size
+        elif entry.reserved:
+            self.pcmBuffer.release(entry.reserved - size)
+            entry.reserved = size
+
+        return size
+
+    def releaseTemp(self, entry):
+        self.pcmBuffer.release(entry.reserved)
+        self.pcmBuffer.spill(-entry.spilled)
+        entry.reserved = 0
+        entry.spilled = 0
+
+    def transcodingMessage(self, entry, prefix):
+        s = prefix + 'Transcoding ' + entry.inputAudioFile.name
+        if self.pcmBuffer.bytes or self.pcmBuffer.spilled:
+            s += ' (' + self.pcmBuffer.usage() + ')'
+        return s
+
+    def makeDirectories(self, entry, prefix):
+        '''Make the output folders of the entry. Return the pairs whose
+        folders exist.'''
+
+        pairs = []
+        for pair in entry.encoderAndOutputPaths:
+            folderPath = os.path.dirname(pair.outputPath)
+            try:
+                if mover.makeDirectories(folderPath):
+                    dbg(prefix + 'Made directories for ' + folderPath)
+                pairs.append(pair)
+            except OSError as e:
+                err(prefix + 'Could not make directories for "' + folderPath + '": ' + e.strerror)
+
+        return pairs
+
+    def recordOutputs(self, entry, batch, failedPairs, prefix):
+        '''Note the outputs of the batch in their manifests. Return True if
+        any of them failed.'''
+
+        if self.dedup:
+            self.dedup.publish(entry, batch, failedPairs)
 
-    def loadTags(self):
-        tags = subprocess.getoutput(FAAD + ' --info "' + escape(self.path) + '"')
+        failed = False
+        for pair in batch:
+            if pair in failedPairs:
+                err(prefix + 'Encoding with ' + pair.setting.name + ' failed')
+                failed = True
+            elif pair.manifest:
+                # A staged output only counts once it's in place
+                mover.after(self.recordOutput, entry, pair)
 
-        ar = re.compile('artist: (.+)', re.IGNORECASE)
-        al = re.compile('album: (.+)', re.IGNORECASE)
-        ti = re.compile('title: (.+)', re.IGNORECASE)
-        tr = re.compile('track: (.*)', re.IGNORECASE)
-        yr = re.compile('date: (.*)', re.IGNORECASE)
-#        cm = re.compile('COMMENT=(.*)', re.IGNORECASE)
+        return failed
 
-        for line in tags.splitlines():
-            m = ar.match(line)
-            if m:
-                self.tags['artist'] = m.group(1)
+    def recordOutput(self, entry, pair):
+        if mover.landed(pair.outputPath + '.' + pair.encoder.extension):
+            pair.manifest.record(pair.manifestKey, entry.inputAudioFile.path,
+                                    entry.stat, pair.encoder.opts)
 
-            m = al.match(line)
-            if m:
-                self.tags['album'] = m.group(1)
+    def finishEntry(self, entry, failed, seconds, prefix):
+        if self.dedup:
+            self.dedup.abandon(entry)
 
-            m = ti.match(line)
-            if m:
-                self.tags['title'] = m.group(1)
+        entry.inputAudioFile.removeTemporaryFiles()
+        self.releaseTemp(entry)
+        self.makespan.add(entry, seconds)
 
-            m = tr.match(line)
-            if m:
-                self.tags['track'] = m.group(1)
+        mover.after(self.finished, entry, failed, seconds, prefix)
 
-            m = yr.match(line)
-            if m:
-                self.tags['year'] = m.group(1)
+    def finished(self, entry, failed, seconds, prefix):
+        '''Finish an entry once its outputs are in place'''
 
-#            m = cm.match(line)
-#            if m:
-#                self.tags['comment'] = m.group(1)
+        for pair in entry.encoderAndOutputPaths:
+            if not mover.landed(pair.outputPath + '.' + pair.encoder.extension):
+                failed = True
 
-def makeAudioFile(path):
-    # TODO: Need a more intelligent way other than file extension to tell a
-    #       filetype
-    if os.path.isfile(path) and os.access(path, os.R_OK):
-        name = os.path.basename(path)
+        mover.finished(entry)
+        self.dropInFlight(entry)
+        progress.finished(entry, [] if failed else
+                            [pair.setting.name for pair in entry.encoderAndOutputPaths],
+                            failed)
 
-        try:
-            ext = os.path.splitext(name)[1].split('.')[1].lower()
-        except IndexError:
-            return None
+        if failed:
+            self.shitList.put(entry)
 
-        # .m4a files can be either ALAC or MP4. Since ALAC comes first in this
-        # list, it masks MP4.
-        if ext in AIFF_FILE_EXTENSIONS:
-            return AIFFAudioFile(path)
-        elif ext in ALAC_FILE_EXTENSIONS:
-            return ALACAudioFile(path)
-        elif ext in FLAC_FILE_EXTENSIONS:
-            return FLACAudioFile(path)
-        elif ext in MP3_FILE_EXTENSIONS:
-            return MP3AudioFile(path)
-        elif ext in MP4_FILE_EXTENSIONS:
-            return MP4AudioFile(path)
-        elif ext in VORBIS_FILE_EXTENSIONS:
-            return VorbisAudioFile(path)
-        elif ext in WAVE_FILE_EXTENSIONS:
-            return WaveAudioFile(path)
+        if self.client:
+            self.client.finish(entry, failed, seconds)
 
-    return None
+        dbg(prefix + 'Finished')
 
-# ------------------------------------------------------------------------------
+    def put(self, entry):
+        '''Queue an entry for the readers'''
 
-class AudioEncoder(object):
-    def __init__(self, opts):
-        self.opts = opts
+        if self.options.watch:
+            with self.lock:
+                self.inFlight[entry.inputAudioFile.path] = entry
 
-    def encode(self, audioFile, outputPath):
-        '''Decode the audioFile if necessary. Then, encode the
-        audioFile. The encoder adds the appropriate extension to
-        outputPath and writes the encoded file to that path.
+        mover.expect(entry)
+        progress.queued(entry)
+        self.inputQueue.put(entry)
 
-        Return the encoded AudioFile if successful, None otherwise
-        '''
-        pass
+    def dropInFlight(self, entry):
+        with self.lock:
+            if self.inFlight.get(entry.inputAudioFile.path) is entry:
+                del self.inFlight[entry.inputAudioFile.path]
 
-class ALACAudioEncoder(AudioEncoder):
-    def encode(self, audioFile, outputPath):
-        outputPath += '.m4a'
+    def isInFlight(self, path):
+        with self.lock:
+            return path in self.inFlight
 
-        pcmAudioFile = audioFile.decode()
+    def populate(self, inputQueue):
+        '''Scan the input directories into inputQueue, then prune. A worker
+        leases its entries from the coordinator instead.'''
 
-        if pcmAudioFile == None:
-            return None
+        if self.client:
+            self.client.populate(inputQueue, self.scan, self.slots)
+            return
 
-        cmd = AFCONVERT + ' -d alac ' + self.opts + ' "' + escape(pcmAudioFile.path) + \
-                '" "' + escape(outputPath) + '"'
-        exitCode = runProcess(cmd)
+        watcher = startWatching(self.options) if self.options.watch else None
 
-        if exitCode != 0:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+        startTime = time.perf_counter()
+        populateQueue(inputQueue, self.options, self.scan, self.manifests,
+                        self.index)
+        self.scan.seconds = time.perf_counter() - startTime
 
-        cmd = ATOMICPARSELEY + ' "' + escape(outputPath) + '" --overWrite'
+        if self.options.prune:
+            pruneOutputs(self.options, self.manifests)
 
-        if 'artist' in audioFile.tags:
-            cmd += ' --artist "' + escape(audioFile.tags['artist']) + '"'
-        if 'album' in audioFile.tags:
-            cmd += ' --album "' + escape(audioFile.tags['album']) + '"'
-        if 'title' in audioFile.tags:
-            cmd += ' --title "' + escape(audioFile.tags['title']) + '"'
-        if 'track' in audioFile.tags:
-            cmd += ' --tracknum "' + escape(audioFile.tags['track']) + '"'
-        if 'year' in audioFile.tags:
-            cmd += ' --year "' + escape(audioFile.tags['year']) + '"'
-        if 'comment' in audioFile.tags:
-            cmd += ' --comment "' + escape(audioFile.tags['comment']) + '"'
+        if watcher:
+            watchDirectories(watcher, inputQueue, self.options, self.scan,
+                                self.manifests, self.index, self.isInFlight,
+                                self.stopWatching)
 
-        exitCode = runProcess(cmd)
+    def reader(self, threadNum, readyQueue):
+        while True:
+            entry = self.inputQueue.get()
+            if entry is None:
+                dbg('Reader ' + str(threadNum) + ' finished')
+                return
 
-        if exitCode == 0:
-            encodedAudioFile = ALACAudioFile(outputPath)
-            encodedAudioFile.tags = audioFile.tags
-            return encodedAudioFile
-        else:
+            path = entry.inputAudioFile.path
             try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+                if not identifyAudioFile(entry.inputAudioFile):
+                    prefix = self.prefix(entry)
+                    err(prefix + 'Not audio piggy can read: ' + path)
+                    self.finishEntry(entry, True, 0, prefix)
+                    continue
+
+                with stats.stage(path, 'read') as record:
+                    record.device = entry.device.name
+                    try:
+                        record.bytesIn = readAhead(path)
+                    except OSError as e:
+                        # The decoder finds out for itself
+                        record.ok = False
+                        dbg('Could not read ' + path + ' ahead: ' + e.strerror)
+            finally:
+                self.inputQueue.done(entry)
+
+            readyQueue.put(entry)
+
+    def startReaders(self, readyQueue):
+        readers = []
+        for i in range(1, self.decoders + 1):
+            dbg('Spawning reader ' + str(i))
+            thread = threading.Thread(target=self.reader, args=[i, readyQueue])
+            readers.append(thread)
+            thread.start()
+
+        return readers
+
+    def decoder(self, threadNum):
+        while True:
+            entry = self.readyQueue.get()
+            if entry is None:
+                dbg('Decoder ' + str(threadNum) + ' finished')
+                return
+
+            startTime = time.monotonic()
+            prefix = self.prefix(entry)
+
+            self.loadTags(entry)
+            self.fingerprint(entry)
+
+            # Streaming encoders decode on their own, so only decode up front
+            # if somebody needs the temporary file
+            if needsDecoding(entry, self.options.stream, self.slots):
+                # PCM files are read in place
+                folder = None
+                if not isinstance(entry.inputAudioFile, PCMAudioFile):
+                    folder = self.admit(entry)
+
+                dbg(prefix + 'Decoding ' + entry.inputAudioFile.name)
+                with stats.stage(entry.inputAudioFile.path, 'decode',
+                                optional=True) as record:
+                    decodedAudioFile = entry.inputAudioFile.decode(folder)
+                    record.ok = decodedAudioFile is not None
+                    record.bytesIn = entry.stat.st_size if entry.stat else 0
+
+                if decodedAudioFile is None:
+                    err(prefix + 'Decode failed')
+                    self.finishEntry(entry, True, time.monotonic() - startTime,
+                                        prefix)
+                    continue
+
+                if folder:
+                    record.bytesOut = record.tempBytes = self.settle(entry,
+                                                            decodedAudioFile)
+
+            entry.decodeSeconds = time.monotonic() - startTime
+            self.pcmBuffer.put(entry)
+
+    def encoder(self, threadNum):
+        while True:
+            entry = self.pcmBuffer.get()
+            if entry is None:
+                dbg('Encoder ' + str(threadNum) + ' finished')
+                return
+
+            startTime = time.monotonic()
+            prefix = self.prefix(entry)
+            msg(self.transcodingMessage(entry, prefix))
+
+            pairs = self.makeDirectories(entry, prefix)
+            failed = len(pairs) < len(entry.encoderAndOutputPaths)
+            pairs, duplicates = self.claim(entry, pairs)
+            pairs = self.passThrough(entry, pairs, prefix)
+
+            if self.encodeBatches(entry, pairs, prefix):
+                failed = True
+
+            if duplicates:
+                pairs = self.copyDuplicates(entry, duplicates, prefix)
+                if self.encodeBatches(entry, pairs, prefix):
+                    failed = True
+
+            self.finishEntry(entry, failed,
+                            entry.decodeSeconds + time.monotonic() - startTime, prefix)
+
+    def run(self):
+        readers = self.startReaders(self.readyQueue)
+        decoders = []
+        encoders = []
+
+        for i in range(1, self.decoders + 1):
+            dbg('Spawning decoder ' + str(i))
+            thread = threading.Thread(target=self.decoder, args=[i])
+            decoders.append(thread)
+            thread.start()
+
+        # Each encoder thread may run several processes at once, but never
+        # more than the slots allow in total
+        for i in range(1, self.slots.size + 1):
+            dbg('Spawning encoder ' + str(i))
+            thread = threading.Thread(target=self.encoder, args=[i])
+            encoders.append(thread)
+            thread.start()
+
+        if self.governor:
+            self.governor.start()
+
+        # Feed the decoders from this thread while the encoders are already
+        # transcoding
+        self.populate(self)
+
+        # Every thread finishes once it pulls a None out of its queue.
+        # Everything is done when all of them have finished.
+        self.inputQueue.close()
+        for r in readers:
+            r.join()
+
+        for d in decoders:
+            self.readyQueue.put(None)
+
+        for d in decoders:
+            d.join()
+
+        for e in encoders:
+            self.pcmBuffer.put(None)
+
+        for e in encoders:
+            e.join()
+
+        if self.governor:
+            self.governor.stop()
+
+class ProcessPoolPipeline(Pipeline):
+    '''Pipeline, with the tags parsed in a pool of worker processes instead
+    of in the decoder threads, so that the parsing doesn't hold the GIL'''
+
+    def run(self):
+        # Forking a process that already has threads is asking for trouble
+        context = multiprocessing.get_context('spawn')
+
+        with concurrent.futures.ProcessPoolExecutor(self.decoders,
+                                                    mp_context=context) as pool:
+            self.pool = pool
+            Pipeline.run(self)
+
+    def loadTags(self, entry):
+        audioFile = entry.inputAudioFile
+
+        if not audioFile.loaded:
+            with stats.stage(audioFile.path, 'tags'):
+                audioFile.tags, audioFile.info = self.pool.submit(
+                                        readTagsAndInfo, audioFile.path,
+                                        type(audioFile)).result()
+                audioFile.loaded = True
+            if self.index:
+                self.index.store(audioFile, entry.stat)
+
+class AsyncPipeline(Pipeline):
+    '''Pipeline, with every child process run from a single asyncio event
+    loop instead of from a thread that blocks on it. One coroutine per process
+    slot takes a file from scanning to encoding, so the slots can go far past
+    the number of cores when the work is I/O-bound. Tags are still read in a
+    thread pool, since the fallbacks block on their tools.'''
+
+    def run(self):
+        asyncio.run(self.runAsync())
+
+    async def runAsync(self):
+        loop = asyncio.get_running_loop()
+        self.asyncQueue = asyncio.Queue(maxsize=READ_AHEAD)
+        self.asyncSlots = AsyncProcessSlots(self.slots.size, self.slots.limit)
+
+        if self.governor:
+            resize = lambda n: asyncio.run_coroutine_threadsafe(
+                                    self.asyncSlots.resize(n), loop).result()
+            self.governor = Governor(self.asyncSlots, self.options.minSlots,
+                                        self.options.maxSlots, resize)
+            self.governor.start()
+
+        workers = []
+        for i in range(1, self.slots.size + 1):
+            dbg('Spawning worker ' + str(i))
+            workers.append(asyncio.create_task(self.worker(i)))
+
+        readers = self.startReaders(AsyncQueueFeeder(self.asyncQueue, loop))
+        await loop.run_in_executor(None, self.populate, self)
+
+        self.inputQueue.close()
+        for r in readers:
+            await loop.run_in_executor(None, r.join)
+
+        for w in workers:
+            await self.asyncQueue.put(None)
+
+        await asyncio.gather(*workers)
 
-class FLACAudioEncoder(AudioEncoder):
-    def encode(self, audioFile, outputPath):
-        outputPath += '.flac'
+        if self.governor:
+            await loop.run_in_executor(None, self.governor.stop)
 
-        pcmAudioFile = audioFile.decode()
+    async def admitAsync(self, entry):
+        '''admit(), without tying up a thread while the entry waits'''
 
-        if pcmAudioFile == None:
-            return None
+        size = entry.decodedSize()
+        if self.spills(entry, size):
+            return self.options.spillDirectory
 
-        cmd = FLAC + ' --silent ' + self.opts
-
-        if 'artist' in audioFile.tags:
-            cmd += ' -T ARTIST="' + escape(audioFile.tags['artist']) + '"'
-        if 'album' in audioFile.tags:
-            cmd += ' -T ALBUM="' + escape(audioFile.tags['album']) + '"'
-        if 'title' in audioFile.tags:
-            cmd += ' -T TITLE="' + escape(audioFile.tags['title']) + '"'
-        if 'track' in audioFile.tags:
-            cmd += ' -T TRACKNUMBER="' + escape(audioFile.tags['track']) + '"'
-        if 'year' in audioFile.tags:
-            cmd += ' -T DATE="' + escape(audioFile.tags['year']) + '"'
-        if 'comment' in audioFile.tags:
-            cmd += ' -T COMMENT="' + escape(audioFile.tags['comment']) + '"'
-
-        cmd += ' -o "' + escape(outputPath) + \
-                '" "' + escape(pcmAudioFile.path) + '"'
-        exitCode = runProcess(cmd)
+        await self.pcmBuffer.reserveAsync(size)
+        entry.reserved = size
+        return TMPDIR
 
-        if exitCode == 0:
-            encodedAudioFile = FLACAudioFile(outputPath)
-            encodedAudioFile.tags = audioFile.tags
-            return encodedAudioFile
-        else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+    async def decodeAhead(self, entry):
+        audioFile = entry.inputAudioFile
 
-class OggencAudioEncoder(AudioEncoder):
-    def encode(self, audioFile, outputPath):
-        outputPath += '.ogg'
+        folder = await self.admitAsync(entry)
+        outputPath = audioFile.generateTempFileName(audioFile.name + '.wav', folder)
 
-        pcmAudioFile = audioFile.decode()
+        await self.asyncSlots.acquire()
+        try:
+            with stats.stage(audioFile.path, 'decode') as record:
+                record.bytesIn = entry.stat.st_size if entry.stat else 0
+                p = await startProcessAsync(audioFile.decodeCommand(outputPath),
+                                            record=record)
+                decodedAudioFile = audioFile.decoded(outputPath, await p.wait())
+                record.ok = decodedAudioFile is not None
 
-        if pcmAudioFile == None:
-            return None
+                if decodedAudioFile:
+                    record.bytesOut = record.tempBytes = self.settle(entry,
+                                                            decodedAudioFile)
+        finally:
+            await self.asyncSlots.release()
 
-        cmd = OGGENC + ' --quiet ' + self.opts
-
-        if 'artist' in audioFile.tags:
-            cmd += ' -a "' + escape(audioFile.tags['artist']) + '"'
-        if 'album' in audioFile.tags:
-            cmd += ' -l "' + escape(audioFile.tags['album']) + '"'
-        if 'title' in audioFile.tags:
-            cmd += ' -t "' + escape(audioFile.tags['title']) + '"'
-        if 'track' in audioFile.tags:
-            cmd += ' -N "' + escape(audioFile.tags['track']) + '"'
-        if 'year' in audioFile.tags:
-            cmd += ' -d "' + escape(audioFile.tags['year']) + '"'
-        if 'comment' in audioFile.tags:
-            cmd += ' -c "COMMENT=' + escape(audioFile.tags['comment']) + '"'
-
-        cmd += ' -o "' + escape(outputPath) + \
-                '" "' + escape(pcmAudioFile.path) + '"'
-        exitCode = runProcess(cmd)
+        return decodedAudioFile is not None
 
-        if exitCode == 0:
-            encodedAudioFile = VorbisAudioFile(outputPath)
-            encodedAudioFile.tags = audioFile.tags
-            return encodedAudioFile
-        else:
-            try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+    async def copyDuplicatesAsync(self, entry, duplicates, prefix):
+        '''copyDuplicates(), with the waiting done on the event loop. The
+        entries being waited for need the executor threads to finish, so only
+        the copying goes there.'''
 
-class LAMEAudioEncoder(AudioEncoder):
-    def encode(self, audioFile, outputPath):
-        outputPath += '.mp3'
+        loop = asyncio.get_running_loop()
+        leftovers = []
 
-        pcmAudioFile = audioFile.decode()
+        for pair, claim in duplicates:
+            await self.dedup.waitAsync(claim)
+            await mover.waitAsync(claim.outputPath)
 
-        if pcmAudioFile == None:
-            return None
+            if not await loop.run_in_executor(None, self.copyDuplicate,
+                                                entry, pair, claim, prefix):
+                leftovers.append(pair)
 
-        cmd = LAME + ' --silent ' + self.opts
-
-        if 'artist' in audioFile.tags:
-            cmd += ' --ta "' + escape(audioFile.tags['artist']) + '"'
-        if 'album' in audioFile.tags:
-            cmd += ' --tl "' + escape(audioFile.tags['album']) + '"'
-        if 'title' in audioFile.tags:
-            cmd += ' --tt "' + escape(audioFile.tags['title']) + '"'
-        if 'track' in audioFile.tags:
-            cmd += ' --tn "' + escape(audioFile.tags['track']) + '"'
-        if 'year' in audioFile.tags:
-            cmd += ' --ty "' + escape(audioFile.tags['year']) + '"'
-        if 'comment' in audioFile.tags:
-            cmd += ' --tc "' + escape(audioFile.tags['comment']) + '"'
-
-        cmd += ' "' + escape(pcmAudioFile.path) + \
-                '" "' + escape(outputPath) + '"'
-        exitCode = runProcess(cmd)
+        return leftovers
 
-        if exitCode == 0:
-            encodedAudioFile = MP3AudioFile(outputPath)
-            encodedAudioFile.tags = audioFile.tags
-            return encodedAudioFile
-        else:
+    async def encodeBatchesAsync(self, entry, pairs, prefix):
+        failed = False
+
+        while pairs:
+            batch = pairs[:self.asyncSlots.limit]
+            pairs = pairs[self.asyncSlots.limit:]
+
+            for pair in batch:
+                dbg(prefix + 'Encoding with ' + pair.setting.name)
+
+            await self.asyncSlots.acquire(len(batch))
             try:
-                deleteFile(outputPath)
-            except OSError:
-                pass
-            return None
+                failedPairs = await encodeConcurrentlyAsync(
+                                        entry.inputAudioFile, batch)
+            finally:
+                await self.asyncSlots.release(len(batch))
 
-# ------------------------------------------------------------------------------
+            if self.recordOutputs(entry, batch, failedPairs, prefix):
+                failed = True
 
-class FileList(object):
-    '''Store the absolute paths to all of the files under one root directory'''
+        return failed
 
-    def __init__(self, rootPath, absoluteFilePaths):
-        self.rootPath           = rootPath
-        self.absoluteFilePaths  = absoluteFilePaths
+    async def worker(self, workerNum):
+        loop = asyncio.get_running_loop()
 
-class EncoderSetting(object):
-    def __init__(self, name, folder, extension, encoder):
-        self.name       = name
-        self.folder     = folder
-        self.extension  = extension
-        self.encoder    = encoder
+        while True:
+            entry = await self.asyncQueue.get()
+            if entry is None:
+                dbg('Worker ' + str(workerNum) + ' finished')
+                return
 
-def findEncoderSetting(name):
-    for s in encoderSettings:
-        if s.name == name:
-            return s
+            startTime = time.monotonic()
+            prefix = self.prefix(entry)
 
-    return None
+            await loop.run_in_executor(None, self.loadTags, entry)
+            await loop.run_in_executor(None, self.fingerprint, entry)
 
-class EncoderAndOutputPath(object):
-    def __init__(self, setting, outputPath):
-        self.setting    = setting
-        self.outputPath = outputPath
-        self.encoder    = setting.encoder
+            msg(self.transcodingMessage(entry, prefix))
 
-class QueueEntry(object):
-    def __init__(self, number, inputAudioFile):
-        self.number                = number
-        self.inputAudioFile        = inputAudioFile
-        self.encoderAndOutputPaths = []
+            if needsDecoding(entry, self.options.stream, self.slots) and \
+                    not isinstance(entry.inputAudioFile, PCMAudioFile):
+                dbg(prefix + 'Decoding ' + entry.inputAudioFile.name)
+                if not await self.decodeAhead(entry):
+                    err(prefix + 'Decode failed')
+                    self.finishEntry(entry, True, time.monotonic() - startTime, prefix)
+                    continue
 
-    def addEncoderAndOutputPath(self, setting, outputPath):
-        self.encoderAndOutputPaths.append(EncoderAndOutputPath(setting,
-                                                            outputPath))
+            pairs = self.makeDirectories(entry, prefix)
+            failed = len(pairs) < len(entry.encoderAndOutputPaths)
+            pairs, duplicates = self.claim(entry, pairs)
+            pairs = await loop.run_in_executor(None, self.passThrough,
+                                                entry, pairs, prefix)
 
-# ------------------------------------------------------------------------------
+            if await self.encodeBatchesAsync(entry, pairs, prefix):
+                failed = True
 
-def parseCommandLine():
-    # return (settings, input directories, output directory)
+            if duplicates:
+                pairs = await self.copyDuplicatesAsync(entry, duplicates, prefix)
+                if await self.encodeBatchesAsync(entry, pairs, prefix):
+                    failed = True
 
-    # Accept the following command line arguments:
-    #   -s  Encoder Setting  (at least one)
-    #   -i  Input Directory  (at least one)
-    #       Output Directory (exactly one)
+            self.finishEntry(entry, failed, time.monotonic() - startTime, prefix)
 
-    settings            = []
-    inputDirectories    = []
-    outputDirectory     = ''
+ENGINES = {
+    'threads':      Pipeline,
+    'processes':    ProcessPoolPipeline,
+    'asyncio':      AsyncPipeline,
+}
 
-    try:
-        opts, args = getopt.getopt(sys.argv[1:], 's:i:')
-    except getopt.GetoptError as e:
-        err(e)
-        sys.exit(EXIT_CMDFAILURE)
+# ------------------------------------------------------------------------------
 
-    if len(args) != 1:
-        err('You must specify exactly one output directory')
-        sys.exit(EXIT_CMDFAILURE)
+# Distributed transcoding. A coordinator started with piggy.py serve scans the
+# library and hands out the entries as jobs to any number of piggy.py work
+# clients, which run them through their own Pipeline. The input and output
+# folders have to be at the same paths on every machine.
+#
+# The protocol is one JSON object per line: the client sends a request and the
+# coordinator answers it. A leased job goes back into the queue if its worker
+# hangs up or stops sending heartbeats, so a crashed machine leaves no holes.
+# Every lease has a number of its own, which the worker renews the job under
+# while it works on it and reports it under. Once a job has been leased again,
+# the old number is stale, and the coordinator ignores whatever comes with it.
+
+def parseAddress(address):
+    '''Return the socket family and address for HOST:PORT or a Unix socket
+    path'''
+
+    host, colon, port = address.rpartition(':')
+    if colon and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host or 'localhost', int(port))
     else:
-        outputDirectory = os.path.normpath(args[0])
+        return socket.AF_UNIX, address
 
-    for opt, arg in opts:
-        if opt == '-s':
-            setting = findEncoderSetting(arg)
+class Connection(object):
+    def __init__(self, sock):
+        self.sock       = sock
+        self.reader     = sock.makefile('r', encoding='utf-8')
+        self.writer     = sock.makefile('w', encoding='utf-8')
+        self.lock       = threading.Lock()  # One request at a time
 
-            if setting:
-                if settings.count(setting) > 0:
-                    err('Encoder setting "' + arg + '" was specified more than once')
-                    sys.exit(EXIT_CMDFAILURE)
-                else:
-                    settings.append(setting)
-            else:
-                err('Encoder setting "' + arg + '" does not exist')
-                sys.exit(EXIT_CMDFAILURE)
-        elif opt == '-i':
-            dir = os.path.normpath(arg)
-            if os.path.isdir(dir):
-                for d in inputDirectories:
-                    if os.path.basename(d) == os.path.basename(dir):
-                        err('WARNING: Duplicate basenames in input directories: ' + os.path.basename(dir))
-                inputDirectories.append(dir)
-            else:
-                err('Not a directory: ' + dir)
-                sys.exit(EXIT_CMDFAILURE)
+    def send(self, message):
+        self.writer.write(json.dumps(message) + '\n')
+        self.writer.flush()
 
-    if len(settings) < 1:
-        err('You must specify at least one encoder setting')
-        sys.exit(EXIT_CMDFAILURE)
+    def receive(self):
+        '''Return the next message, or None once the other end hangs up'''
 
-    if len(inputDirectories) < 1:
-        err('You must specify at least one input folder')
-        sys.exit(EXIT_CMDFAILURE)
+        line = self.reader.readline()
+        if not line:
+            return None
 
-    return (settings, inputDirectories, outputDirectory)
+        return json.loads(line)
 
-def recursiveFileList(root):
-    '''Return a FileList of all the files in a directory'''
+    def request(self, message):
+        with self.lock:
+            self.send(message)
+            reply = self.receive()
 
-    absoluteFilePaths = []
+        if reply is None:
+            raise ConnectionError('The coordinator hung up')
+        elif 'error' in reply:
+            raise ConnectionError(reply['error'])
 
-    # Clean up the root path (and remove the trailing slash)
-    root = os.path.normpath(root)
+        return reply
 
-    for dirpath, dirnames, filenames in os.walk(root):
-        # Add every non-hidden file in the directory to the list
-        for file in filenames:
-            if file.startswith('.'):
-                dbg('Ignoring file ' + os.path.join(dirpath, file))
-            else:
-                absoluteFilePaths.append(os.path.join(dirpath, file))
+    def close(self):
+        for f in [self.reader, self.writer, self.sock]:
+            try:
+                f.close()
+            except OSError:
+                pass
 
-    absoluteFilePaths.sort()
+class CoordinatorHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.coordinator.serveConnection(Connection(self.request))
+
+class CoordinatorTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads      = True
+
+class CoordinatorUnixServer(socketserver.ThreadingMixIn,
+                            socketserver.UnixStreamServer):
+    daemon_threads      = True
+
+class Coordinator(object):
+    '''Stand in for a Pipeline, but hand the entries out to workers instead of
+    transcoding them. Whatever the workers report ends up in the manifests,
+    the shit list and the stats, just as if this process had done the work.'''
+
+    def __init__(self, options, manifests, index):
+        self.options    = options
+        self.manifests  = manifests
+        self.index      = index
+        self.shitList   = queue.Queue()
+        self.scan       = ScanProgress()
+        self.makespan   = Makespan()
+        self.slots      = ProcessSlots(0)   # The workers' slots, added up
+        self.condition  = threading.Condition()
+        self.entries    = {}    # Job id -> QueueEntry
+        self.pending    = collections.deque()   # Job ids waiting for a worker
+        self.leases     = {}    # Job id -> [worker name, deadline, lease number]
+        self.leaseCount = 0     # Lease numbers handed out so far
+        self.finished   = set() # Job ids that are done, failed or not
+        self.workers    = set() # Names of the workers connected right now
+        self.server     = None
+
+    def put(self, entry):
+        '''Take an entry from populateQueue()'''
+
+        progress.queued(entry)
+
+        with self.condition:
+            entry.jobId = len(self.entries) + 1
+            self.entries[entry.jobId] = entry
+            self.pending.append(entry.jobId)
+            self.condition.notify_all()
+
+    def isDone(self):
+        return self.scan.done and len(self.finished) == len(self.entries)
+
+    def describe(self, entry):
+        return {
+            'id':       entry.jobId,
+            'lease':    self.leases[entry.jobId][2],
+            'number':   entry.number,
+            'path':     entry.inputAudioFile.path,
+            'outputs':  [{'setting':        pair.setting.name,
+                            'outputPath':   pair.outputPath,
+                            'manifestKey':  pair.manifestKey}
+                        for pair in entry.encoderAndOutputPaths],
+        }
+
+    def requeue(self, jobIds, why):
+        # The condition must be held
+        for jobId in jobIds:
+            del self.leases[jobId]
+            self.pending.appendleft(jobId)
+            err('Requeueing ' + self.entries[jobId].inputAudioFile.path +
+                ' because ' + why)
+
+        if jobIds:
+            self.condition.notify_all()
+
+    def requeueExpired(self):
+        # The condition must be held
+        now = time.monotonic()
+        self.requeue([jobId for jobId, (worker, deadline, lease) in self.leases.items()
+                        if deadline < now], 'its lease ran out')
+
+    def lease(self, worker, count, wait):
+        '''Hand out up to count jobs. If asked to, wait a little for some to
+        turn up, but not so long that the worker's heartbeats stop.'''
+
+        deadline = time.monotonic() + (LEASE_WAIT if wait else 0)
+        jobs = []
+
+        with self.condition:
+            self.requeueExpired()
+
+            while not self.pending and not self.isDone() and \
+                    time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            while self.pending and len(jobs) < count:
+                jobId = self.pending.popleft()
+                self.leaseCount += 1
+                self.leases[jobId] = [worker, time.monotonic() + LEASE_SECONDS,
+                                        self.leaseCount]
+                jobs.append(self.describe(self.entries[jobId]))
+
+            return {'jobs': jobs, 'files': self.scan.count,
+                    'scanned': self.scan.done, 'done': self.isDone()}
+
+    def isStale(self, jobId, lease):
+        # The condition must be held. A job whose lease ran out and that
+        # nobody else has leased yet still belongs to its old worker.
+        current = self.leases.get(jobId)
+        return jobId in self.finished or jobId not in self.entries or \
+                (current is not None and current[2] != lease)
+
+    def heartbeat(self, worker, jobs):
+        '''Renew the leases of the jobs the worker still works on. Return
+        the ones it has lost to another worker.'''
+
+        lost = []
+        with self.condition:
+            for jobId, lease in jobs:
+                current = self.leases.get(jobId)
+                if self.isStale(jobId, lease):
+                    lost.append(jobId)
+                elif current:
+                    current[1] = time.monotonic() + LEASE_SECONDS
+                elif jobId in self.pending:
+                    # It ran out, but nobody else has it yet
+                    self.pending.remove(jobId)
+                    self.leases[jobId] = [worker, time.monotonic() + LEASE_SECONDS,
+                                            lease]
+
+        return lost
+
+    def complete(self, worker, jobId, lease, failed, recorded, seconds):
+        '''Take the report of a job. Return False if it came under a stale
+        lease, in which case it's up to the job's current worker.'''
+
+        with self.condition:
+            if self.isStale(jobId, lease):
+                return False
+
+            # The lease may have run out and the job may be waiting for
+            # somebody else, but this worker got there first
+            self.leases.pop(jobId, None)
+            if jobId in self.pending:
+                self.pending.remove(jobId)
+
+            self.finished.add(jobId)
+            self.condition.notify_all()
+
+        entry = self.entries[jobId]
+        for pair in entry.encoderAndOutputPaths:
+            if pair.setting.name in recorded and pair.manifest:
+                pair.manifest.record(pair.manifestKey, entry.inputAudioFile.path,
+                                        entry.stat, pair.encoder.opts)
 
-    return FileList(root, absoluteFilePaths)
+        progress.finished(entry, recorded, failed)
 
-def populateQueue(inputQueue, settings, inputFileLists, outputDirectory):
-    counter = 1
+        if failed:
+            self.shitList.put(entry)
 
-    for fileList in inputFileLists:
-        for filePath in fileList.absoluteFilePaths:
-            audioFile = makeAudioFile(filePath)
-            if audioFile:
-                queueEntry = QueueEntry(counter, audioFile)
-                counter += 1
+        self.makespan.add(entry, seconds)
+        dbg(worker + ' finished ' + entry.inputAudioFile.path)
+        return True
 
-                # Add a trailing slash to the rootPath
-                rootStr = os.path.join(fileList.rootPath, '')
-                relativeFilePath = filePath.split(rootStr, 1)[1]
-                relativeFilePathWithoutExtension = os.path.splitext(
-                                                    relativeFilePath)[0]
+    def join(self, worker, slots):
+        with self.condition:
+            self.workers.add(worker)
+            self.slots.size += slots
+            self.slots.limit = self.slots.size
+            self.makespan.workers = self.slots.size
 
-                rootName = os.path.basename(fileList.rootPath)
+        msg('Worker ' + worker + ' joined with ' + str(slots) + ' processes')
 
-                for setting in settings:
-                    outputPath = os.path.join(outputDirectory,
-                                    setting.folder, rootName,
-                                    relativeFilePathWithoutExtension)
-                    queueEntry.addEncoderAndOutputPath(setting, outputPath)
+    def leave(self, worker):
+        with self.condition:
+            self.workers.discard(worker)
+            self.requeue([jobId for jobId, (w, deadline, lease) in self.leases.items()
+                            if w == worker], worker + ' left')
+            self.condition.notify_all()
 
-                inputQueue.put(queueEntry)
-            else:
-#               TODO: It might be a good idea to keep track of these and dump
-#               them when transcoding has finished
-                err('Could not make an AudioFile out of ' + filePath)
+    def serveConnection(self, connection):
+        worker = None
 
-    if inputQueue.qsize() < 1:
-        err('No audio files found')
-        sys.exit(EXIT_SUCCESS)
+        try:
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+
+                op = message.get('op')
+                reply = {}
+
+                if op == 'hello':
+                    worker = message['worker']
+                    self.join(worker, message['slots'])
+                    reply = {'settings': [s.name for s in self.options.settings]}
+                elif worker is None:
+                    reply = {'error': 'Say hello first'}
+                elif op == 'lease':
+                    reply = self.lease(worker, message['count'],
+                                        message.get('wait', True))
+                elif op == 'heartbeat':
+                    reply = {'lost': self.heartbeat(worker, message['jobs'])}
+                elif op == 'done':
+                    reply = {'accepted': self.complete(worker, message['id'],
+                                            message['lease'], message['failed'],
+                                            message['recorded'], message['seconds'])}
+                elif op == 'stats':
+                    for values in message['records']:
+                        stats.add(stageRecordFromList(values))
+                else:
+                    reply = {'error': 'Unknown request ' + repr(op)}
+
+                connection.send(reply)
+        except (OSError, ValueError, KeyError) as e:
+            err('Lost worker ' + str(worker) + ': ' + str(e))
+        finally:
+            if worker:
+                self.leave(worker)
+            connection.close()
+
+    def listen(self, address):
+        family, address = parseAddress(address)
+
+        if family == socket.AF_UNIX:
+            # Left over by a coordinator that didn't get to clean up
+            if os.path.exists(address):
+                deleteFile(address)
+            self.server = CoordinatorUnixServer(address, CoordinatorHandler)
+        else:
+            self.server = CoordinatorTCPServer(address, CoordinatorHandler)
+
+        self.server.coordinator = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def run(self):
+        self.listen(self.options.serveAddress)
+        msg('Waiting for workers on ' + self.options.serveAddress)
+
+        startTime = time.perf_counter()
+        populateQueue(self, self.options, self.scan, self.manifests, self.index)
+        self.scan.seconds = time.perf_counter() - startTime
+
+        with self.condition:
+            self.scan.done = True
+            self.condition.notify_all()
+
+        if self.options.prune:
+            pruneOutputs(self.options, self.manifests)
+
+        with self.condition:
+            while not self.isDone():
+                self.condition.wait(HEARTBEAT_INTERVAL)
+                self.requeueExpired()
+
+            # Give the workers a chance to send their stats and hang up
+            deadline = time.monotonic() + LEASE_SECONDS
+            while self.workers and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        if self.server.address_family == socket.AF_UNIX:
+            deleteFile(self.options.serveAddress)
+
+class RemoteManifest(object):
+    '''Stand in for the Manifest of one setting on a worker. The coordinator
+    records the outputs in the real one once it hears about them.'''
+
+    def __init__(self, recorded, settingName):
+        self.recorded       = recorded      # The setting names recorded for the job
+        self.settingName    = settingName
+
+    def record(self, key, sourcePath, stat, opts):
+        self.recorded.append(self.settingName)
+
+class WorkClient(object):
+    '''Lease jobs from a coordinator into a Pipeline and report back how they
+    went. Only a few jobs per process slot are leased at a time, so a faster
+    machine ends up with more of the work.'''
+
+    def __init__(self, address):
+        family, address = parseAddress(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+
+        self.connection = Connection(sock)
+        self.name       = socket.gethostname() + ':' + str(os.getpid())
+        self.condition  = threading.Condition()
+        self.leased     = 0     # Jobs leased and not reported yet
+        self.leases     = {}    # Job id -> lease number, for the same jobs
+        self.jobs       = 0     # Jobs reported
+        self.recorded   = {}    # Job id -> names of the settings recorded
+        self.stopped    = threading.Event()
+        self.heartbeats = threading.Thread(target=self.heartbeat, daemon=True)
+        self.reports    = queue.Queue()     # (job id, failed, seconds) to send
+        self.reporter   = threading.Thread(target=self.sendReports, daemon=True)
+
+    def hello(self, slots):
+        '''Introduce this worker and return the names of the settings'''
+
+        reply = self.connection.request({'op': 'hello', 'worker': self.name,
+                                            'slots': slots})
+        self.heartbeats.start()
+        self.reporter.start()
+        return reply['settings']
+
+    def heartbeat(self):
+        '''Renew the leases of the jobs this worker holds, however long they
+        take to transcode'''
+
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            with self.condition:
+                jobs = list(self.leases.items())
 
-def dumpShitList(shitList):
-    size = shitList.qsize()
+            try:
+                reply = self.connection.request({'op': 'heartbeat', 'jobs': jobs})
+            except OSError as e:
+                err('Could not send a heartbeat: ' + str(e))
+                return
 
-    if size > 0:
-        err('The following ' + str(size) + ' files could not be transcoded:')
+            for jobId in reply['lost']:
+                err('Job ' + str(jobId) + ' was handed to another worker')
+
+    def makeEntry(self, job):
+        audioFile = makeAudioFile(job['path'])
+        try:
+            stat = os.stat(job['path'])
+        except OSError:
+            stat = None
+
+        if audioFile is None or stat is None:
+            return None
+
+        entry = QueueEntry(job['number'], audioFile, stat)
+        entry.jobId = job['id']
+        recorded = self.recorded[entry.jobId] = []
+
+        for output in job['outputs']:
+            setting = findEncoderSetting(output['setting'])
+            entry.addEncoderAndOutputPath(setting, output['outputPath'],
+                                            RemoteManifest(recorded, setting.name),
+                                            output['manifestKey'])
+
+        return entry
+
+    def populate(self, inputQueue, scan, slots):
+        '''Lease jobs into inputQueue until the coordinator has no more'''
+
+        ahead = WORK_AHEAD * slots.size
 
         while True:
+            with self.condition:
+                while self.leased >= ahead:
+                    self.condition.wait()
+                count = ahead - self.leased
+                busy = self.leased > 0
+
+            # While a lease request waits, reports can't get through, so only
+            # wait at the coordinator when there is nothing to report
             try:
-                entry = shitList.get(block=False)
-                err('  ' + entry.inputAudioFile.path)
-            except queue.Empty:
+                reply = self.connection.request({'op': 'lease', 'count': count,
+                                                    'wait': not busy})
+            except (OSError, ValueError) as e:
+                err('Lost the coordinator: ' + str(e))
                 break
 
-    return size
+            # The progress lines count the coordinator's files
+            scan.count, scan.done = reply['files'], reply['scanned']
 
-# ------------------------------------------------------------------------------
+            for job in reply['jobs']:
+                entry = self.makeEntry(job)
+                with self.condition:
+                    self.leased += 1
+                    self.leases[job['id']] = job['lease']
+
+                if entry:
+                    inputQueue.put(entry)
+                else:
+                    err('Could not make an AudioFile out of ' + job['path'])
+                    self.report(job['id'], True, 0)
+
+            if reply['done']:
+                break
+
+            if busy and not reply['jobs']:
+                with self.condition:
+                    self.condition.wait(LEASE_WAIT)
+
+    def report(self, jobId, failed, seconds):
+        with self.condition:
+            lease = self.leases[jobId]
 
-def worker(threadNum, inputQueue, queueSize, shitList):
-    while True:
         try:
-            entry = inputQueue.get(block=False)
-        except queue.Empty:
-            dbg('Thread ' + str(threadNum) + ' finished')
-            return
+            reply = self.connection.request({'op': 'done', 'id': jobId,
+                                    'lease': lease, 'failed': failed,
+                                    'recorded': self.recorded.pop(jobId, []),
+                                    'seconds': seconds})
+            if not reply['accepted']:
+                err('Job ' + str(jobId) + ' was handed to another worker; ' +
+                    'its report is left to that one')
+        except (OSError, ValueError, KeyError) as e:
+            err('Could not report back to the coordinator: ' + str(e))
+
+        with self.condition:
+            del self.leases[jobId]
+            self.leased -= 1
+            self.jobs += 1
+            self.condition.notify_all()
+
+    def finish(self, entry, failed, seconds):
+        '''Queue a job's report for the reporter thread. This is called on the
+        OutputMover's thread, which mustn't wait on the coordinator.'''
+
+        self.reports.put((entry.jobId, failed, seconds))
+
+    def sendReports(self):
+        while True:
+            report = self.reports.get()
+            if report is None:
+                return
+            self.report(*report)
 
-        prefix = '[{:> 6} / {:>6}]: '.format(entry.number, queueSize)
-        msg(prefix + 'Transcoding ' + entry.inputAudioFile.name)
+    def close(self):
+        '''Send the reports that are still waiting and the stats of every
+        job to the coordinator, and hang up'''
 
-        decodedAudioFile = entry.inputAudioFile.decode()
+        self.stopped.set()
 
-        if decodedAudioFile is None:
-            err(prefix + 'Decode failed')
-            shitList.put(entry)
-            continue
+        if self.reporter.is_alive():
+            self.reports.put(None)
+            self.reporter.join()
 
-        for pair in entry.encoderAndOutputPaths:
-            folderPath = os.path.dirname(pair.outputPath)
-            try:
-                dbg(prefix + 'Making directories for ' + folderPath)
-                os.makedirs(folderPath, exist_ok=True)
-            except OSError as e:
-                err(prefix + 'Could not make directories for "' + folderPath + '": ' + e.strerror)
-                shitList.put(entry)
-                break
+        with stats.lock:
+            records = [record.asList() for record in stats.records]
 
-            dbg(prefix + 'Encoding with ' + pair.setting.name)
-            encodedAudioFile = pair.encoder.encode(decodedAudioFile,
-                                                    pair.outputPath)
-            if encodedAudioFile is None:
-                err(prefix + 'Encoding with ' + pair.setting.name + ' failed')
-                shitList.put(entry)
-                break
+        try:
+            self.connection.request({'op': 'stats', 'records': records})
+        except (OSError, ValueError) as e:
+            err('Could not send the stats to the coordinator: ' + str(e))
 
-        entry.inputAudioFile.removeTemporaryFiles()
-        dbg(prefix + 'Finished')
+        self.connection.close()
+
+def work(options):
+    '''Run jobs leased from the coordinator at options.workAddress until
+    there are none left'''
+
+    try:
+        client = WorkClient(options.workAddress)
+    except OSError as e:
+        err('Could not connect to ' + options.workAddress + ': ' + str(e))
+        sys.exit(EXIT_FAILURE)
+
+    index = None
+    if options.indexPath:
+        index = LibraryIndex(options.indexPath)
+
+    pipeline = ENGINES[options.engine](options, {}, index)
+    pipeline.client = client
+
+    try:
+        names = client.hello(pipeline.slots.size)
+    except (OSError, ValueError) as e:
+        err('Could not talk to ' + options.workAddress + ': ' + str(e))
+        sys.exit(EXIT_FAILURE)
+
+    for name in names:
+        setting = findEncoderSetting(name)
+        if setting is None:
+            err('Encoder setting "' + name + '" does not exist here')
+            sys.exit(EXIT_FAILURE)
+        options.settings.append(setting)
+        msg('Encoding with ' + name)
+
+    msg('Working for ' + options.workAddress + ' as ' + client.name)
+    timer = Timer()
+
+    mover.open(options.stagingDirectory, options.fsync)
+
+    sep()
 
-def spawnThreads(inputQueue, queueSize, shitList):
-    workers = []
+    timer.start()
+    progress.start(pipeline.scan)
+    try:
+        pipeline.run()
+    finally:
+        mover.close()
+        progress.stop()
+        client.close()
+        if index:
+            index.close()
+    timer.stop()
 
-    # Spawn and run all the worker threads
-    for i in range(1, numCores() + 1):
-        dbg('Spawning thread ' + str(i))
-        thread = threading.Thread(target=worker, args=[i, inputQueue, queueSize, shitList])
-        workers.append(thread)
-        thread.start()
+    sep()
 
-    # The workers will finish once the queue is empty. Everything is
-    # done when all workers have finished.
-    for w in workers:
-        w.join()
+    failures = dumpShitList(pipeline.shitList)
+    msg('Finished ' + str(client.jobs) + ' jobs, ' + str(len(failures)) +
+        ' of them failed, in ' + timer.stringDelta())
+    stats.summary(timer.timeDelta(), pipeline.slots.size)
 
 def main():
-    inputFileLists  = []                # A list of FileList objects
-    inputQueue      = queue.Queue()
-    shitList        = queue.Queue()
+    options = parseCommandLine()
 
-    settings, inputDirectories, outputDirectory = parseCommandLine()
+    if options.mergePath:
+        mergeReports(options.mergePath, options.mergeInputs)
+        sys.exit(EXIT_SUCCESS)
+
+    if options.workAddress:
+        work(options)
+        sys.exit(EXIT_SUCCESS)
 
-    for s in settings:
+    for s in options.settings:
         msg('Encoding with ' + s.name)
 
-    for d in inputDirectories:
+    for d in options.inputDirectories:
         msg('Searching ' + d)
 
-    msg('Outputting to ' + outputDirectory)
+    msg('Outputting to ' + options.outputDirectory)
+
+    if not options.stream:
+        msg('Decoding into ' + TMPDIR)
 
-    for d in inputDirectories:
-        inputFileLists.append(recursiveFileList(d))
+    if options.spillDirectory:
+        msg('Decoding files too big for ' + TMPDIR + ' into ' + options.spillDirectory)
 
-    populateQueue(inputQueue, settings, inputFileLists, outputDirectory)
-    queueSize = inputQueue.qsize()
+    if options.stagingDirectory:
+        msg('Staging the outputs in ' + options.stagingDirectory)
 
+    if options.fsync != 'none':
+        msg('Syncing every ' + options.fsync + ' to disk')
+
+    if options.engine != 'threads':
+        msg('Running on the ' + options.engine + ' engine')
+
+    if options.serveAddress:
+        msg('Handing out the work to piggy work clients')
+    elif options.maxSlots:
+        msg('Running between ' + str(options.minSlots) + ' and ' +
+            str(options.maxSlots) + ' processes at once')
+    else:
+        msg('Running ' + str(options.slots or numCores()) + ' processes at once')
+
+    if options.resume:
+        msg('Resuming where the last run left off')
+    elif options.incremental:
+        msg('Skipping files that are up to date')
+
+    if options.dedup:
+        msg('Copying the outputs of files with the same audio')
+
+    if options.watch:
+        msg('Watching for new and changed files until interrupted')
+
+    if options.shard:
+        msg('Transcoding shard ' + str(options.shard[0]) + ' of ' +
+            str(options.shard[1]) + ', split by ' + options.shardBy)
+
+    manifests = {}
+    for s in options.settings:
+        manifests[s.name] = Manifest(os.path.join(options.outputDirectory, s.folder),
+                                        options.shard)
+
+    journal.open(os.path.join(options.outputDirectory,
+                                JOURNAL_NAME + shardSuffix(options.shard)))
+    if journal.files and options.resume:
+        msg('Deleting ' + str(len(journal.files)) + ' temporary files that ' +
+            'an interrupted run left behind')
+        journal.deleteLeftovers()
+    elif journal.files:
+        err('WARNING: An interrupted run left ' + str(len(journal.files)) +
+            ' temporary files behind; --resume deletes them')
+
+    index = None
+    if options.indexPath:
+        msg('Using the library index in ' + options.indexPath)
+        index = LibraryIndex(options.indexPath)
+
+    if options.serveAddress:
+        pipeline = Coordinator(options, manifests, index)
+    else:
+        pipeline = ENGINES[options.engine](options, manifests, index)
+    scan = pipeline.scan
     timer = Timer()
 
+    if options.watch:
+        stopWatchingOnSignals(pipeline.stopWatching)
+
+    mover.open(options.stagingDirectory, options.fsync)
+
     sep()
 
     timer.start()
-    spawnThreads(inputQueue, queueSize, shitList)
+    progress.start(scan)
+    try:
+        pipeline.run()
+    finally:
+        mover.close()
+        progress.stop()
+        for m in manifests.values():
+            m.close()
+        journal.close()
+        if index:
+            index.close()
     timer.stop()
 
+    # Another shard may well have all the files
+    if scan.count + scan.skipped < 1 and not options.shard:
+        err('No audio files found')
+        sys.exit(EXIT_SUCCESS)
+
     sep()
 
-    shitListSize = dumpShitList(shitList)
-    msg('Encoded ' + str(queueSize - shitListSize) + ' files in ' + timer.stringDelta())
+    if scan.skipped > 0:
+        msg('Skipped ' + str(scan.skipped) + ' files that were already up to date')
+
+    failures = dumpShitList(pipeline.shitList)
+    msg('Encoded ' + str(scan.count - len(failures)) + ' files in ' + timer.stringDelta())
+    pipeline.makespan.report(timer.timeDelta())
+    stats.summary(timer.timeDelta(), pipeline.slots.size)
+
+    if options.reportPath:
+        msg('Writing the run report to ' + options.reportPath)
+        stats.writeReport(options.reportPath, timer.timeDelta(),
+                            pipeline.slots.size, scan, failures, options.shard)
 
 # ------------------------------------------------------------------------------
 
 encoderSettings = [
-#                   NAME            FOLDER         EXTENSION    ENCODER
-    EncoderSetting('alac',          'alac',         'm4a',      ALACAudioEncoder('')),
-    EncoderSetting('flac',          'flac',         'flac',     FLACAudioEncoder('--best --verify')),
-    EncoderSetting('oggenc-q5',     'vorbis-q5',    'ogg',      OggencAudioEncoder('-q 5')),
-    EncoderSetting('lame-vbr2',     'mp3-vbr2',     'mp3',      LAMEAudioEncoder('-m j -h --vbr-new -V 2 --id3v2-only --noreplaygain')),
-    EncoderSetting('lame-cbr192',   'mp3-cbr192',   'mp3',      LAMEAudioEncoder('-m j -h -b 192 --id3v2-only --noreplaygain')),
-    EncoderSetting('lame-cbr256',   'mp3-cbr256',   'mp3',      LAMEAudioEncoder('-m j -h -b 256 --id3v2-only --noreplaygain')),
-    EncoderSetting('lame-standard', 'mp3-standard', 'mp3',      LAMEAudioEncoder('--preset standard --id3v2-only --noreplaygain')),
-    EncoderSetting('lame-extreme',  'mp3-extreme',  'mp3',      LAMEAudioEncoder('--preset extreme --id3v2-only --noreplaygain')),
-    EncoderSetting('lame-insane',   'mp3-insane',   'mp3',      LAMEAudioEncoder('--preset insane --id3v2-only --noreplaygain')),
+#                   NAME            FOLDER         EXTENSION    ENCODER                                                                     COST    PASSTHROUGH
+    EncoderSetting('alac',          'alac',         'm4a',      ALACAudioEncoder(''),                                                       0.5,    [Passthrough('alac')]),
+    EncoderSetting('flac',          'flac',         'flac',     FLACAudioEncoder('--best --verify'),                                        1.0,    [Passthrough('flac')]),
+    EncoderSetting('oggenc-q5',     'vorbis-q5',    'ogg',      OggencAudioEncoder('-q 5'),                                                 2.0),
+    EncoderSetting('lame-vbr2',     'mp3-vbr2',     'mp3',      LAMEAudioEncoder('-m j -h --vbr-new -V 2 --id3v2-only --noreplaygain'),     2.0),
+    EncoderSetting('lame-cbr192',   'mp3-cbr192',   'mp3',      LAMEAudioEncoder('-m j -h -b 192 --id3v2-only --noreplaygain'),             2.5),
+    EncoderSetting('lame-cbr256',   'mp3-cbr256',   'mp3',      LAMEAudioEncoder('-m j -h -b 256 --id3v2-only --noreplaygain'),             2.5),
+    EncoderSetting('lame-standard', 'mp3-standard', 'mp3',      LAMEAudioEncoder('--preset standard --id3v2-only --noreplaygain'),          2.0),
+    EncoderSetting('lame-extreme',  'mp3-extreme',  'mp3',      LAMEAudioEncoder('--preset extreme --id3v2-only --noreplaygain'),           2.0),
+    EncoderSetting('lame-insane',   'mp3-insane',   'mp3',      LAMEAudioEncoder('--preset insane --id3v2-only --noreplaygain'),            2.5),
 ]
 
 # ------------------------------------------------------------------------------
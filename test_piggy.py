@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+# test_piggy.py
+#
+# Serban Giuroiu
+# http://serban.org
+#
+# Run piggy against small libraries with the stand-in codecs from benchmark.py.
+# Every run happens in a child process with a time limit, so a pipeline that
+# hangs fails its test instead of the whole suite.
+
+# ------------------------------------------------------------------------------
+
+import glob
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import benchmark
+import piggy
+
+# ------------------------------------------------------------------------------
+
+PIGGY                   = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'piggy.py')
+TIMEOUT                 = 60            # Seconds before a run counts as hung
+SETTINGS                = ['flac', 'lame-vbr2']
+OUTPUT_EXTENSIONS       = ('.flac', '.mp3')
+TEMP_POLL_INTERVAL      = 0.005         # Seconds between looks at TMPDIR
+POLL_INTERVAL           = 0.05          # Seconds between looks at anything else
+
+# What asyncio gives its default executor. The asyncio engine must not need
+# more threads than this, however many process slots it runs.
+EXECUTOR_THREADS        = min(32, (os.cpu_count() or 1) + 4)
+
+# ------------------------------------------------------------------------------
+
+class PiggyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='piggy-test-')
+        self.inputPath = os.path.join(self.root, 'input')
+        self.outputPath = os.path.join(self.root, 'output')
+        self.savedPath = os.environ['PATH']
+        benchmark.installStandIns(os.path.join(self.root, 'bin'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.savedPath
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def piggyArgv(self, args):
+        argv = [sys.executable, PIGGY]
+        for name in SETTINGS:
+            argv += ['-s', name]
+        return argv + args + ['-i', self.inputPath, self.outputPath]
+
+    def runPiggy(self, args):
+        try:
+            p = subprocess.run(self.piggyArgv(args), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, timeout=TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.fail('piggy ' + ' '.join(args) + ' hung with ' +
+                        str(self.countOutputs()) + ' outputs written')
+
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8', 'replace'))
+
+    def waitFor(self, condition, what):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Gave up waiting for ' + what)
+            time.sleep(POLL_INTERVAL)
+
+    def compressedLibrary(self, count):
+        '''Write count one-second FLAC files, which are decoded ahead'''
+
+        options = benchmark.Options()
+        options.count = count
+        options.length = 1.0
+        options.depth = 0
+        options.flacPercent = 100
+        benchmark.generateLibrary(self.inputPath, options)
+
+    def countOutputs(self):
+        count = 0
+        for folder, folders, files in os.walk(self.outputPath):
+            count += sum(1 for name in files if name.endswith(OUTPUT_EXTENSIONS)
+                            and not name.startswith('.'))
+        return count
+
+class AsyncEngineTest(PiggyTestCase):
+    '''The asyncio engine runs more process slots than its executor has
+    threads, so nothing it waits for may tie one of them up'''
+
+    def testTempBudgetWithMoreSlotsThanThreads(self):
+        count = 2 * EXECUTOR_THREADS
+        self.compressedLibrary(count)
+
+        # A budget of about one decoded file, with every one decoded ahead
+        self.runPiggy(['-e', 'asyncio', '-j', str(count), '-t', '-b', '200K'])
+        self.assertEqual(self.countOutputs(), count * len(SETTINGS))
+
+    def testTempBudgetIsKept(self):
+        count = 16
+        self.compressedLibrary(count)
+
+        # The decoded files are named after the inputs, so mark the inputs to
+        # tell this run's files in TMPDIR apart from anybody else's
+        mark = os.path.basename(self.root)
+        for folder, folders, files in os.walk(self.inputPath):
+            for name in files:
+                os.rename(os.path.join(folder, name),
+                            os.path.join(folder, mark + ' ' + name))
+
+        peak = [0]
+        stop = threading.Event()
+
+        def watch():
+            pattern = os.path.join(piggy.TMPDIR, '*' + mark + '*')
+            while not stop.is_set():
+                size = 0
+                for path in glob.glob(pattern):
+                    try:
+                        size += os.path.getsize(path)
+                    except OSError:
+                        pass
+                peak[0] = max(peak[0], size)
+                time.sleep(TEMP_POLL_INTERVAL)
+
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            self.runPiggy(['-e', 'asyncio', '-j', str(count), '-t', '-b', '200K'])
+        finally:
+            stop.set()
+            watcher.join()
+
+        self.assertEqual(self.countOutputs(), count * len(SETTINGS))
+        self.assertGreater(peak[0], 0)
+        self.assertLessEqual(peak[0], piggy.parseSize('200K'))
+
+    def testDuplicatesWithMoreSlotsThanThreads(self):
+        # Every file but one waits for that one to be transcoded
+        count = 2 * EXECUTOR_THREADS
+        data = benchmark.noise(random.Random(benchmark.RANDOM_SEED), 1.0)
+        os.makedirs(self.inputPath)
+        for number in range(count):
+            benchmark.writeWave(os.path.join(self.inputPath,
+                                '{:02} Copy.wav'.format(number)), data)
+
+        self.runPiggy(['-e', 'asyncio', '-j', str(count), '-m'])
+        self.assertEqual(self.countOutputs(), count * len(SETTINGS))
+
+class ShardTest(PiggyTestCase):
+    def testShardsAndMerge(self):
+        options = benchmark.Options()
+        options.count = 24
+        options.length = 1.0
+        options.depth = 1
+        options.flacPercent = 50
+        benchmark.generateLibrary(self.inputPath, options)
+
+        inputs = set()
+        for folder, folders, files in os.walk(self.inputPath):
+            inputs.update(os.path.join(folder, name) for name in files)
+
+        reportPaths = [os.path.join(self.root, 'shard%d.json' % k) for k in [1, 2]]
+        runs = [subprocess.Popen(self.piggyArgv(['--shard', '%d/2' % k, '-r', path]),
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+                for k, path in enumerate(reportPaths, 1)]
+        try:
+            for p in runs:
+                self.assertEqual(p.wait(timeout=TIMEOUT), 0)
+        finally:
+            for p in runs:
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+
+        # Every input went to exactly one of the shards
+        reports = []
+        for path in reportPaths:
+            with open(path) as f:
+                reports.append(json.load(f))
+        first, second = [set(report['files']) for report in reports]
+        self.assertEqual(first & second, set())
+        self.assertEqual(first | second, inputs)
+        self.assertEqual(self.countOutputs(), len(inputs) * len(SETTINGS))
+
+        runPath = os.path.join(self.root, 'run.json')
+        p = subprocess.run([sys.executable, PIGGY, '--merge', runPath] + reportPaths,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            timeout=TIMEOUT)
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8', 'replace'))
+
+        with open(runPath) as f:
+            run = json.load(f)
+        self.assertEqual(sorted(run['shards']), [[1, 2], [2, 2]])
+        self.assertEqual(run['scan']['files'], len(inputs))
+        self.assertEqual(set(run['files']), inputs)
+        self.assertEqual(run['failures'], [])
+
+class OutputTest(PiggyTestCase):
+    '''Two writers of one output, as when a watched file changes again while
+    it's being transcoded, a lease runs out, or two runs share an output
+    folder'''
+
+    def testWritersOfOneOutput(self):
+        os.makedirs(self.outputPath)
+        outputPath = os.path.join(self.outputPath, 'Song.flac')
+
+        first = piggy.startOutput(outputPath)
+        second = piggy.startOutput(outputPath)
+        self.assertNotEqual(first, second)
+
+        with open(first, 'wb') as f, open(second, 'wb') as g:
+            f.write(b'1' * 1000)
+            g.write(b'2' * 10)
+            f.write(b'1' * 1000)
+
+        # A writer that fails only cleans up after itself
+        third = piggy.startOutput(outputPath)
+        with open(third, 'wb') as f:
+            f.write(b'3')
+        self.assertFalse(piggy.commitOutput(third, False))
+
+        self.assertTrue(piggy.commitOutput(second, True))
+        self.assertTrue(piggy.commitOutput(first, True))
+
+        with open(outputPath, 'rb') as f:
+            self.assertEqual(f.read(), b'1' * 2000)
+        self.assertEqual(os.listdir(self.outputPath), ['Song.flac'])
+
+    def testRunsSharingAnOutputFolder(self):
+        count = 24
+        data = benchmark.noise(random.Random(benchmark.RANDOM_SEED), 2.0)
+        os.makedirs(self.inputPath)
+        for number in range(count):
+            benchmark.writeWave(os.path.join(self.inputPath,
+                                '{:02} Track.wav'.format(number)), data)
+
+        argv = [sys.executable, PIGGY, '-s', 'lame-vbr2', '-i', self.inputPath,
+                self.outputPath]
+        runs = [subprocess.Popen(argv, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL) for i in range(2)]
+        try:
+            for p in runs:
+                self.assertEqual(p.wait(timeout=TIMEOUT), 0)
+        finally:
+            for p in runs:
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+
+        # The stand-in lame copies its input, so every output is the whole
+        # input and nothing else
+        with open(os.path.join(self.inputPath, '00 Track.wav'), 'rb') as f:
+            expected = f.read()
+
+        outputFolder = os.path.join(self.outputPath, 'mp3-vbr2', 'input')
+        names = sorted(name for name in os.listdir(outputFolder)
+                        if not name.startswith('.'))
+        self.assertEqual(len(names), count)
+        for name in names:
+            with open(os.path.join(outputFolder, name), 'rb') as f:
+                self.assertEqual(f.read(), expected, name)
+
+        self.assertEqual([name for name in os.listdir(outputFolder)
+                            if name.startswith(piggy.PARTIAL_PREFIX)], [])
+
+class WatchTest(PiggyTestCase):
+    def testChangeWhileTranscoding(self):
+        # A lame that takes longer than a change takes to be noticed, and
+        # notes when it starts and stops
+        logPath = os.path.join(self.root, 'lame.log')
+        realPath = os.path.join(self.root, 'real', 'lame')
+        os.makedirs(os.path.dirname(realPath))
+        os.symlink(os.path.join(self.root, 'bin', 'standin'), realPath)
+
+        lamePath = os.path.join(self.root, 'bin', 'lame')
+        os.remove(lamePath)
+        with open(lamePath, 'w') as f:
+            f.write('#!/bin/sh\necho start >> ' + logPath + '\nsleep ' +
+                    str(3 * piggy.WATCH_SETTLE) + '\n' +
+                    realPath + ' "$@"\nstatus=$?\necho stop >> ' + logPath +
+                    '\nexit $status\n')
+        os.chmod(lamePath, 0o755)
+
+        def log():
+            try:
+                with open(logPath) as f:
+                    return f.read().split()
+            except FileNotFoundError:
+                return []
+
+        rng = random.Random(benchmark.RANDOM_SEED)
+        inputPath = os.path.join(self.inputPath, 'Song.wav')
+        outputPath = os.path.join(self.outputPath, 'mp3-vbr2', 'input', 'Song.mp3')
+        os.makedirs(self.inputPath)
+
+        argv = [sys.executable, PIGGY, '--watch', '-j', '4', '-s', 'lame-vbr2',
+                '-i', self.inputPath, self.outputPath]
+        p = subprocess.Popen(argv, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            benchmark.writeWave(inputPath, benchmark.noise(rng, 0.5))
+            self.waitFor(lambda: log(), 'the first transcode')
+
+            # Changed again while it's being transcoded
+            benchmark.writeWave(inputPath, benchmark.noise(rng, 1.0))
+            self.waitFor(lambda: log().count('stop') == 2, 'the second transcode')
+        finally:
+            p.send_signal(signal.SIGINT)
+            try:
+                p.wait(timeout=TIMEOUT)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+
+        self.assertEqual(log(), ['start', 'stop', 'start', 'stop'])
+        with open(inputPath, 'rb') as f, open(outputPath, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+class LeaseTest(PiggyTestCase):
+    '''A job whose lease ran out while its worker was still at it'''
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(self.inputPath)
+        path = os.path.join(self.inputPath, 'Song.wav')
+        benchmark.writeWave(path, benchmark.noise(random.Random(1), 0.1))
+
+        self.coordinator = piggy.Coordinator(piggy.Options(), {}, None)
+        self.coordinator.put(piggy.QueueEntry(1, piggy.makeAudioFile(path),
+                                                os.stat(path)))
+
+    def runOut(self, jobId):
+        with self.coordinator.condition:
+            self.coordinator.leases[jobId][1] = 0
+            self.coordinator.requeueExpired()
+
+    def testStaleReportIsRefused(self):
+        first = self.coordinator.lease('first', 1, False)['jobs'][0]
+        self.runOut(first['id'])
+        second = self.coordinator.lease('second', 1, False)['jobs'][0]
+        self.assertEqual(first['id'], second['id'])
+        self.assertNotEqual(first['lease'], second['lease'])
+
+        jobs = [[first['id'], first['lease']]]
+        self.assertEqual(self.coordinator.heartbeat('first', jobs), [first['id']])
+        self.assertFalse(self.coordinator.complete('first', first['id'],
+                                                    first['lease'], False, [], 1.0))
+        self.assertTrue(self.coordinator.complete('second', second['id'],
+                                                    second['lease'], False, [], 1.0))
+        self.assertEqual(self.coordinator.finished, set([second['id']]))
+
+    def testHeartbeatKeepsAJobNobodyElseHas(self):
+        first = self.coordinator.lease('first', 1, False)['jobs'][0]
+        self.runOut(first['id'])
+
+        jobs = [[first['id'], first['lease']]]
+        self.assertEqual(self.coordinator.heartbeat('first', jobs), [])
+        self.assertEqual(self.coordinator.lease('second', 1, False)['jobs'], [])
+        self.assertTrue(self.coordinator.complete('first', first['id'],
+                                                    first['lease'], False, [], 1.0))
+
+if __name__ == '__main__':
+    unittest.main()